@@ -0,0 +1,309 @@
+"""
+Benchmark suite of the stages other than FPLUME, which scale with the size of the catalog
+and with the number of Monte Carlo samples:
+    - era5_to_met: processing of ERA5 pressure-level NetCDF files into .met files
+      (create_met_file.process_era5_data and save_to_txt);
+    - load_events: loading of the eruption catalog;
+    - open_ensemble: opening of the stored .npy ensembles (ensemble_store.open_ensemble);
+    - ensemble_percentiles: percentiles of the box plot;
+    - ensemble_ecdf: ECDF of the radar height ± 300 m;
+    - ensemble_ci: confidence intervals of the box statistics and ECDF (bootstrap_ci, or its
+      binomial limit for ensembles larger than max_bootstrap_samples).
+
+Synthetic inputs (ERA5 files with the same structure as the downloaded ones, catalogs and
+ensembles) of the selected size are generated in a temporary directory. Each stage is timed
+(best of --repeat) and its peak memory is measured with tracemalloc in a separate run.
+
+Results are compared with the baselines stored in BENCHMARK_FILE for the same size: the run
+fails (exit code 1) if a stage is slower than the baseline by more than time_tolerance or
+uses more memory than mem_tolerance (benchmark in config.yaml). --save-baseline stores the
+current results as the new baselines.
+
+Usage:
+    python fplume_montecarlo.benchmark --scale small
+    python fplume_montecarlo.benchmark --events 10000 --ensembles 10 --samples 1000000
+    python fplume_montecarlo.benchmark --scale medium --save-baseline
+"""
+
+# ---Import packages
+import argparse
+import json
+from pathlib import Path
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+# ---Import directories and utilities
+from fplume_montecarlo.config import PROJ_ROOT
+from fplume_montecarlo.create_met_file import process_era5_data, save_to_txt
+from fplume_montecarlo.ensemble_store import (
+    EnsembleWriter,
+    ensemble_ci,
+    ensemble_ecdf,
+    ensemble_percentiles,
+    open_ensemble,
+)
+from fplume_montecarlo.utilities import load_config, load_events
+
+CONFIG = load_config(PROJ_ROOT / "config.yaml")
+
+# ---Load volcano features
+VOLCANO = CONFIG["volcano"]
+
+# ---Stored baselines
+BENCHMARK_FILE = PROJ_ROOT / "benchmarks" / "baselines.json"
+
+# ---Sizes of the synthetic inputs
+SCALES = {
+    "small":  {"events": 10,    "ensembles": 10,  "samples": 1_000,     "met_files": 10},
+    "medium": {"events": 1_000, "ensembles": 100, "samples": 10_000,    "met_files": 50},
+    "large":  {"events": 10_000, "ensembles": 10, "samples": 1_000_000, "met_files": 200},
+}
+
+# ---Pressure levels of the ERA5 downloads (hPa)
+PRESSURE_LEVELS = [1000, 975, 950, 925, 900, 875, 850, 825, 800, 775, 750, 700, 650, 600,
+                   550, 500, 450, 400, 350, 300, 250, 225, 200, 175, 150, 125, 100, 70,
+                   50, 30, 20, 10, 7, 5]
+
+def synthetic_era5(path, date, rng):
+    """
+    Writes a synthetic ERA5 pressure-level NetCDF file around the volcano, with the same
+    dimensions and variables as the files of download_era5.py.
+    """
+    p = np.array(PRESSURE_LEVELS, dtype=float)
+    lat = VOLCANO.latitude + np.arange(1, -1.25, -0.25)
+    lon = VOLCANO.longitude + np.arange(-1, 1.25, 0.25)
+    shape = (1, len(p), len(lat), len(lon))
+
+    # ---Standard atmosphere with random perturbations
+    z_m = np.clip(44330.8 * (1 - (p / 1013.25) ** 0.190263), 0, None)
+    T = np.where(z_m < 11000, 288.15 - 6.5e-3 * z_m, 216.65)
+    noise = lambda scale: rng.normal(0, scale, shape)
+    variables = {
+        "z": z_m[None, :, None, None] * 9.80665 + noise(20.0),
+        "t": T[None, :, None, None] + noise(1.0),
+        "q": 8e-3 * np.exp(-z_m / 2500)[None, :, None, None] * (1 + noise(0.05)),
+        "u": 10 + 20 * np.sin(np.pi * z_m / 24000)[None, :, None, None] + noise(2.0),
+        "v": noise(5.0),
+    }
+    ds = xr.Dataset(
+        {name: (("valid_time", "pressure_level", "latitude", "longitude"), values.astype("float32"))
+         for name, values in variables.items()},
+        coords={"valid_time": [date], "pressure_level": p, "latitude": lat, "longitude": lon},
+    )
+    ds.to_netcdf(path)
+
+def synthetic_catalog(path, n_events, rng):
+    """
+    Writes a synthetic eruption catalog with the columns of list_eruptions.txt.
+    """
+    dates = pd.Timestamp("2000-01-01") + pd.to_timedelta(rng.integers(0, 24 * 365 * 25, n_events), unit="h")
+    pd.DataFrame({
+        "code": np.arange(1, n_events + 1),
+        "year": dates.strftime("%Y"),
+        "month": dates.strftime("%m"),
+        "day": dates.strftime("%d"),
+        "hour": dates.strftime("%H"),
+        "mer": np.round(10 ** rng.uniform(4, 7, n_events)),
+        "exit_v": rng.choice([200, 250], n_events),
+        "h": np.round(rng.uniform(6000, 15000, n_events)),
+    }).to_csv(path, sep="\t", index=False)
+
+def synthetic_ensembles(directory, n_ensembles, n_samples, rng):
+    """
+    Writes synthetic .npy ensembles (heights above the vent, as run_montecarlo stores them).
+    One ensemble in ten has importance sampling weights, the others are plain Monte Carlo.
+
+    Returns:
+        list[str]: the date prefixes of the ensembles.
+    """
+    prefixes = []
+    for k in range(n_ensembles):
+        prefix = f"ensemble_{k:05d}"
+        weighted = k % 10 == 0
+        writer = EnsembleWriter(directory, prefix, n_samples, weighted=weighted)
+        for start in range(0, n_samples, writer.chunk_size):
+            n = min(writer.chunk_size, n_samples - start)
+            heights = np.round(rng.lognormal(np.log(6000), 0.2, n), 1)
+            writer.write(start, heights, rng.uniform(0.5, 1.5, n) if weighted else None)
+        writer.close()
+        prefixes.append(prefix)
+    return prefixes
+
+def generate_inputs(directory, size, seed=0):
+    """
+    Generates all the synthetic inputs of a benchmark run.
+
+    Returns:
+        dict: paths of the ERA5 files and catalog, directory and prefixes of the ensembles.
+    """
+    rng = np.random.default_rng(seed)
+    era5_dir = directory / "ERA5"
+    era5_dir.mkdir()
+    era5_files = []
+    for k in range(size["met_files"]):
+        date = pd.Timestamp("2021-01-01") + pd.Timedelta(hours=k)
+        path = era5_dir / f"{date:%Y_%m_%d_%H}_pressure_levels.nc"
+        synthetic_era5(path, date, rng)
+        era5_files.append(path)
+
+    catalog = directory / "list_eruptions.txt"
+    synthetic_catalog(catalog, size["events"], rng)
+
+    ensembles_dir = directory / "column_files"
+    ensembles_dir.mkdir()
+    prefixes = synthetic_ensembles(ensembles_dir, size["ensembles"], size["samples"], rng)
+    return {"era5_files": era5_files, "catalog": catalog, "ensembles_dir": ensembles_dir,
+            "ensemble_prefixes": prefixes, "met_dir": directory, "seed": seed}
+
+def stage_functions(inputs):
+    """
+    Builds the benchmarked stages. Stages after open_ensemble use the ensembles it opens.
+
+    Returns:
+        dict: {stage name: callable}
+    """
+    state = {}
+
+    def era5_to_met():
+        for era5_file in inputs["era5_files"]:
+            save_to_txt(process_era5_data(era5_file), inputs["met_dir"] / f"{era5_file.stem}.met")
+
+    def load_catalog():
+        load_events(inputs["catalog"], code=None)
+
+    # ---Radar height above the vent, at the median of the synthetic ensembles
+    radar = np.full(len(inputs["ensemble_prefixes"]), 6000.0)
+
+    def open_ensembles():
+        state["ensembles"] = [open_ensemble(inputs["ensembles_dir"], prefix)
+                              for prefix in inputs["ensemble_prefixes"]]
+
+    def box_stats():
+        for ensemble in state["ensembles"]:
+            ensemble_percentiles(ensemble, [1, 25, 50, 75, 99])
+
+    def ecdf():
+        for ensemble, h in zip(state["ensembles"], radar):
+            ensemble_ecdf(ensemble, [h - 300, h, h + 300])
+
+    def confidence_intervals():
+        ensemble_ci(state["ensembles"], radar, n_boot=1000, seed=inputs["seed"])
+
+    return {
+        "era5_to_met": era5_to_met,
+        "load_events": load_catalog,
+        "open_ensemble": open_ensembles,
+        "ensemble_percentiles": box_stats,
+        "ensemble_ecdf": ecdf,
+        "ensemble_ci": confidence_intervals,
+    }
+
+def run_benchmark(inputs, repeat=3):
+    """
+    Times each stage (best of repeat) and measures its peak memory with tracemalloc.
+
+    Returns:
+        dict: {stage: {"seconds": float, "peak_mb": float}}
+    """
+    results = {}
+    for name, func in stage_functions(inputs).items():
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            func()
+            times.append(time.perf_counter() - start)
+
+        # ---Peak memory in a separate run, tracemalloc slows down the stage
+        tracemalloc.start()
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        results[name] = {"seconds": min(times), "peak_mb": peak / 1e6}
+        print(f"  {name:<20} {min(times):>9.3f} s {peak / 1e6:>10.1f} MB")
+    return results
+
+def size_key(size):
+    """
+    Key of the baselines of a benchmark size.
+    """
+    return ",".join(f"{k}={size[k]}" for k in ("events", "ensembles", "samples", "met_files"))
+
+def compare(results, baseline):
+    """
+    Compares the results with the baseline of the same size.
+
+    Returns:
+        list[str]: description of the regressions (empty if none).
+    """
+    settings = CONFIG["benchmark"]
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        ref = baseline[name]
+        if result["seconds"] > ref["seconds"] * (1 + settings["time_tolerance"]) + settings["min_seconds"]:
+            regressions.append(f"{name}: {result['seconds']:.3f} s vs baseline {ref['seconds']:.3f} s")
+        if result["peak_mb"] > ref["peak_mb"] * (1 + settings["mem_tolerance"]) + 1:
+            regressions.append(f"{name}: {result['peak_mb']:.1f} MB vs baseline {ref['peak_mb']:.1f} MB")
+    return regressions
+
+def main():
+    """
+    Parses command-line arguments, runs the benchmark and checks it against the baselines.
+    """
+    parser = argparse.ArgumentParser(description="Benchmark of the ERA5 -> met and analysis stages")
+    parser.add_argument("--scale", choices=list(SCALES), default="small", help="Preset size")
+    parser.add_argument("--events", type=int, help="Events in the catalog")
+    parser.add_argument("--ensembles", type=int, help="Number of .column files")
+    parser.add_argument("--samples", type=int, help="Samples per .column file")
+    parser.add_argument("--met-files", type=int, help="Number of ERA5 files")
+    parser.add_argument("--repeat", type=int, default=3, help="Timed runs per stage")
+    parser.add_argument("--save-baseline", action="store_true", help="Store the results as baselines")
+    args = parser.parse_args()
+
+    size = dict(SCALES[args.scale])
+    for key in size:
+        if getattr(args, key) is not None:
+            size[key] = getattr(args, key)
+    key = size_key(size)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        print(f"Generating synthetic inputs ({key})")
+        inputs = generate_inputs(Path(tmp), size)
+        print(f"{'Stage':<22} {'Time':>11} {'Peak memory':>13}")
+        results = run_benchmark(inputs, repeat=args.repeat)
+
+    baselines = {}
+    if BENCHMARK_FILE.exists():
+        with open(BENCHMARK_FILE, "r") as f:
+            baselines = json.load(f)
+
+    if args.save_baseline:
+        baselines[key] = results
+        BENCHMARK_FILE.parent.mkdir(parents=True, exist_ok=True)
+        with open(BENCHMARK_FILE, "w") as f:
+            json.dump(baselines, f, indent=2)
+        print(f"Saved baselines to: {BENCHMARK_FILE}")
+        return
+
+    if key not in baselines:
+        print(f"No baseline for {key}. Run with --save-baseline to store one")
+        return
+
+    regressions = compare(results, baselines[key])
+    if regressions:
+        print("Performance regressions:")
+        for regression in regressions:
+            print(f"  {regression}")
+        sys.exit(1)
+    print("No regressions against the baselines")
+
+if __name__ == "__main__":
+    main()
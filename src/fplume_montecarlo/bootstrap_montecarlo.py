@@ -0,0 +1,200 @@
+"""
+Bootstrap confidence intervals of the Monte Carlo statistics, to assess whether the number
+of FPLUME runs (n_montecarlo) is large enough.
+
+For each event, the box statistics (1st, 25th, 50th, 75th, 99th percentiles) and the ECDF
+at the radar height (low/mid/high, i.e. h - 300 m, h, h + 300 m) are resampled n_boot times.
+All the events are processed at once, without Python loops over events or replicates:
+    - percentiles: the bootstrap distribution of the order statistic of rank m of a sample
+      of size N only depends on N: P(X*_(m) <= x_(i)) = P(Binomial(N, (i + 1) / N) > m).
+      It is computed once per N and replicates are drawn for every event by searchsorted of
+      uniform draws, giving a matrix of indices into the sorted ensembles;
+    - ECDF: the resampled counts below h - 300, h and h + 300 m are drawn jointly from a
+      multinomial distribution.
+Importance sampling ensembles (weighted) use a Poisson bootstrap of the weights instead.
+
+Used by plot_montecarlo.py and qqplot_montecarlo.py, through ensemble_store.ensemble_ci
+(large ensembles use the binomial limit of the bootstrap in bounded memory).
+
+Usage:
+    python fplume_montecarlo.bootstrap_montecarlo --n-boot 1000
+"""
+
+# ---Import packages
+import argparse
+from functools import cache
+import time
+
+import numpy as np
+from scipy.stats import binom
+
+# ---Import directories and utilities
+from fplume_montecarlo.config import COLUMN_FILES_DIR, ERUPTIONS_FILE, PROJ_ROOT
+from fplume_montecarlo.utilities import load_config, load_events
+
+CONFIG = load_config(PROJ_ROOT / "config.yaml")
+
+# ---Box statistics (percentiles) of plot_montecarlo.py
+BOX_PERCENTILES = (1, 25, 50, 75, 99)
+
+@cache
+def order_statistic_cdf(N, percentiles=BOX_PERCENTILES):
+    """
+    Exact bootstrap CDF of the order statistics used for the given percentiles.
+
+    Returns:
+        np.ndarray: shape (len(percentiles), N), entry [q, i] = P(X*_(m_q) <= x_(i)).
+    """
+    ranks = np.rint(np.asarray(percentiles) / 100 * (N - 1)).astype(int)
+    p = np.arange(1, N + 1) / N
+    return binom.sf(ranks[:, None], N, p[None, :])
+
+def bootstrap_percentiles(sorted_vals, n_boot, rng, percentiles=BOX_PERCENTILES):
+    """
+    Bootstrap replicates of the percentiles of ensembles of equal size.
+
+    Parameters:
+        sorted_vals (np.ndarray): sorted ensembles, shape (E, N).
+
+    Returns:
+        np.ndarray: replicates, shape (E, len(percentiles), n_boot).
+    """
+    E, N = sorted_vals.shape
+    cdf = order_statistic_cdf(N, tuple(percentiles))
+
+    u = rng.random((len(percentiles), E * n_boot))
+    idx = np.stack([np.searchsorted(cdf[q], u[q]) for q in range(len(percentiles))])
+    idx = np.minimum(idx, N - 1).reshape(len(percentiles), E, n_boot).transpose(1, 0, 2)
+    return np.take_along_axis(sorted_vals[:, :, None], idx.reshape(E, -1, 1), axis=1).reshape(idx.shape)
+
+def bootstrap_ecdf(sorted_vals, thresholds, n_boot, rng):
+    """
+    Bootstrap replicates of the ECDF of ensembles of equal size at increasing thresholds.
+
+    Parameters:
+        sorted_vals (np.ndarray): sorted ensembles, shape (E, N).
+        thresholds (np.ndarray): increasing thresholds per event, shape (E, T).
+
+    Returns:
+        np.ndarray: replicates, shape (E, T, n_boot).
+    """
+    E, N = sorted_vals.shape
+    counts = (sorted_vals[:, None, :] <= thresholds[:, :, None]).sum(axis=2)        # (E, T)
+
+    # ---Probabilities of the intervals between thresholds (and above the last one)
+    probs = np.diff(np.concatenate([np.zeros((E, 1)), counts, np.full((E, 1), N)], axis=1), axis=1) / N
+    draws = rng.multinomial(N, probs, size=(n_boot, E))                    # (n_boot, E, T + 1)
+    return (np.cumsum(draws[..., :-1], axis=2) / N).transpose(1, 2, 0)
+
+def bootstrap_weighted(values, weights, thresholds, n_boot, rng, percentiles=BOX_PERCENTILES,
+                       max_elements=2_000_000):
+    """
+    Poisson bootstrap of the weighted percentiles and ECDF of an importance sampling ensemble.
+    Replicates are drawn in blocks of at most max_elements resampled weights, so that memory
+    stays bounded for large ensembles.
+
+    Returns:
+        tuple: (np.ndarray (len(percentiles), n_boot), np.ndarray (len(thresholds), n_boot))
+    """
+    order = np.argsort(values)
+    x, w = values[order], weights[order]
+    below = (x[None, :] <= np.asarray(thresholds)[:, None]).astype(float)   # (T, N)
+    levels = np.asarray(percentiles) / 100
+
+    box, ecdf = [], []
+    chunk = max(1, max_elements // len(x))
+    for start in range(0, n_boot, chunk):
+        b = min(chunk, n_boot - start)
+        cw = rng.poisson(1.0, size=(b, len(x))) * w                         # (b, N)
+        total = cw.sum(axis=1)
+        ecdf.append((cw @ below.T / total[:, None]).T)
+        cum = (np.cumsum(cw, axis=1) - 0.5 * cw) / total[:, None]
+        idx = np.stack([np.searchsorted(row, levels) for row in cum], axis=1)
+        box.append(x[np.minimum(idx, len(x) - 1)])
+    return np.concatenate(box, axis=1), np.concatenate(ecdf, axis=1)
+
+def bootstrap_ci(ensembles, radar_values, weights=None, n_boot=1000, level=0.95,
+                 radar_sigma=300, seed=None):
+    """
+    Bootstrap confidence intervals of the box statistics and of the ECDF at the radar height
+    (h - radar_sigma, h, h + radar_sigma) for every event.
+
+    Parameters:
+        ensembles (list of np.ndarray): simulated column heights of each event.
+        radar_values (array-like): radar column height of each event (same units).
+        weights (list of np.ndarray or None): importance sampling weights of each event
+            (None, or uniform weights, for plain Monte Carlo).
+        n_boot (int): number of bootstrap replicates.
+        level (float): confidence level.
+        radar_sigma (float): radar height uncertainty.
+        seed (int or None): seed of the random generator.
+
+    Returns:
+        dict: "box_low", "box_high" of shape (E, 5) and "ecdf_low", "ecdf_high" of shape
+        (E, 3), bounds of the confidence intervals.
+    """
+    rng = np.random.default_rng(seed)
+    E = len(ensembles)
+    radar_values = np.asarray(radar_values, dtype=float)
+    thresholds = radar_values[:, None] + np.array([-radar_sigma, 0, radar_sigma])[None, :]
+    weights = weights if weights is not None else [None] * E
+
+    box = np.empty((E, len(BOX_PERCENTILES), n_boot))
+    ecdf = np.empty((E, 3, n_boot))
+
+    # ---Plain Monte Carlo ensembles, grouped by size
+    groups = {}
+    for e, (values, w) in enumerate(zip(ensembles, weights)):
+        if w is not None and not np.all(w == w[0]):
+            box[e], ecdf[e] = bootstrap_weighted(np.asarray(values), np.asarray(w),
+                                                 thresholds[e], n_boot, rng)
+        else:
+            groups.setdefault(len(values), []).append(e)
+
+    for members in groups.values():
+        sorted_vals = np.sort(np.stack([ensembles[e] for e in members]), axis=1)
+        box[members] = bootstrap_percentiles(sorted_vals, n_boot, rng)
+        ecdf[members] = bootstrap_ecdf(sorted_vals, thresholds[members], n_boot, rng)
+
+    alpha = (1 - level) / 2
+    box_low, box_high = np.quantile(box, [alpha, 1 - alpha], axis=2)
+    ecdf_low, ecdf_high = np.quantile(ecdf, [alpha, 1 - alpha], axis=2)
+    return {"box_low": box_low, "box_high": box_high, "ecdf_low": ecdf_low, "ecdf_high": ecdf_high}
+
+def main():
+    """
+    Prints the bootstrap confidence intervals of all the events with a .column file.
+    """
+    parser = argparse.ArgumentParser(description="Bootstrap confidence intervals of Monte Carlo statistics")
+    parser.add_argument("--n-boot", type=int, default=1000, help="Number of bootstrap replicates")
+    parser.add_argument("--level", type=float, default=0.95, help="Confidence level")
+    args = parser.parse_args()
+
+    from fplume_montecarlo.ensemble_store import ensemble_ci, ensemble_size, open_ensemble
+
+    entries = []
+    for event in load_events(ERUPTIONS_FILE, code=None):
+        column_file = COLUMN_FILES_DIR / f"{event['date_prefix']}.column"
+        if not column_file.exists():
+            continue
+        entries.append((event, open_ensemble(COLUMN_FILES_DIR, event["date_prefix"])))
+
+    if not entries:
+        print("No .column files found")
+        return
+
+    start = time.perf_counter()
+    ci = ensemble_ci([e[1] for e in entries], [e[0]["h"] - e[0]["volcano"].height for e in entries],
+                     n_boot=args.n_boot, level=args.level)
+    elapsed = time.perf_counter() - start
+
+    print(f"{'Event':<16} {'N':>7} {'Median CI (m)':>20} {'ECDF(h) CI (%)':>18}")
+    for e, (event, ensemble) in enumerate(entries):
+        height = event["volcano"].height
+        print(f"{event['date_prefix']:<16} {ensemble_size(ensemble)[0]:>7d} "
+              f"{ci['box_low'][e, 2] + height:>9.0f} – {ci['box_high'][e, 2] + height:<8.0f} "
+              f"{ci['ecdf_low'][e, 1] * 100:>8.1f} – {ci['ecdf_high'][e, 1] * 100:<6.1f}")
+    print(f"{len(entries)} events x {args.n_boot} replicates in {elapsed:.2f} s")
+
+if __name__ == "__main__":
+    main()
@@ -30,6 +30,7 @@ RAW_DATA_DIR = DATA_DIR / "raw"                              # Parent directory
 # --- Volcanic eruption events directory
 ERUPTIONS_DIR = RAW_DATA_DIR                                 # Parent directory
 ERUPTIONS_FILE = ERUPTIONS_DIR / "list_eruptions.txt"        # txt file containing the list of the volcanic eruptions 
+TIMESERIES_FILE = ERUPTIONS_DIR / "list_timeseries.txt"      # txt file containing the time-series campaigns (start/end window)
 
 # --- Intermediate data directories
 INTERIM_DATA_DIR = DATA_DIR / "interim"                      # Parent directory
@@ -1,17 +1,29 @@
 """
-Processes ERA5 pressure-level dataset for Etna volcanic eruption events
+Processes ERA5 pressure-level dataset for the volcanic eruption events
 listed in list_eruptions.txt and generates .met meteorological profile files 
 used as input for the FPLUME volcanic plume model.
 
-Data is interpolated vertically (every 5 hPa) at the Etna volcano location, and
+Data is interpolated vertically (every 5 hPa) at the location of the volcano of each
+event (volcano column of the catalog, default volcano of config.yaml), and
 converted into FPLUME's expected tabular format.
+
+ERA5 files can be NetCDF (.nc) or GRIB (.grib, requires cfgrib). Files are opened lazily:
+only the variables of the .met profile at the grid column nearest to the vent are decoded
+(chunk-aware if dask is installed). --benchmark compares the parse time with the former
+eager decoding of the whole file.
+
 Usage:
     python fplume_montecarlo.create_met_file --code <n>
     python fplume_montecarlo.create_met_file --all
+    python fplume_montecarlo.create_met_file --all --benchmark
+    python fplume_montecarlo.create_met_file --all --profile         # see profiling.py
 """
 
 # --- Import packages
 import argparse
+import importlib.util
+import os
+import time
 import pandas as pd
 import numpy as np
 import xarray as xr
@@ -20,16 +32,61 @@ from pathlib import Path
 # --- Import Import ERA5 directories, volcanic erupions file
 from fplume_montecarlo.config import PROJ_ROOT, ERA5_DIR, FPLUME_MET_FILES_DIR, ERUPTIONS_FILE
 from fplume_montecarlo.utilities import load_events,load_config
+from fplume_montecarlo.profiling import profiled
 
 CONFIG = load_config(PROJ_ROOT / "config.yaml")
 
-def process_era5_data(nc_file):
+# --- ERA5 variables used for the .met profile
+MET_VARIABLES = ["z", "t", "q", "u", "v"]
+
+def find_era5_file(date_prefix):
+    """
+    Returns the ERA5 pressure-level file of an event: GRIB if downloaded, otherwise NetCDF.
+    """
+    for suffix in (".grib", ".nc"):
+        era5_file = Path(ERA5_DIR) / f"{date_prefix}_pressure_levels{suffix}"
+        if era5_file.exists():
+            return era5_file
+    return Path(ERA5_DIR) / f"{date_prefix}_pressure_levels.nc"
+
+def open_era5_column(era5_file, latitude, longitude):
+    """
+    Lazily opens an ERA5 pressure-level file and decodes only the .met variables
+    at the grid point nearest to the given location.
+
+    Parameters:
+        era5_file (str or Path): NetCDF (.nc) or GRIB (.grib) file.
+        latitude (float): latitude of the vent.
+        longitude (float): longitude of the vent.
+
+    Returns:
+        xr.Dataset: variables z, t, q, u, v along the pressure_level dimension.
+    """
+    kwargs = {}
+    if Path(era5_file).suffix == ".grib":
+        if importlib.util.find_spec("cfgrib") is None:
+            raise ImportError("Reading GRIB files requires cfgrib: pip install cfgrib")
+        kwargs["engine"] = "cfgrib"
+        kwargs["backend_kwargs"] = {"indexpath": "", "filter_by_keys": {"typeOfLevel": "isobaricInhPa"}}
+    if importlib.util.find_spec("dask") is not None:
+        kwargs["chunks"] = {}                   # keep the on-disk chunks, read on demand
+
+    ds = xr.open_dataset(era5_file, **kwargs)
+    if "isobaricInhPa" in ds.dims:
+        ds = ds.rename({"isobaricInhPa": "pressure_level"})
+
+    # ---Select variables and vent column before reading any data
+    ds = ds[MET_VARIABLES].sel(latitude=latitude, longitude=longitude, method='nearest')
+    return ds.load()
+
+def process_era5_data(nc_file, volcano=None):
     """
-    Processes ERA5 datasets in NetCDF format to extract meteorological variables at Etna's location
-    and interpolates them to 5 hPa vertical resolution.
+    Processes ERA5 datasets in NetCDF format to extract meteorological variables at the volcano
+    location and interpolates them to 5 hPa vertical resolution.
 
     Parameters:
-        nc_file (str or Path): Path to the ERA5 NetCDF file containing pressure-level data.
+        nc_file (str or Path): Path to the ERA5 NetCDF or GRIB file containing pressure-level data.
+        volcano (Volcano, optional): volcano of the event (default volcano of config.yaml if None).
 
     Returns:
         df (pd.DataFrame): A DataFrame containing columns:
@@ -42,17 +99,22 @@ def process_era5_data(nc_file):
             - 'Wind Velocity North->South (m/s)'
     """
     # ---Volcano Coordinates
-    VOLCANO = CONFIG["volcano"]  # This is now a Volcano object
-    lat_volcano = VOLCANO.latitude
-    lon_volcano = VOLCANO.longitude
+    volcano = volcano or CONFIG["volcano"]
+    lat_volcano = volcano.latitude
+    lon_volcano = volcano.longitude
 
-    # ---Select variables and downscale every 5 hPa
-    ds = xr.open_dataset(nc_file)
-    ds = ds.sel(latitude=lat_volcano, longitude=lon_volcano, method='nearest')
+    # ---Select variables at the vent column and downscale every 5 hPa
+    ds = open_era5_column(nc_file, lat_volcano, lon_volcano)
 
     downscaled_pressure_levels = np.arange(ds.pressure_level.max(), ds.pressure_level.min(), -5)
     ds_interp = ds.interp(pressure_level=downscaled_pressure_levels)
 
+    return profile_to_dataframe(ds_interp)
+
+def profile_to_dataframe(ds_interp):
+    """
+    Converts a single interpolated ERA5 column into the .met DataFrame (see process_era5_data).
+    """
     pressure_levels = ds_interp.pressure_level.values.flatten()
     temperature = ds_interp.t.values.flatten()
     humidity = ds_interp.q.values.flatten() * 1000              # specific humidity in g/kg
@@ -75,6 +137,34 @@ def process_era5_data(nc_file):
 
     return df
 
+def process_era5_timeseries(era5_file, hours, volcano=None):
+    """
+    Processes an ERA5 file containing several hours (download_era5_window) in one pass:
+    the vent column of all the hours is read and interpolated at once, then split by hour.
+
+    Parameters:
+        era5_file (str or Path): NetCDF or GRIB file with a time dimension.
+        hours (list of datetime): hours to extract.
+        volcano (Volcano, optional): volcano of the campaign (default volcano of config.yaml if None).
+
+    Returns:
+        dict: {pd.Timestamp: pd.DataFrame as returned by process_era5_data}
+    """
+    volcano = volcano or CONFIG["volcano"]
+    ds = open_era5_column(era5_file, volcano.latitude, volcano.longitude)
+
+    time_dim = "valid_time" if "valid_time" in ds.dims else "time"
+    downscaled_pressure_levels = np.arange(ds.pressure_level.max(), ds.pressure_level.min(), -5)
+    ds_interp = ds.interp(pressure_level=downscaled_pressure_levels)
+
+    available = pd.DatetimeIndex(ds_interp[time_dim].values)
+    profiles = {}
+    for hour in pd.DatetimeIndex(hours):
+        if hour not in available:
+            raise ValueError(f"Hour {hour} not found in {era5_file}")
+        profiles[hour] = profile_to_dataframe(ds_interp.sel({time_dim: hour}))
+    return profiles
+
 def save_to_txt(df, output_file):
     """
     Writes the meteorological DataFrame to a .met file in the tabular format required by FPLUME.
@@ -91,6 +181,61 @@ def save_to_txt(df, output_file):
         f.write("#  (km)   (kg/m^3)      (hPa)        (K)          (g/kg)         West->East(m/s)    North->South(m/s)\n")
         df.to_csv(f, sep='\t', index=False, header=False, float_format='%.3f')
 
+def ensure_met_file(event):
+    """
+    Returns the .met file of an event, creating it from the ERA5 file of the event if it
+    does not exist yet (e.g. events run by pipeline.py without --save-met).
+
+    Raises:
+        FileNotFoundError: if neither the .met file nor the ERA5 file exists.
+    """
+    date_prefix = event["date_prefix"]
+    met_file = FPLUME_MET_FILES_DIR / f"{date_prefix}.met"
+    if not met_file.exists():
+        era5_file = find_era5_file(date_prefix)
+        if not era5_file.exists():
+            raise FileNotFoundError(f"Missing .met file and ERA5 file {era5_file.name} for event "
+                                    f"{date_prefix}. Please run download_era5.py")
+        met_file.parent.mkdir(parents=True, exist_ok=True)
+        save_to_txt(process_era5_data(era5_file, event["volcano"]), met_file)
+    return met_file
+
+def process_era5_data_eager(nc_file, volcano=None):
+    """
+    Former processing, decoding the whole file before selecting the vent column.
+    Only used as reference by --benchmark.
+    """
+    volcano = volcano or CONFIG["volcano"]
+    ds = xr.open_dataset(nc_file).load()
+    ds = ds.sel(latitude=volcano.latitude, longitude=volcano.longitude, method='nearest')
+    downscaled_pressure_levels = np.arange(ds.pressure_level.max(), ds.pressure_level.min(), -5)
+    return ds.interp(pressure_level=downscaled_pressure_levels)
+
+def benchmark(events, repeat=3):
+    """
+    Measures file size and parse time of the ERA5 file of each event, eager vs lazy.
+
+    Returns:
+        pd.DataFrame: one row per event.
+    """
+    rows = []
+    for event in events:
+        era5_file = find_era5_file(event['date_prefix'])
+        if not era5_file.exists():
+            continue
+        row = {"date_prefix": event['date_prefix'], "format": era5_file.suffix,
+               "MB": os.path.getsize(era5_file) / 1e6}
+        for label, func in (("eager_s", process_era5_data_eager), ("lazy_s", process_era5_data)):
+            times = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                func(era5_file, event["volcano"])
+                times.append(time.perf_counter() - start)
+            row[label] = min(times)
+        rows.append(row)
+    return pd.DataFrame(rows)
+
+@profiled("create_met_file")
 def main():
     """
     Entry point for command-line usage. Processes a specific or all eruption events,
@@ -100,6 +245,8 @@ def main():
     parser = argparse.ArgumentParser(description="Create .met file from ERA5 data")
     parser.add_argument("--code", type=int, help="Code of the event to process")
     parser.add_argument("--all", action="store_true", help="Process all events")
+    parser.add_argument("--benchmark", action="store_true",
+                        help="Compare file size and parse time with eager decoding")
     args = parser.parse_args()
   
     if args.all:
@@ -109,15 +256,19 @@ def main():
     else:
         raise ValueError("Please specify --code <int>")
 
+    if args.benchmark:
+        print(benchmark(events).to_string(index=False))
+        return
+
     for event in events:
         date_prefix = event['date_prefix']
-        nc_file = f"{ERA5_DIR}/{date_prefix}_pressure_levels.nc"
+        nc_file = find_era5_file(date_prefix)
         output_file = FPLUME_MET_FILES_DIR / f"{date_prefix}.met"
 
         output_file.parent.mkdir(parents=True, exist_ok=True)
 
         print(f"Processing ERA5 file: {nc_file}")
-        df = process_era5_data(nc_file)
+        df = process_era5_data(nc_file, event["volcano"])
         save_to_txt(df, output_file)
         print(f"Saved met file to: {output_file}")
 
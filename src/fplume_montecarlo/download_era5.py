@@ -1,17 +1,28 @@
 """
-Downloads ERA5 reanalysis data (pressure levels) in NetCDF format
+Downloads ERA5 reanalysis data (pressure levels) in NetCDF or GRIB format
 for the volcanic eruption events contained in list_eruptions.txt.
 
-Data is retrieved using the Copernicus Climate Data Store (CDS) API.
+Data is retrieved using the Copernicus Climate Data Store (CDS) API. Only the variables
+used by create_met_file.py are requested (use --all-variables for the full former set).
+The domain is a box of +/- 1 degree around the volcano of each event; events at the same
+hour whose boxes overlap (nearby volcanoes) share a single request over the union of the
+boxes, and the file is copied to the name of each event.
+The size and download time of each file are appended to ERA5_DIR/download_log.csv, to
+compare formats and variable sets.
 
 Usage:
     python fplume_montecarlo.download_era5 --code <n>
     python fplume_montecarlo.download_era5 --all
+    python fplume_montecarlo.download_era5 --all --format grib
+    python fplume_montecarlo.download_era5 --all --profile           # see profiling.py
 """
 # --- Import packages
 import cdsapi
 import os
 import argparse
+import shutil
+import time
+import pandas as pd
 
 # --- Import ERA5 directories, volcanic erupions file, and ERA5 key API file from local
 from fplume_montecarlo.config import PROJ_ROOT, ERUPTIONS_FILE, ERA5_DIR
@@ -30,12 +41,20 @@ key_era5_file = CONFIG["user_paths"]["key_era5_file"]
 with open(os.path.join(key_dir,key_era5_file)) as f:
     CDS_KEY = f.read().strip()
 
-# --- Select variables to download from the pressure level dataset
+# --- Select variables to download from the pressure level dataset (used by create_met_file.py)
 pressure_level_vars = [
+    "geopotential", "specific_humidity", "temperature", "u_component_of_wind", "v_component_of_wind"
+    ]
+
+# --- Former full set of variables (--all-variables)
+all_pressure_level_vars = [
     "geopotential", "potential_vorticity", "relative_humidity", "specific_humidity",
     "temperature", "u_component_of_wind", "v_component_of_wind", "vertical_velocity","divergence"
     ]
 
+# --- File extension of each download format
+FORMAT_SUFFIX = {"netcdf": ".nc", "grib": ".grib"}
+
 # --- Select pressure levels to download
 pressure_levels=["5", "7", "10", "20", "30",
     "50", "70", "100","125", "150", "175",
@@ -45,16 +64,64 @@ pressure_levels=["5", "7", "10", "20", "30",
     "900", "925", "950","975", "1000",
 ]
 # --- Select domain to download  [N W S E]
+def volcano_area(volcano, margin=1.0):
+    """
+    Domain [N W S E] of +/- margin degrees around a volcano.
+    """
+    return [volcano.latitude + margin, volcano.longitude - margin,
+            volcano.latitude - margin, volcano.longitude + margin]
+
 VOLCANO = CONFIG["volcano"]  # This is now a Volcano object
-lat_volcano = VOLCANO.latitude
-lon_volcano = VOLCANO.longitude
+area = volcano_area(VOLCANO)   # reasonable domain for Etna location: lat = 37.75, lon = 15.00
+
+def areas_overlap(a, b):
+    """
+    True if two [N W S E] domains overlap.
+    """
+    return a[2] <= b[0] and b[2] <= a[0] and a[1] <= b[3] and b[1] <= a[3]
 
-area = [lat_volcano +1, lon_volcano -1, lat_volcano-1, lon_volcano + 1]   # reasonable domain for Etna location: lat = 37.75, lon = 15.00
+def group_requests(events):
+    """
+    Groups the events at the same hour whose domains overlap, so that they share one request.
 
+    Returns:
+        list[tuple]: (union domain [N W S E], list of events) for each request.
+    """
+    groups = []
+    for event in events:
+        event_area = volcano_area(event["volcano"])
+        hour = (event["year"], event["month"], event["day"], event["hour"])
+        for group in groups:
+            if group["hour"] == hour and areas_overlap(group["area"], event_area):
+                a = group["area"]
+                group["area"] = [max(a[0], event_area[0]), min(a[1], event_area[1]),
+                                 min(a[2], event_area[2]), max(a[3], event_area[3])]
+                group["events"].append(event)
+                break
+        else:
+            groups.append({"hour": hour, "area": event_area, "events": [event]})
+    return [(group["area"], group["events"]) for group in groups]
 
-def download_era5_pressure_levels(year, month, day, hour, pressure_level_vars, pressure_levels, CDS_URL, CDS_KEY):
+def download_events(events, pressure_level_vars, pressure_levels, CDS_URL, CDS_KEY, data_format="netcdf"):
     """
-    Download ERA5 pressure-level data for Etna's eruptions events (from list).
+    Downloads the ERA5 pressure-level data of a list of events (possibly of different volcanoes),
+    with one request per group of events sharing the hour and an overlapping domain.
+    """
+    for request_area, group in group_requests(events):
+        first = group[0]
+        filename = download_era5_pressure_levels(
+            first["year"], first["month"], first["day"], first["hour"], pressure_level_vars, pressure_levels,
+            CDS_URL, CDS_KEY, data_format=data_format, area=request_area, date_prefix=first["date_prefix"]
+        )
+        for event in group[1:]:
+            shared = f"{ERA5_DIR}/{event['date_prefix']}_pressure_levels{FORMAT_SUFFIX[data_format]}"
+            shutil.copy(filename, shared)
+            print(f"Shared {filename} with {event['date_prefix']}")
+
+def download_era5_pressure_levels(year, month, day, hour, pressure_level_vars, pressure_levels, CDS_URL, CDS_KEY,
+                                  data_format="netcdf", area=area, date_prefix=None):
+    """
+    Download ERA5 pressure-level data for eruptions events (from list).
     The downloaded NetCDF file is saved locally in the ERA5_DIR directory with a filename based on the date.
 
     Parameters:
@@ -66,12 +133,14 @@ def download_era5_pressure_levels(year, month, day, hour, pressure_level_vars, p
         pressure_levels (list of str): pressure levels (in hPa) to include in the dataset;
         CDS_URL (str): URL for the Copernicus Climate Data Store API;
         CDS_KEY (str): API key for authenticating with the CDS.
+        data_format (str): "netcdf" (compressed NetCDF4) or "grib".
+        area (list): domain [N W S E], by default around the volcano of config.yaml;
+        date_prefix (str, optional): prefix of the file (date_prefix of the event), by default
+            {year}_{month}_{day}_{hour}.
 
     Returns:
-        None. Saves the data to a NetCDF file in ERA5_DIR.
+        str: the downloaded file, saved in ERA5_DIR.
     """
-    c = cdsapi.Client(url=CDS_URL, key=CDS_KEY)
-
     # ---Download pressure-level data
     if pressure_level_vars and pressure_levels:
         request_params_pressure = {
@@ -82,40 +151,109 @@ def download_era5_pressure_levels(year, month, day, hour, pressure_level_vars, p
             "day": [int(day)],
             "time": [f"{int(hour):02d}:00"],
             "pressure_level": pressure_levels,
-            "data_format": "netcdf",
+            "data_format": data_format,
             "download_format": "unarchived",
             "area": area
         }
-        date_prefix = f"{year}_{month}_{day}_{hour}"
-        filename_pressure = f"{ERA5_DIR}/{date_prefix}_pressure_levels.nc"
+        date_prefix = date_prefix or f"{year}_{month}_{day}_{hour}"
+        filename_pressure = f"{ERA5_DIR}/{date_prefix}_pressure_levels{FORMAT_SUFFIX[data_format]}"
+        retrieve_pressure_levels(request_params_pressure, filename_pressure, date_prefix, CDS_URL, CDS_KEY)
+        return filename_pressure
+
+def download_era5_window(start, end, pressure_level_vars, pressure_levels, CDS_URL, CDS_KEY,
+                         data_format="netcdf", filename=None, area=area):
+    """
+    Download ERA5 pressure-level data for all the hours of a time window with a single request
+    (time-series campaigns, see timeseries_montecarlo.py).
+
+    The CDS request is the product of the requested years, months, days and times, so for
+    windows spanning several days it may contain a few hours outside the window, which are
+    ignored by create_met_file.py.
+
+    Parameters:
+        start (datetime): first hour of the window;
+        end (datetime): last hour of the window (included);
+        filename (str, optional): output file, by default
+            ERA5_DIR/{start}_{end}_pressure_levels.nc (or .grib);
+        area (list): domain [N W S E], by default around the volcano of config.yaml;
+        other parameters as in download_era5_pressure_levels.
+
+    Returns:
+        str: the downloaded file.
+    """
+    hours = pd.date_range(start, end, freq="h")
+    request_params_pressure = {
+        "product_type": ["reanalysis"],
+        "variable": pressure_level_vars,
+        "year": sorted({h.year for h in hours}),
+        "month": sorted({h.month for h in hours}),
+        "day": sorted({h.day for h in hours}),
+        "time": sorted({f"{h.hour:02d}:00" for h in hours}),
+        "pressure_level": pressure_levels,
+        "data_format": data_format,
+        "download_format": "unarchived",
+        "area": area
+    }
+    window_prefix = f"{hours[0]:%Y_%m_%d_%H}_{hours[-1]:%Y_%m_%d_%H}"
+    if filename is None:
+        filename = f"{ERA5_DIR}/{window_prefix}_pressure_levels{FORMAT_SUFFIX[data_format]}"
+    retrieve_pressure_levels(request_params_pressure, filename, window_prefix, CDS_URL, CDS_KEY)
+    return filename
+
+def retrieve_pressure_levels(request_params_pressure, filename_pressure, date_prefix, CDS_URL, CDS_KEY):
+    """
+    Submits a request to the ERA5 pressure-levels dataset and downloads the result.
+    """
+    c = cdsapi.Client(url=CDS_URL, key=CDS_KEY)
+
+    print(f"Starting download of pressure level data for {filename_pressure}")
 
-        print(f"Starting download of pressure level data for {filename_pressure}")
-        
-        response = c.retrieve('reanalysis-era5-pressure-levels', request_params_pressure)
-        download_url = response.location
+    start = time.perf_counter()
+    response = c.retrieve('reanalysis-era5-pressure-levels', request_params_pressure)
+    download_url = response.location
 
-        # ---Show progress bar while downloading
-        progress_bar(download_url, filename_pressure)
-        print(f"Pressure level data saved as {filename_pressure}")
+    # ---Show progress bar while downloading
+    progress_bar(download_url, filename_pressure)
+    elapsed = time.perf_counter() - start
+    print(f"Pressure level data saved as {filename_pressure}")
+
+    log_download(date_prefix, request_params_pressure["data_format"],
+                 len(request_params_pressure["variable"]), filename_pressure, elapsed)
+
+def log_download(date_prefix, data_format, n_variables, filename, elapsed):
+    """
+    Appends the size and the download time (request + transfer) of an ERA5 file
+    to ERA5_DIR/download_log.csv.
+    """
+    log_file = os.path.join(ERA5_DIR, "download_log.csv")
+    size = os.path.getsize(filename)
+    write_header = not os.path.exists(log_file)
+    with open(log_file, "a") as f:
+        if write_header:
+            f.write("date_prefix,format,n_variables,bytes,seconds\n")
+        f.write(f"{date_prefix},{data_format},{n_variables},{size},{elapsed:.1f}\n")
+    print(f"Downloaded {size / 1e6:.2f} MB in {elapsed:.1f} s")
 
 # ---Main execution loop
 if __name__ == "__main__":
+    from fplume_montecarlo.profiling import profile_script
 
+    profile_script("download_era5")
     parser = argparse.ArgumentParser(description="Download ERA5 pressure level data for eruption events.")
     parser.add_argument("--code", type=int, help="Event code to download (from eruption file)")
     parser.add_argument("--all", action="store_true", help="Download all events")
+    parser.add_argument("--format", choices=list(FORMAT_SUFFIX), default="netcdf", help="Download format")
+    parser.add_argument("--all-variables", action="store_true",
+                        help="Download the former full set of variables (for comparison)")
     args = parser.parse_args()
 
+    variables = all_pressure_level_vars if args.all_variables else pressure_level_vars
+
     if args.all:
         events = load_events(ERUPTIONS_FILE)
-        for event in events:
-            download_era5_pressure_levels(
-                event["year"], event["month"], event["day"], event["hour"], pressure_level_vars, pressure_levels, CDS_URL, CDS_KEY
-                )
     elif args.code is not None:
-        event = load_events(ERUPTIONS_FILE, code=args.code)
-        download_era5_pressure_levels(
-            event["year"], event["month"], event["day"], event["hour"], pressure_level_vars, pressure_levels, CDS_URL, CDS_KEY
-            )
+        events = [load_events(ERUPTIONS_FILE, code=args.code)]
     else:
-        raise ValueError("Please specify either --code <int> or --all.")
\ No newline at end of file
+        raise ValueError("Please specify either --code <int> or --all.")
+
+    download_events(events, variables, pressure_levels, CDS_URL, CDS_KEY, data_format=args.format)
\ No newline at end of file
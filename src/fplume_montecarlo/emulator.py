@@ -0,0 +1,322 @@
+"""
+Cross-event emulator of the FPLUME column height, trained on all the stored Monte Carlo
+ensembles, to give an immediate approximate height distribution for a new event before
+any FPLUME run.
+
+Inputs of the emulator are the six sampled parameters (log10 MER) and compact features of
+the .met profile of the event:
+    - wind_vent: wind speed at the vent (m/s);
+    - wind_mean: mean wind speed in the 10 km above the vent (m/s);
+    - wind_shear: bulk wind shear between the vent and 8 km above it (1/s);
+    - n2: mean squared Brunt-Väisälä frequency between the vent and the tropopause (1/s²);
+    - humidity: mean specific humidity in the 5 km above the vent (g/kg);
+    - tropopause: lapse-rate tropopause height (km a.s.l.).
+The log of the column height above the vent is fitted with ridge regression on the
+standardized inputs, including the products of log10 MER with the met features. The
+residuals of the fit give the spread added to the predictions.
+
+A new event is flagged as out of distribution when the Mahalanobis distance of its
+conditions (log10 MER, exit velocity and met features) from the training events exceeds the
+ood_quantile of the chi-squared distribution (emulator in config.yaml): full Monte Carlo
+should then be run instead.
+
+The model is saved in PROCESSED_DATA_DIR/emulator.npz and the predicted distributions in
+COLUMN_FILES_DIR/emulator/{date_prefix}.column
+
+Usage:
+    python fplume_montecarlo.emulator --train                  # train on all the stored events
+    python fplume_montecarlo.emulator --code <n> --n 10000     # predict the distribution
+"""
+
+# ---Import packages
+import argparse
+
+import numpy as np
+import pandas as pd
+from scipy.stats import chi2
+
+# ---Import directories and utilities
+from fplume_montecarlo.config import (
+    COLUMN_FILES_DIR,
+    ERUPTIONS_FILE,
+    PROCESSED_DATA_DIR,
+    PROJ_ROOT,
+)
+from fplume_montecarlo.plume_model import G, event_met_profile, sample_batch
+from fplume_montecarlo.utilities import (
+    load_column_file,
+    load_config,
+    load_events,
+    load_samples_file,
+)
+
+CONFIG = load_config(PROJ_ROOT / "config.yaml")
+
+# ---Emulator model and predictions
+EMULATOR_FILE = PROCESSED_DATA_DIR / "emulator.npz"
+EMULATOR_DIR = COLUMN_FILES_DIR / "emulator"
+
+PARAMETERS = list(CONFIG["parameters_montecarlo"])
+MET_FEATURES = ["wind_vent", "wind_mean", "wind_shear", "n2", "humidity", "tropopause"]
+
+def layer_mean(z, values, bottom, top):
+    """
+    Height-weighted mean of a profile between two altitudes (m).
+    """
+    grid = np.linspace(bottom, top, 101)
+    return np.interp(grid, z, values).mean()
+
+def met_features(met, vent_height):
+    """
+    Compact features of a .met profile (see module docstring).
+
+    Parameters:
+        met (dict): profile as returned by plume_model.load_met_profile.
+        vent_height (float): vent height (m a.s.l.).
+
+    Returns:
+        dict: {feature: value}
+    """
+    z, T = met["z"], met["T"]
+
+    # ---Lapse-rate tropopause: lowest level above 5 km where the lapse rate stays below 2 K/km
+    lapse = -np.gradient(T, z) * 1000
+    tropopause = z[-1]
+    for k in np.flatnonzero(z > 5000):
+        above = (z >= z[k]) & (z <= z[k] + 2000)
+        if np.mean(lapse[above]) < 2:
+            tropopause = z[k]
+            break
+
+    # ---Static stability from the potential temperature
+    theta = T * (1e5 / met["p"]) ** 0.286
+    n2 = G * np.gradient(np.log(theta), z)
+    top = max(tropopause, vent_height + 1000)
+
+    wind_at_vent = np.interp(vent_height, z, met["wind"])
+    return {
+        "wind_vent": wind_at_vent,
+        "wind_mean": layer_mean(z, met["wind"], vent_height, vent_height + 10000),
+        "wind_shear": (np.interp(vent_height + 8000, z, met["wind"]) - wind_at_vent) / 8000,
+        "n2": layer_mean(z, n2, vent_height, top),
+        "humidity": layer_mean(z, met["q"], vent_height, vent_height + 5000) * 1000,
+        "tropopause": tropopause / 1000,
+    }
+
+def event_features(event):
+    """
+    Met features of an event from its .met file (created from the ERA5 file if missing).
+    """
+    return met_features(event_met_profile(event), event["volcano"].height)
+
+def design_matrix(samples, features):
+    """
+    Builds the inputs of the regression: sampled parameters (log10 MER), met features and
+    products of log10 MER with the met features.
+
+    Parameters:
+        samples (pd.DataFrame): sampled parameters, one row per run.
+        features (dict): met features of the event.
+
+    Returns:
+        np.ndarray: shape (runs, inputs).
+    """
+    X = samples[PARAMETERS].to_numpy(dtype=float).copy()
+    X[:, 0] = np.log10(X[:, 0])
+    met = np.broadcast_to([features[f] for f in MET_FEATURES], (len(X), len(MET_FEATURES)))
+    return np.hstack([X, met, X[:, :1] * met])
+
+def event_conditions(event, features):
+    """
+    Event-level conditions used for the out-of-distribution check.
+    """
+    return np.array([np.log10(event["mer"]), event["exit_v"]] + [features[f] for f in MET_FEATURES])
+
+def load_training_data(events):
+    """
+    Loads the stored runs of each event with their met features, using at most
+    max_samples_per_event runs per event so that all the events have similar weight.
+
+    Returns:
+        list[dict]: one entry per event with keys "event", "X", "y" (log of the column
+        height above the vent) and "conditions".
+    """
+    rng = np.random.default_rng(0)
+    max_samples = CONFIG["emulator"]["max_samples_per_event"]
+    data = []
+    for event in events:
+        date_prefix = event["date_prefix"]
+        column_file = COLUMN_FILES_DIR / f"{date_prefix}.column"
+        samples_file = COLUMN_FILES_DIR / f"{date_prefix}.samples"
+        if not (column_file.exists() and samples_file.exists()):
+            print(f"Skipped {date_prefix}: missing .column or .samples file")
+            continue
+        try:
+            features = met_features(event_met_profile(event), event["volcano"].height)
+        except FileNotFoundError as e:
+            print(f"Skipped {date_prefix}: {e}")
+            continue
+
+        heights = load_column_file(column_file)
+        samples = load_samples_file(samples_file)
+        n = min(len(heights), len(samples))
+        heights, samples = heights[:n], samples.iloc[:n]
+        valid = np.flatnonzero(heights > 0)
+        if len(valid) > max_samples:
+            valid = rng.choice(valid, max_samples, replace=False)
+
+        data.append({
+            "event": event,
+            "X": design_matrix(samples.iloc[valid], features),
+            "y": np.log(heights[valid]),
+            "conditions": event_conditions(event, features),
+        })
+    return data
+
+def fit_ridge(X, y, alpha):
+    """
+    Ridge regression on standardized inputs.
+
+    Returns:
+        dict: "mean", "scale", "beta", "intercept".
+    """
+    mean, scale = X.mean(axis=0), X.std(axis=0)
+    scale[scale == 0] = 1.0
+    Z = (X - mean) / scale
+    intercept = y.mean()
+    beta = np.linalg.solve(Z.T @ Z + alpha * np.eye(Z.shape[1]), Z.T @ (y - intercept))
+    return {"mean": mean, "scale": scale, "beta": beta, "intercept": intercept}
+
+def predict_log_height(model, X):
+    """
+    Mean log column height (above the vent) predicted by the ridge regression.
+    """
+    return model["intercept"] + ((X - model["mean"]) / model["scale"]) @ model["beta"]
+
+def train(events):
+    """
+    Trains the emulator on the stored ensembles, with a leave-one-event-out validation,
+    and saves it to EMULATOR_FILE.
+
+    Returns:
+        pd.DataFrame: leave-one-event-out errors of each event.
+    """
+    settings = CONFIG["emulator"]
+    data = load_training_data(events)
+    if len(data) < 3:
+        raise ValueError("At least 3 events with stored runs are needed to train the emulator")
+
+    # ---Leave-one-event-out validation of the predicted distribution
+    rows = []
+    for k, test in enumerate(data):
+        others = [d for j, d in enumerate(data) if j != k]
+        model = fit_ridge(np.vstack([d["X"] for d in others]),
+                          np.concatenate([d["y"] for d in others]), settings["ridge_alpha"])
+        residuals = np.concatenate([d["y"] - predict_log_height(model, d["X"]) for d in others])
+        predicted = np.exp(predict_log_height(model, test["X"]) +
+                           np.random.default_rng(k).choice(residuals, len(test["y"])))
+        observed = np.exp(test["y"])
+        rows.append({
+            "code": test["event"]["code"],
+            "date_prefix": test["event"]["date_prefix"],
+            "n": len(observed),
+            "rmse": np.sqrt(np.mean((np.exp(predict_log_height(model, test["X"])) - observed) ** 2)),
+            "p50_error": np.median(predicted) - np.median(observed),
+            "p5_error": np.percentile(predicted, 5) - np.percentile(observed, 5),
+            "p95_error": np.percentile(predicted, 95) - np.percentile(observed, 95),
+        })
+
+    # ---Final model on all the events
+    X = np.vstack([d["X"] for d in data])
+    y = np.concatenate([d["y"] for d in data])
+    model = fit_ridge(X, y, settings["ridge_alpha"])
+    residuals = y - predict_log_height(model, X)
+
+    # ---Distribution of the training conditions (shrunk covariance, few events)
+    conditions = np.array([d["conditions"] for d in data])
+    ood_mean = conditions.mean(axis=0)
+    cov = np.cov(conditions, rowvar=False)
+    cov = cov + settings["covariance_shrinkage"] * np.diag(np.diag(cov)) + 1e-12 * np.eye(len(ood_mean))
+
+    np.savez(
+        EMULATOR_FILE,
+        parameters=np.array(PARAMETERS),
+        met_features=np.array(MET_FEATURES),
+        events=np.array([d["event"]["date_prefix"] for d in data]),
+        residual_quantiles=np.quantile(residuals, np.linspace(0, 1, 201)),
+        ood_mean=ood_mean,
+        ood_inv_cov=np.linalg.inv(cov),
+        ood_threshold=chi2.ppf(settings["ood_quantile"], len(ood_mean)),
+        **model,
+    )
+    print(f"Trained emulator on {len(data)} events ({len(y)} runs), "
+          f"residual std (log height): {residuals.std():.3f}")
+    print(f"Saved emulator to: {EMULATOR_FILE}")
+    return pd.DataFrame(rows)
+
+def load_emulator():
+    """
+    Loads the emulator saved by train().
+    """
+    if not EMULATOR_FILE.exists():
+        raise FileNotFoundError(f"{EMULATOR_FILE} not found. Please run emulator --train")
+    with np.load(EMULATOR_FILE) as f:
+        return {key: f[key] for key in f.files}
+
+def predict(event, n, emulator=None):
+    """
+    Approximate column height distribution of an event from the emulator.
+
+    Returns:
+        tuple: (np.ndarray of n column heights above the vent (m), Mahalanobis distance of
+        the event from the training events, True if the event is out of distribution)
+    """
+    emulator = emulator or load_emulator()
+    features = event_features(event)
+
+    samples = sample_batch(event, n)
+    residuals = np.interp(np.random.random(n), np.linspace(0, 1, 201), emulator["residual_quantiles"])
+    heights = np.exp(predict_log_height(emulator, design_matrix(samples, features)) + residuals)
+
+    diff = event_conditions(event, features) - emulator["ood_mean"]
+    distance = float(np.sqrt(diff @ emulator["ood_inv_cov"] @ diff))
+    return heights, distance, distance ** 2 > emulator["ood_threshold"]
+
+def main():
+    """
+    Parses command-line arguments, trains the emulator or predicts the selected events.
+    """
+    parser = argparse.ArgumentParser(description="Cross-event emulator of the column height")
+    parser.add_argument("--code", type=int, help="Process only one event by code")
+    parser.add_argument("--all", action="store_true", help="Process all events")
+    parser.add_argument("--train", action="store_true", help="Train the emulator on all the stored events")
+    parser.add_argument("--n", type=int, default=CONFIG["n_montecarlo"], help="Number of emulated samples")
+    args = parser.parse_args()
+
+    if args.train:
+        validation = train(load_events(ERUPTIONS_FILE, code=None))
+        print("Leave-one-event-out validation (m):")
+        print(validation.to_string(index=False, float_format="%.0f"))
+        return
+
+    if args.all:
+        events = load_events(ERUPTIONS_FILE, code=None)
+    elif args.code:
+        events = [load_events(ERUPTIONS_FILE, code=args.code)]
+    else:
+        raise ValueError("Please specify --train, --code <int> or --all")
+
+    emulator = load_emulator()
+    EMULATOR_DIR.mkdir(parents=True, exist_ok=True)
+    for event in events:
+        date_prefix = event["date_prefix"]
+        heights, distance, ood = predict(event, args.n, emulator)
+        np.savetxt(EMULATOR_DIR / f"{date_prefix}.column", heights, fmt="%.1f")
+
+        q5, q50, q95 = np.percentile(heights + event["volcano"].height, [5, 50, 95])
+        flag = "OUT OF DISTRIBUTION: run full Monte Carlo" if ood else "in distribution"
+        print(f"{date_prefix}: median {q50:.0f} m a.s.l. [{q5:.0f} – {q95:.0f}], "
+              f"radar {event['h']} m, Mahalanobis distance {distance:.2f} ({flag})")
+
+if __name__ == "__main__":
+    main()
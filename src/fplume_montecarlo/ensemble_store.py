@@ -0,0 +1,340 @@
+"""
+Bounded-memory storage and statistics of the Monte Carlo ensembles, for very large numbers
+of runs per event.
+
+The column heights of an event (and the importance sampling weights) are stored as .npy
+arrays next to the .column and .samples files:
+    - {date_prefix}.heights.npy: column height of every run (m above the vent), NaN for
+      runs without a result
+    - {date_prefix}.weights.npy: likelihood-ratio weight of every run (importance sampling)
+The arrays are preallocated for all the runs of the event and filled through a memory map
+(EnsembleWriter): run_montecarlo buffers the heights and flushes them every chunk_size runs,
+the worker threads of the scheduler write the slice of their chunk directly. The .column
+file (valid heights only) is exported from the array when the event is complete.
+
+Statistics are computed from the memory-mapped arrays chunk by chunk (aggregation in
+config.yaml), never loading a whole ensemble:
+    - ECDF at given thresholds: one pass;
+    - percentiles: one pass for the range, one histogram pass locating the bins of the
+      requested percentiles, and one pass collecting the values of those bins only. The
+      result is np.percentile, or weighted_percentile for weighted ensembles, up to
+      floating-point rounding;
+    - confidence intervals (ensemble_ci): bootstrap_ci for ensembles up to
+      max_bootstrap_samples runs, otherwise the binomial limit of the bootstrap (the
+      bootstrap ECDF at a threshold is Binomial(n, p) / n, with n the effective sample
+      size of weighted ensembles).
+Ensembles only stored as .column/.samples text files (former runs) are converted once.
+
+Used by run_montecarlo.py, scheduler.py, timeseries_montecarlo.py, bootstrap_montecarlo.py,
+plot_montecarlo.py and qqplot_montecarlo.py.
+"""
+
+# ---Import packages
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from scipy.stats import binom
+
+# ---Import directories and utilities
+from fplume_montecarlo.config import PROJ_ROOT
+from fplume_montecarlo.utilities import load_config, merge_ties, midpoint_percentile
+
+CONFIG = load_config(PROJ_ROOT / "config.yaml")
+
+def ensemble_paths(directory, date_prefix):
+    """
+    Paths of the heights and weights arrays of an event.
+    """
+    directory = Path(directory)
+    return directory / f"{date_prefix}.heights.npy", directory / f"{date_prefix}.weights.npy"
+
+class EnsembleWriter:
+    """
+    Preallocated memory-mapped arrays of the heights (and weights) of the n runs of an event.
+    """
+
+    def __init__(self, directory, date_prefix, n, weighted=False, chunk_size=None):
+        self.chunk_size = chunk_size or CONFIG["aggregation"]["chunk_size"]
+        heights_file, weights_file = ensemble_paths(directory, date_prefix)
+        heights_file.parent.mkdir(parents=True, exist_ok=True)
+        weights_file.unlink(missing_ok=True)
+
+        self.heights = np.lib.format.open_memmap(heights_file, mode="w+", dtype=np.float64, shape=(n,))
+        self.weights = None
+        if weighted:
+            self.weights = np.lib.format.open_memmap(weights_file, mode="w+", dtype=np.float64, shape=(n,))
+        for start in range(0, n, self.chunk_size):
+            self.heights[start:start + self.chunk_size] = np.nan
+            if weighted:
+                self.weights[start:start + self.chunk_size] = 0.0
+
+        # ---Buffer of append()
+        self.buffer = np.full(self.chunk_size, np.nan)
+        self.buffer_weights = np.zeros(self.chunk_size)
+        self.n_buffered = 0
+        self.position = 0
+
+    def write(self, start, heights, weights=None):
+        """
+        Writes the results of a chunk of runs at position start (NaN heights for failed runs).
+        """
+        self.heights[start:start + len(heights)] = heights
+        if self.weights is not None and weights is not None:
+            self.weights[start:start + len(weights)] = weights
+
+    def append(self, height, weight=1.0):
+        """
+        Appends the result of the next run (height None for a failed run).
+        """
+        self.buffer[self.n_buffered] = np.nan if height is None else float(height)
+        self.buffer_weights[self.n_buffered] = weight
+        self.n_buffered += 1
+        if self.n_buffered == self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes the buffered runs to the memory map and flushes it to disk.
+        """
+        if self.n_buffered:
+            self.write(self.position, self.buffer[:self.n_buffered], self.buffer_weights[:self.n_buffered])
+            self.position += self.n_buffered
+            self.n_buffered = 0
+        self.heights.flush()
+        if self.weights is not None:
+            self.weights.flush()
+
+    def close(self):
+        self.flush()
+        del self.heights, self.weights
+
+def export_column_file(directory, date_prefix, column_file, chunk_size=None):
+    """
+    Writes the valid heights of an ensemble to a .column file, chunk by chunk.
+    """
+    chunk_size = chunk_size or CONFIG["aggregation"]["chunk_size"]
+    heights_file, _ = ensemble_paths(directory, date_prefix)
+    heights = np.load(heights_file, mmap_mode="r")
+    with open(column_file, "w") as f:
+        for start in range(0, len(heights), chunk_size):
+            chunk = np.asarray(heights[start:start + chunk_size])
+            np.savetxt(f, chunk[~np.isnan(chunk)], fmt="%.10g")
+
+def convert_column_file(directory, date_prefix, chunk_size=None):
+    """
+    Converts the .column (and weights of the .samples) text files of an event into .npy
+    arrays, parsing them chunk by chunk.
+    """
+    chunk_size = chunk_size or CONFIG["aggregation"]["chunk_size"]
+    directory = Path(directory)
+    column_file = directory / f"{date_prefix}.column"
+    samples_file = directory / f"{date_prefix}.samples"
+    with open(column_file, "r") as f:
+        n = sum(len(line.split()) for line in f)
+
+    weighted = False
+    if samples_file.exists():
+        weighted = "weight" in pd.read_csv(samples_file, sep="\t", nrows=0).columns
+    writer = EnsembleWriter(directory, date_prefix, n, weighted=weighted, chunk_size=chunk_size)
+
+    start = 0
+    with open(column_file, "r") as f:
+        while start < n:
+            lines = [line for _, line in zip(range(chunk_size), f)]
+            chunk = np.array([float(v) for line in lines for v in line.split()])
+            writer.write(start, chunk)
+            start += len(chunk)
+    if weighted:
+        start = 0
+        for chunk in pd.read_csv(samples_file, sep="\t", usecols=["weight"], chunksize=chunk_size):
+            w = chunk["weight"].to_numpy(dtype=float)[:n - start]
+            writer.weights[start:start + len(w)] = w
+            start += len(w)
+    writer.close()
+
+def open_ensemble(directory, date_prefix):
+    """
+    Opens the heights (and weights) arrays of an event as read-only memory maps, converting
+    the .column file first if the arrays do not exist.
+
+    Returns:
+        tuple: (heights memmap, weights memmap or None)
+    """
+    heights_file, weights_file = ensemble_paths(directory, date_prefix)
+    if not heights_file.exists():
+        if not (Path(directory) / f"{date_prefix}.column").exists():
+            raise FileNotFoundError(f"No results for event {date_prefix} in {directory}")
+        convert_column_file(directory, date_prefix)
+    heights = np.load(heights_file, mmap_mode="r")
+    weights = np.load(weights_file, mmap_mode="r") if weights_file.exists() else None
+    return heights, weights
+
+def iter_chunks(ensemble, chunk_size=None):
+    """
+    Yields (heights, weights) of the valid runs of an ensemble, chunk by chunk.
+    """
+    chunk_size = chunk_size or CONFIG["aggregation"]["chunk_size"]
+    heights, weights = ensemble
+    for start in range(0, len(heights), chunk_size):
+        h = np.asarray(heights[start:start + chunk_size])
+        w = np.asarray(weights[start:start + chunk_size]) if weights is not None else np.ones(len(h))
+        valid = ~np.isnan(h)
+        yield h[valid], w[valid]
+
+def ensemble_size(ensemble):
+    """
+    Number of valid runs and Kish effective sample size of an ensemble.
+
+    Returns:
+        tuple: (n, ess)
+    """
+    n, sw, sw2 = 0, 0.0, 0.0
+    for _, w in iter_chunks(ensemble):
+        n += len(w)
+        sw += w.sum()
+        sw2 += np.sum(w ** 2)
+    return n, (sw ** 2 / sw2 if sw2 > 0 else 0.0)
+
+def ensemble_ecdf(ensemble, thresholds):
+    """
+    (Weighted) ECDF of an ensemble at the given thresholds, in one pass.
+
+    Returns:
+        np.ndarray: fraction of the runs below or at each threshold.
+    """
+    thresholds = np.atleast_1d(np.asarray(thresholds, dtype=float))
+    below = np.zeros(len(thresholds))
+    total = 0.0
+    for h, w in iter_chunks(ensemble):
+        below += (w[None, :] * (h[None, :] <= thresholds[:, None])).sum(axis=1)
+        total += w.sum()
+    return below / total
+
+def bin_index(h, lo, hi, bins):
+    """
+    Histogram bin of each value in [lo, hi].
+    """
+    if hi <= lo:
+        return np.zeros(len(h), dtype=np.int64)
+    return np.clip(((h - lo) / (hi - lo) * bins).astype(np.int64), 0, bins - 1)
+
+def ensemble_percentiles(ensemble, q, bins=None):
+    """
+    Percentiles q (0-100) of an ensemble in bounded memory: np.percentile for plain Monte
+    Carlo, weighted_percentile for weighted ensembles (the same midpoint CDF, with the
+    weights of tied values merged), up to floating-point rounding.
+
+    Returns:
+        np.ndarray: one value per percentile.
+    """
+    bins = bins or CONFIG["aggregation"]["bins"]
+    q = np.atleast_1d(np.asarray(q, dtype=float))
+    weighted = ensemble[1] is not None
+
+    # ---Range of the values
+    lo, hi, n = np.inf, -np.inf, 0
+    for h, _ in iter_chunks(ensemble):
+        if len(h):
+            lo, hi, n = min(lo, h.min()), max(hi, h.max()), n + len(h)
+    if n == 0:
+        return np.full(len(q), np.nan)
+
+    # ---Histogram of counts (plain) or weights (weighted)
+    hist = np.zeros(bins)
+    for h, w in iter_chunks(ensemble):
+        hist += np.bincount(bin_index(h, lo, hi, bins), weights=w if weighted else None, minlength=bins)
+    below_bin = np.concatenate([[0.0], np.cumsum(hist)[:-1]])
+
+    # ---Bins containing the percentiles, and the closest non-empty bins on each side
+    if weighted:
+        targets = q / 100 * hist.sum()
+    else:
+        rank = q / 100 * (n - 1)
+        targets = np.concatenate([np.floor(rank), np.ceil(rank)])
+    target_bins = np.clip(np.searchsorted(np.cumsum(hist), targets, side="right"), 0, bins - 1)
+    nonempty = np.flatnonzero(hist > 0)
+    k = np.searchsorted(nonempty, target_bins)
+    selected = np.zeros(bins, dtype=bool)
+    selected[nonempty[np.clip(k - 1, 0, len(nonempty) - 1)]] = True
+    selected[nonempty[np.clip(k, 0, len(nonempty) - 1)]] = True
+    selected[nonempty[np.clip(k + 1, 0, len(nonempty) - 1)]] = True
+
+    # ---Values of the selected bins, with their position in the whole sorted ensemble
+    values, weights = [], []
+    for h, w in iter_chunks(ensemble):
+        keep = selected[bin_index(h, lo, hi, bins)]
+        values.append(h[keep])
+        weights.append(w[keep])
+    values, weights = np.concatenate(values), np.concatenate(weights)
+    order = np.argsort(values, kind="stable")
+    if weighted:
+        values, weights = merge_ties(values[order], weights[order])
+    else:
+        values, weights = values[order], np.ones(len(order))
+    value_bins = bin_index(values, lo, hi, bins)
+    cum = np.cumsum(weights)
+    first = np.searchsorted(value_bins, value_bins, side="left")
+    below = below_bin[value_bins] - (cum[first] - weights[first])
+
+    if weighted:
+        return midpoint_percentile(values, weights, q, below=below, total=hist.sum())
+    return np.interp(rank, below + cum - weights, values)
+
+def binomial_ci(n, p, level):
+    """
+    Binomial limit of the bootstrap confidence interval of a proportion p estimated from n runs.
+
+    Returns:
+        tuple: (low, high) proportions.
+    """
+    alpha = (1 - level) / 2
+    n = max(round(n), 1)
+    return binom.ppf(alpha, n, p) / n, binom.ppf(1 - alpha, n, p) / n
+
+def ensemble_ci(ensembles, radar_values, n_boot=1000, level=0.95, radar_sigma=300, seed=None):
+    """
+    Confidence intervals of the box statistics and of the ECDF at the radar height
+    (h - radar_sigma, h, h + radar_sigma), as bootstrap_ci, from the stored ensembles.
+    Ensembles up to max_bootstrap_samples valid runs are loaded and resampled by
+    bootstrap_ci; larger ones use the binomial limit of the bootstrap in bounded memory.
+
+    Parameters:
+        ensembles (list of tuple): (heights, weights) as returned by open_ensemble.
+        radar_values (array-like): radar column height of each event, above the vent.
+
+    Returns:
+        dict: "box_low", "box_high" of shape (E, 5) and "ecdf_low", "ecdf_high" of shape (E, 3).
+    """
+    from fplume_montecarlo.bootstrap_montecarlo import BOX_PERCENTILES, bootstrap_ci
+
+    E = len(ensembles)
+    radar_values = np.asarray(radar_values, dtype=float)
+    offsets = np.array([-radar_sigma, 0, radar_sigma])
+    ci = {"box_low": np.empty((E, len(BOX_PERCENTILES))), "box_high": np.empty((E, len(BOX_PERCENTILES))),
+          "ecdf_low": np.empty((E, 3)), "ecdf_high": np.empty((E, 3))}
+
+    small, large = [], []
+    for e, ensemble in enumerate(ensembles):
+        n, ess = ensemble_size(ensemble)
+        (small if n <= CONFIG["aggregation"]["max_bootstrap_samples"] else large).append((e, ess))
+
+    if small:
+        values, weights = [], []
+        for e, _ in small:
+            h, w = (np.concatenate(part) for part in zip(*iter_chunks(ensembles[e])))
+            values.append(h)
+            weights.append(w if ensembles[e][1] is not None else None)
+        boot = bootstrap_ci(values, radar_values[[e for e, _ in small]], weights=weights,
+                            n_boot=n_boot, level=level, radar_sigma=radar_sigma, seed=seed)
+        for key, bounds in ci.items():
+            bounds[[e for e, _ in small]] = boot[key]
+
+    for e, ess in large:
+        ecdf = ensemble_ecdf(ensembles[e], radar_values[e] + offsets)
+        ci["ecdf_low"][e], ci["ecdf_high"][e] = binomial_ci(ess, ecdf, level)
+        p = np.array(BOX_PERCENTILES) / 100
+        p_low, p_high = binomial_ci(ess, p, level)
+        bounds = ensemble_percentiles(ensembles[e], np.concatenate([p_low, p_high]) * 100)
+        ci["box_low"][e], ci["box_high"][e] = bounds[:len(p)], bounds[len(p):]
+    return ci
@@ -15,37 +15,36 @@ Usage:
 """
 
 # --- Import packages
+from functools import cache
 import numpy as np
 from jinja2 import Template
 from scipy.stats import truncnorm
 from pathlib import Path
-from fplume_montecarlo.utilities import load_config
+from fplume_montecarlo.utilities import load_config, event_date_prefix
 from fplume_montecarlo.config import PROJ_ROOT
 
 CONFIG = load_config(PROJ_ROOT / "config.yaml")
 
-def generate_inp_file(year, month, day, hour, MER, exit_velocity, template_file, output_dir):
+@cache
+def load_template(template_file):
     """
-    Inserts perturbed volcanic initial conditions into the 'template_fplume.inp' template
-    to generate the .inp file required by FPLUME.
-
-    Each parameter is perturbed assuming a Gaussian distribution. Default values with specified
-    uncertainties are based on literature values for Etna:
-        - MER: 22.3% uncertainty (Mereu et al., 2022)
-        - Exit velocity: std dev = 25 m/s
-        - Exit temperature: mean = 1390 K, std dev = 6 K (Giordano et al., 2010)
-        - Exit water fraction: mean = 3 wt%, std dev = 0.5 (Giordano et al., 2010)
-        - cp: mean = 1300 J/kg·K, std dev = 50 (Minett et al., 1988)
-        - c_umbrella: mean = 1.2, std dev = 0.025
+    Reads and compiles a jinja2 template once; later calls reuse the compiled template.
+    """
+    with open(template_file, "r") as f:
+        return Template(f.read())
 
-    The user can modify these value in config.yaml.
+def parameter_distributions(MER, exit_velocity, param_montecarlo=None):
+    """
+    Resolves the mean and standard deviation of each perturbed parameter from config.yaml
+    (or from the given param_montecarlo settings, with the same structure), replacing the
+    MER and exit velocity placeholders with the radar-derived event values.
 
     Returns:
-        Path to the generated .inp file.
+        dict: {name: {"mean": float, "std": float}} in the order of parameters_montecarlo.
     """
+    if param_montecarlo is None:
+        param_montecarlo = CONFIG["parameters_montecarlo"]
 
-    param_montecarlo = CONFIG["parameters_montecarlo"]
-    
     parameters = {}
     for name, settings in param_montecarlo.items():
         if settings["mean"] == "MER":
@@ -62,26 +61,180 @@ def generate_inp_file(year, month, day, hour, MER, exit_velocity, template_file,
             "mean": mean,
             "std": std
         }
+    return parameters
 
-    with open(template_file, "r") as f:
-        template = Template(f.read())
+def truncnorm_bounds(mean, std):
+    """
+    Standardized bounds of a normal distribution truncated at zero (no negative values).
+    """
+    return (0 - mean) / std, (np.inf - mean) / std
+
+def sample_parameters(MER, exit_velocity, proposal=None):
+    """
+    Samples one set of perturbed volcanic initial conditions.
+
+    Each parameter is drawn from a normal distribution truncated at zero, with mean and
+    standard deviation given by parameter_distributions(). If an importance sampling proposal
+    (see design_proposal()) is given, the parameters are drawn from the shifted distribution,
+    except for a defensive fraction of the samples drawn from the nominal one.
+
+    Returns:
+        dict: {name: sampled value}
+    """
+    parameters = parameter_distributions(MER, exit_velocity)
+    if proposal is not None and np.random.uniform() >= proposal["defensive_fraction"]:
+        parameters = proposal["parameters"]
 
     # --- Sample parameter values using truncated normal to avoid negative unphisical values
     sampled_params = {}
     for name, stats in parameters.items():
         mean, std = stats["mean"], stats["std"]
-        a = (0 - mean) / std
-        b = (np.inf - mean) / std
+        a, b = truncnorm_bounds(mean, std)
         sampled_params[name] = truncnorm.rvs(a, b, loc=mean, scale=std)
 
+    return sampled_params
+
+def transform_uniforms(uniforms, MER, exit_velocity, param_montecarlo=None):
+    """
+    Maps uniform draws on (0, 1) to perturbed parameters through the inverse CDF of the
+    truncated normal distributions. Reusing the same uniforms with different settings gives
+    common random numbers across scenarios.
+
+    Parameters:
+        uniforms (array-like): one uniform value per parameter, in the order of
+            parameter_distributions().
+
+    Returns:
+        dict: {name: sampled value}
+    """
+    parameters = parameter_distributions(MER, exit_velocity, param_montecarlo)
+
+    sampled_params = {}
+    for u, (name, stats) in zip(uniforms, parameters.items()):
+        mean, std = stats["mean"], stats["std"]
+        a, b = truncnorm_bounds(mean, std)
+        sampled_params[name] = truncnorm.ppf(u, a, b, loc=mean, scale=std)
+
+    return sampled_params
+
+def design_proposal(pilot_samples, pilot_heights, target_height, MER, exit_velocity,
+                    defensive_fraction=0.2, max_shift=4.0):
+    """
+    Designs an importance sampling proposal that concentrates the runs around a target
+    column height (e.g. the radar height), using the results of a pilot run.
+
+    A linear model of the column height on the standardized parameters is fitted to the
+    pilot run, and all the means are shifted to the most probable point of the parameter
+    space where the model predicts the target height. Standard deviations are unchanged.
+
+    Parameters:
+        pilot_samples (pd.DataFrame): sampled parameters of the pilot run.
+        pilot_heights (np.ndarray): column heights of the pilot run (m above the vent).
+        target_height (float): column height to focus on (m above the vent).
+        MER (float): radar-derived MER of the event (kg/s).
+        exit_velocity (float): exit velocity of the event (m/s).
+        defensive_fraction (float): fraction of samples still drawn from the nominal
+            distribution, which bounds the weights to 1 / defensive_fraction.
+        max_shift (float): maximum shift of the means, in standard deviations.
+
+    Returns:
+        dict: {"parameters": shifted {name: {"mean", "std"}}, "shift": {name: shift in std},
+        "defensive_fraction": float}
+    """
+    nominal = parameter_distributions(MER, exit_velocity)
+    names = list(nominal)
+    means = np.array([nominal[n]["mean"] for n in names])
+    stds = np.array([nominal[n]["std"] for n in names])
+
+    # --- Linear fit of the pilot heights on the standardized parameters
+    Z = (pilot_samples[names].to_numpy(dtype=float) - means) / stds
+    A = np.column_stack([np.ones(len(Z)), Z])
+    coef, *_ = np.linalg.lstsq(A, pilot_heights, rcond=None)
+    h0, grad = coef[0], coef[1:]
+
+    # --- Minimum-norm shift reaching the target height on the fitted model
+    shift = np.zeros(len(names))
+    if np.dot(grad, grad) > 0:
+        shift = (target_height - h0) * grad / np.dot(grad, grad)
+    norm = np.linalg.norm(shift)
+    if norm > max_shift:
+        shift *= max_shift / norm
+
+    parameters = {
+        name: {"mean": nominal[name]["mean"] + shift[k] * nominal[name]["std"],
+               "std": nominal[name]["std"]}
+        for k, name in enumerate(names)
+    }
+    return {
+        "parameters": parameters,
+        "shift": {name: round(float(shift[k]), 3) for k, name in enumerate(names)},
+        "defensive_fraction": defensive_fraction,
+    }
+
+def importance_weight(sampled_params, MER, exit_velocity, proposal):
+    """
+    Likelihood-ratio weight p(x) / q(x) of one sample drawn with sample_parameters(),
+    where p is the nominal distribution and q the defensive mixture of the proposal.
+
+    Returns:
+        float: importance weight (1 for plain Monte Carlo).
+    """
+    nominal = parameter_distributions(MER, exit_velocity)
+
+    log_ratio = 0.0
+    for name, stats in nominal.items():
+        x = sampled_params[name]
+        shifted = proposal["parameters"][name]
+        log_ratio += (truncnorm.logpdf(x, *truncnorm_bounds(shifted["mean"], shifted["std"]),
+                                       loc=shifted["mean"], scale=shifted["std"])
+                      - truncnorm.logpdf(x, *truncnorm_bounds(stats["mean"], stats["std"]),
+                                         loc=stats["mean"], scale=stats["std"]))
+
+    alpha = proposal["defensive_fraction"]
+    return 1.0 / (alpha + (1 - alpha) * np.exp(log_ratio))
+
+def generate_inp_file(year, month, day, hour, MER, exit_velocity, template_file, output_dir,
+                      sampled_params=None, volcano=None):
+    """
+    Inserts perturbed volcanic initial conditions into the 'template_fplume.inp' template
+    to generate the .inp file required by FPLUME.
+
+    Each parameter is perturbed assuming a Gaussian distribution. Default values with specified
+    uncertainties are based on literature values for Etna:
+        - MER: 22.3% uncertainty (Mereu et al., 2022)
+        - Exit velocity: std dev = 25 m/s
+        - Exit temperature: mean = 1390 K, std dev = 6 K (Giordano et al., 2010)
+        - Exit water fraction: mean = 3 wt%, std dev = 0.5 (Giordano et al., 2010)
+        - cp: mean = 1300 J/kg·K, std dev = 50 (Minett et al., 1988)
+        - c_umbrella: mean = 1.2, std dev = 0.025
+
+    The user can modify these value in config.yaml. If sampled_params is given (e.g. to keep
+    track of the inputs of each run), it is rendered as is instead of drawing a new sample.
+    The vent position and height are those of volcano (default volcano of config.yaml if None).
+
+    Returns:
+        Path to the generated .inp file.
+    """
+
+    template = load_template(template_file)
+
+    if sampled_params is None:
+        sampled_params = sample_parameters(MER, exit_velocity)
+    sampled_params = dict(sampled_params)
+
     # --- Add date/time for the template
     sampled_params.update({"year": year, "month": month, "day": day, "hour": hour})
 
+    # --- Add vent of the volcano
+    volcano = volcano or CONFIG["volcano"]
+    sampled_params.update({"lon_vent": volcano.longitude, "lat_vent": volcano.latitude,
+                           "vent_height": volcano.height})
+
     # --- Render template
     rendered = template.render(sampled_params)
 
     # --- Write .inp file
-    date_prefix = f"{year}_{month}_{day}_{hour}"
+    date_prefix = event_date_prefix(year, month, day, hour, volcano)
     output_path = Path(output_dir) / f"{date_prefix}.inp"
 
     with open(output_path, "w") as f:
@@ -0,0 +1,281 @@
+"""
+Estimates the MER distribution of each eruption event from the radar column height,
+inverting a forward response table of FPLUME instead of running FPLUME in MFR mode
+(SOLVE_PLUME_FOR = MFR) for every sample.
+
+For each event (i.e. for each .met profile) a design run is performed once: FPLUME is run
+in HEIGHT mode over a grid of MER (log-spaced, log10_mer_range in config.yaml) and exit
+velocity levels, with the other parameters at their mean. The resulting column heights
+are stored in COLUMN_FILES_DIR/{date_prefix}.response and reused afterwards.
+
+The radar height h ± height_uncertainty and the exit velocity are then sampled, and the
+MER of every sample is obtained by interpolating the response table (all samples at once).
+A few real MFR-mode runs can be requested with --check to cross-check the inversion.
+
+The MER samples are saved in COLUMN_FILES_DIR/{date_prefix}.mer
+
+Requires the inputs prepared by prepare_input_files.py for the design and check runs.
+
+Usage:
+    python fplume_montecarlo.inverse_mer --code <n>
+    python fplume_montecarlo.inverse_mer --all
+    python fplume_montecarlo.inverse_mer --code <n> --check 5
+"""
+
+# ---Import packages
+import argparse
+import re
+
+import numpy as np
+import pandas as pd
+from scipy.stats import truncnorm
+
+# ---Import directories and utilities
+from fplume_montecarlo.config import (
+    COLUMN_FILES_DIR,
+    ERUPTIONS_FILE,
+    FPLUME_EXE_DIR,
+    PROJ_ROOT,
+    TMP_MONTECARLO_DIR,
+)
+from fplume_montecarlo.generate_inp_file import parameter_distributions, truncnorm_bounds
+from fplume_montecarlo.run_montecarlo import clean_working_dirs, execute_fplume, run_single
+from fplume_montecarlo.utilities import load_config, load_events
+
+CONFIG = load_config(PROJ_ROOT / "config.yaml")
+
+# ---Output line of the mass flow rate solved by FPLUME in MFR mode
+MFR_OUTPUT_LINE = re.compile(
+    r"^\s*mass\s+flow\s+rate\s*\(kg/s\)\s*[:=]\s*([-+]?[0-9]*\.?[0-9]+(?:[eEdD][-+]?[0-9]+)?)",
+    re.IGNORECASE
+)
+
+def design_points(event):
+    """
+    Builds the MER x exit velocity design of the forward response table.
+
+    Returns:
+        tuple: (np.ndarray of MER levels in kg/s, np.ndarray of exit velocity levels in m/s)
+    """
+    settings = CONFIG["inverse_mer"]
+    lo, hi = settings["log10_mer_range"]
+    mer_levels = np.logspace(lo, hi, settings["n_mer"])
+
+    exit_v = parameter_distributions(event["mer"], event["exit_v"])["exit_velocity"]
+    v_levels = exit_v["mean"] + exit_v["std"] * np.array(settings["exit_velocity_levels"], float)
+    v_levels = np.unique(v_levels[v_levels > 0])
+    return mer_levels, v_levels
+
+def run_design(event):
+    """
+    Runs FPLUME over the design points of an event and stores the response table.
+
+    Returns:
+        pd.DataFrame: columns MER, exit_velocity, height (m above the vent).
+    """
+    date_prefix = event["date_prefix"]
+    target_path = FPLUME_EXE_DIR / "tmp_montecarlo"
+    means = {name: stats["mean"]
+             for name, stats in parameter_distributions(event["mer"], event["exit_v"]).items()}
+
+    mer_levels, v_levels = design_points(event)
+    rows = []
+    for v in v_levels:
+        for mer in mer_levels:
+            print(f"  Design run MER = {mer:.3g} kg/s, exit velocity = {v:.1f} m/s for {date_prefix}")
+            params = dict(means, MER=mer, exit_velocity=v)
+            height = run_single(event, params, TMP_MONTECARLO_DIR, target_path)
+            rows.append({"MER": mer, "exit_velocity": v,
+                         "height": float(height) if height is not None else np.nan})
+
+    response = pd.DataFrame(rows)
+    response.to_csv(COLUMN_FILES_DIR / f"{date_prefix}.response", sep="\t", index=False)
+    return response
+
+def response_curve(table):
+    """
+    Column height -> log10(MER) curve of one exit velocity level of the response table,
+    strictly increasing in height as np.interp requires: the rows whose height does not
+    exceed the heights of all the lower MERs are dropped (on a plateau, the lowest MER
+    reaching the height is kept).
+
+    Returns:
+        tuple: (np.ndarray of heights, np.ndarray of log10(MER), number of dropped rows)
+    """
+    table = table.sort_values("MER")
+    h = table["height"].to_numpy()
+    keep = h > np.concatenate([[-np.inf], np.maximum.accumulate(h)[:-1]])
+    return h[keep], np.log10(table["MER"].to_numpy()[keep]), int(np.sum(~keep))
+
+def check_response(response):
+    """
+    Checks that the column height of the response table rises with MER at every exit
+    velocity level. Rows breaking the rise are reported (and ignored by invert_heights).
+
+    Raises:
+        ValueError: if a level has less than two rows with rising heights.
+    """
+    response = response.dropna()
+    for v, table in response.groupby("exit_velocity"):
+        h, _, dropped = response_curve(table)
+        if len(h) < 2:
+            raise ValueError(f"Column height does not rise with MER at exit velocity {v:.1f} m/s: "
+                             f"{len(table)} valid design runs. Please check the design (--redesign)")
+        if dropped:
+            print(f"  Warning: column height does not rise with MER for {dropped} of {len(table)} "
+                  f"design runs at exit velocity {v:.1f} m/s, ignored by the inversion")
+
+def invert_heights(response, heights, exit_velocities):
+    """
+    Interpolates the response table to find the MER producing each (height, exit velocity).
+
+    For every exit velocity level, log10(MER) is interpolated as a function of the column
+    height (strictly increasing curve of response_curve), then the result is linearly interpolated between the two
+    exit velocity levels bracketing each sample.
+
+    Parameters:
+        response (pd.DataFrame): response table (MER, exit_velocity, height).
+        heights (np.ndarray): column heights above the vent (m).
+        exit_velocities (np.ndarray): exit velocities (m/s), same shape as heights.
+
+    Returns:
+        tuple: (np.ndarray of MER in kg/s, np.ndarray of bool flagging heights outside the
+        range of the table, whose MER is clipped to the design range)
+    """
+    response = response.dropna()
+    v_levels = np.sort(response["exit_velocity"].unique())
+
+    # ---log10(MER) at each exit velocity level, shape (levels, samples)
+    log_mer = np.empty((len(v_levels), len(heights)))
+    outside = np.zeros(len(heights), dtype=bool)
+    for k, v in enumerate(v_levels):
+        h_table, log_mer_table, _ = response_curve(response[response["exit_velocity"] == v])
+        log_mer[k] = np.interp(heights, h_table, log_mer_table)
+        outside |= (heights < h_table[0]) | (heights > h_table[-1])
+
+    if len(v_levels) == 1:
+        return 10 ** log_mer[0], outside
+
+    # ---Linear interpolation between the bracketing exit velocity levels
+    v = np.clip(exit_velocities, v_levels[0], v_levels[-1])
+    upper = np.clip(np.searchsorted(v_levels, v), 1, len(v_levels) - 1)
+    lower = upper - 1
+    frac = (v - v_levels[lower]) / (v_levels[upper] - v_levels[lower])
+    cols = np.arange(len(heights))
+    log_mer = (1 - frac) * log_mer[lower, cols] + frac * log_mer[upper, cols]
+    return 10 ** log_mer, outside
+
+def sample_observations(event, n):
+    """
+    Samples radar column heights (m above the vent) and exit velocities for an event.
+
+    Returns:
+        tuple: (np.ndarray of heights, np.ndarray of exit velocities)
+    """
+    sigma = CONFIG["inverse_mer"]["height_uncertainty"]
+    heights = np.random.normal(event["h"] - event["volcano"].height, sigma, n)
+
+    stats = parameter_distributions(event["mer"], event["exit_v"])["exit_velocity"]
+    a, b = truncnorm_bounds(stats["mean"], stats["std"])
+    exit_velocities = truncnorm.rvs(a, b, loc=stats["mean"], scale=stats["std"], size=n)
+    return heights, exit_velocities
+
+def read_mfr(result_file):
+    """
+    Reads the mass flow rate solved by FPLUME in MFR mode from the output files of a run
+    (.res and .log files sharing the problem name), i.e. the last line of the form
+    "Mass flow rate (kg/s) : 1.2345E+06". Echoes of the inputs (MASS_FLOW_RATE_(KGS),
+    MFR_SEARCH_RANGE) do not match.
+
+    Returns:
+        float: MER in kg/s.
+    """
+    problem = result_file.name.split(".")[0]
+    outputs = [path for path in sorted(result_file.parent.glob(f"{problem}*"))
+               if path.is_file() and path.suffix in (".res", ".log")]
+    for path in outputs:
+        mfr = None
+        with open(path, "r", errors="ignore") as f:
+            for line in f:
+                match = MFR_OUTPUT_LINE.match(line)
+                if match:
+                    mfr = float(match.group(1).upper().replace("D", "E"))
+        if mfr is not None:
+            return mfr
+    raise ValueError(f"Solved mass flow rate line not found in the FPLUME outputs of {problem} "
+                     f"({', '.join(p.name for p in outputs) or 'no .res/.log file'})")
+
+def check_mfr_mode(event, response, n_check):
+    """
+    Cross-checks the inversion against real FPLUME runs in MFR mode.
+
+    Returns:
+        pd.DataFrame: columns height, exit_velocity, mer_fplume, mer_table.
+    """
+    target_path = FPLUME_EXE_DIR / "tmp_montecarlo"
+    means = {name: stats["mean"]
+             for name, stats in parameter_distributions(event["mer"], event["exit_v"]).items()}
+
+    heights, exit_velocities = sample_observations(event, n_check)
+    mer_table, _ = invert_heights(response, heights, exit_velocities)
+
+    rows = []
+    for h, v, m in zip(heights, exit_velocities, mer_table):
+        params = dict(means, exit_velocity=v, solve_plume_for="MFR", height_above_vent=h)
+        result_file = execute_fplume(event, params, TMP_MONTECARLO_DIR, target_path)
+        rows.append({"height": h, "exit_velocity": v,
+                     "mer_fplume": read_mfr(result_file), "mer_table": m})
+    return pd.DataFrame(rows)
+
+def main():
+    """
+    Parses command-line arguments and estimates the MER distribution of the selected events.
+    """
+    parser = argparse.ArgumentParser(description="Inverse MER estimation from a forward response table")
+    parser.add_argument("--code", type=int, help="Process only one event by code")
+    parser.add_argument("--all", action="store_true", help="Process all events")
+    parser.add_argument("--n", type=int, default=CONFIG["n_montecarlo"], help="Number of MER samples")
+    parser.add_argument("--redesign", action="store_true", help="Run the design even if a table exists")
+    parser.add_argument("--check", type=int, default=0, help="Number of FPLUME MFR-mode check runs")
+    args = parser.parse_args()
+
+    if args.all:
+        events = load_events(ERUPTIONS_FILE, code=None)
+    elif args.code:
+        events = [load_events(ERUPTIONS_FILE, code=args.code)]
+    else:
+        raise ValueError("Please specify --code <int> or --all")
+
+    for event in events:
+        date_prefix = event["date_prefix"]
+        print(f"Processing event {date_prefix}")
+
+        # ---Forward response table, computed once per met profile
+        response_file = COLUMN_FILES_DIR / f"{date_prefix}.response"
+        needs_runs = args.redesign or not response_file.exists() or args.check > 0
+        if response_file.exists() and not args.redesign:
+            response = pd.read_csv(response_file, sep="\t")
+        else:
+            response = run_design(event)
+        check_response(response)
+
+        # ---Inversion of the radar height
+        heights, exit_velocities = sample_observations(event, args.n)
+        mer, outside = invert_heights(response, heights, exit_velocities)
+        np.savetxt(COLUMN_FILES_DIR / f"{date_prefix}.mer", mer, fmt="%.6g")
+
+        q5, q50, q95 = np.percentile(mer, [5, 50, 95])
+        print(f"  MER radar: {event['mer']:.3g} kg/s, inverted: {q50:.3g} kg/s "
+              f"[{q5:.3g} – {q95:.3g}], outside table: {outside.mean() * 100:.1f}%")
+
+        if args.check:
+            check = check_mfr_mode(event, response, args.check)
+            ratio = check["mer_table"] / check["mer_fplume"]
+            print(check.to_string(index=False))
+            print(f"  MER table / FPLUME MFR mode: median {np.median(ratio):.3f}")
+
+        if needs_runs:
+            clean_working_dirs(date_prefix, FPLUME_EXE_DIR / "tmp_montecarlo")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+"""
+In-memory pipeline from the ERA5 files to the Monte Carlo runs, replacing the chain
+create_met_file -> prepare_input_files -> run_montecarlo for a batch of events.
+
+The met profile of each event is computed from its ERA5 file (create_met_file.py) and handed
+over as a DataFrame to the staging of the scheduler (scheduler.py), which writes the .met and
+.tgsd files once, directly in the FPLUME scratch directory of each worker: no copies in
+FPLUME_MET_FILES_DIR and TMP_MONTECARLO_DIR. Events without an ERA5 file fall back to their
+.met file in FPLUME_MET_FILES_DIR, if any. Without --save-met, no .met file is left in
+FPLUME_MET_FILES_DIR: plume_model.py and emulator.py create it from the ERA5 file when they
+need it (create_met_file.ensure_met_file).
+
+The inputs of all the events are checked before any run, and the missing ones are reported
+for every event of the batch; the events with complete inputs are then run.
+
+Usage:
+    python fplume_montecarlo.pipeline --code <n>
+    python fplume_montecarlo.pipeline --all --workers 8
+    python fplume_montecarlo.pipeline --all --importance --save-met
+    python fplume_montecarlo.pipeline --all --profile                # see profiling.py
+"""
+
+# ---Import packages
+import argparse
+
+import pandas as pd
+
+# ---Import directories and utilities
+from fplume_montecarlo.config import ERUPTIONS_FILE, FPLUME_MET_FILES_DIR, FPLUME_TEMPLATES_DIR
+from fplume_montecarlo.create_met_file import find_era5_file, process_era5_data, save_to_txt
+from fplume_montecarlo.profiling import profiled
+from fplume_montecarlo.run_montecarlo import n_montecarlo
+from fplume_montecarlo.scheduler import run_campaign
+from fplume_montecarlo.utilities import load_events
+
+# ---Particle size distribution, the same for all the events
+TGSD_TEMPLATE_FILE = FPLUME_TEMPLATES_DIR / "template_fplume.tgsd"
+
+def collect_inputs(events, importance=False, save_met=False):
+    """
+    Computes the met profile of every event and checks its inputs, without stopping at the
+    first event with missing inputs.
+
+    Args:
+        events (list[dict]): events as returned by load_events.
+        importance (bool): importance sampling requires the radar column height h.
+        save_met (bool): also write the computed .met files to FPLUME_MET_FILES_DIR.
+
+    Returns:
+        tuple: (inputs {date_prefix: {"met": DataFrame or Path, "tgsd": Path}},
+                missing {date_prefix: [reasons]})
+    """
+    inputs, missing = {}, {}
+    for event in events:
+        date_prefix = event["date_prefix"]
+        reasons = []
+
+        if not TGSD_TEMPLATE_FILE.exists():
+            reasons.append(f"missing {TGSD_TEMPLATE_FILE.name}")
+        if importance and pd.isna(event.get("h")):
+            reasons.append("missing radar column height (h), required by --importance")
+
+        # ---Met profile from the ERA5 file, otherwise from an existing .met file
+        era5_file = find_era5_file(date_prefix)
+        met_file = FPLUME_MET_FILES_DIR / f"{date_prefix}.met"
+        met = None
+        if era5_file.exists():
+            try:
+                met = process_era5_data(era5_file, event["volcano"])
+            except (OSError, KeyError, ValueError) as e:
+                reasons.append(f"unreadable ERA5 file {era5_file.name} ({e})")
+            else:
+                if save_met:
+                    met_file.parent.mkdir(parents=True, exist_ok=True)
+                    save_to_txt(met, met_file)
+        elif met_file.exists():
+            met = met_file
+        else:
+            reasons.append(f"missing ERA5 file {era5_file.name} and .met file. Please run download_era5.py")
+
+        if reasons:
+            missing[date_prefix] = reasons
+        else:
+            inputs[date_prefix] = {"met": met, "tgsd": TGSD_TEMPLATE_FILE}
+    return inputs, missing
+
+def report_missing(missing, n_events):
+    """
+    Prints the missing inputs of every event of a batch.
+    """
+    if not missing:
+        return
+    print(f"Missing inputs for {len(missing)} of {n_events} events:")
+    for date_prefix, reasons in missing.items():
+        for reason in reasons:
+            print(f"  {date_prefix}: {reason}")
+
+def run_pipeline(events, n_workers=1, importance=False, n_runs=n_montecarlo, save_met=False):
+    """
+    Runs the Monte Carlo simulation of a batch of events from their ERA5 files, handing the
+    met profiles over in memory to the FPLUME workers (scheduler.py).
+
+    Returns:
+        dict: missing inputs {date_prefix: [reasons]} of the events that were not run.
+    """
+    inputs, missing = collect_inputs(events, importance=importance, save_met=save_met)
+    report_missing(missing, len(events))
+    ready = [e for e in events if e["date_prefix"] in inputs]
+    if ready:
+        run_campaign(ready, n_workers, importance=importance, n_runs=n_runs, inputs=inputs)
+    return missing
+
+@profiled("pipeline")
+def main():
+    """
+    Runs the in-memory pipeline for one or all the events.
+    """
+    parser = argparse.ArgumentParser(description="Run FPLUME Monte Carlo from ERA5 files")
+    parser.add_argument("--code", type=int, help="Process only one event by code")
+    parser.add_argument("--all", action="store_true", help="Process all events")
+    parser.add_argument("--workers", type=int, default=1, help="Number of FPLUME workers")
+    parser.add_argument("--importance", action="store_true",
+                        help="Importance sampling toward the radar column height")
+    parser.add_argument("--save-met", action="store_true",
+                        help="Also write the .met files to FPLUME_MET_FILES_DIR")
+    args = parser.parse_args()
+
+    if args.all:
+        events = load_events(ERUPTIONS_FILE, code=None)
+    elif args.code:
+        events = [load_events(ERUPTIONS_FILE, code=args.code)]
+    else:
+        raise ValueError("Please specify --code <int> or --all")
+
+    run_pipeline(events, args.workers, importance=args.importance, save_met=args.save_met)
+
+if __name__ == "__main__":
+    main()
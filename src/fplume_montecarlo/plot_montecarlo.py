@@ -6,6 +6,19 @@ The plot consists of two subplots:
       with radar-observed column heights overlaid as scatter points.
     - Bottom: A bar chart showing MER values with a secondary axis plotting the ECDF percentile
       of the radar observation within the Monte Carlo distribution.
+
+Ensembles run with importance sampling (run_montecarlo --importance) are summarized with
+their likelihood-ratio weights, and their effective sample size is reported.
+
+Bootstrap 95% confidence intervals (bootstrap_montecarlo.py) of the median and of the ECDF
+percentile show whether n_montecarlo is large enough for each event.
+
+Ensembles are read from the memory-mapped .npy files of ensemble_store.py, so that the
+statistics of very large ensembles are computed in bounded memory.
+
+Usage:
+    python fplume_montecarlo.plot_montecarlo
+    python fplume_montecarlo.plot_montecarlo --profile     # see profiling.py
 """
 # --- Import packages
 import os
@@ -14,20 +27,21 @@ import matplotlib.pyplot as plt
 from datetime import datetime
 from fplume_montecarlo.config import PROJ_ROOT, ERUPTIONS_FILE, COLUMN_FILES_DIR, PLOTS_DIR
 from fplume_montecarlo.utilities import load_events, load_config
+from fplume_montecarlo.ensemble_store import (
+    open_ensemble, ensemble_percentiles, ensemble_ecdf, ensemble_size, ensemble_ci
+)
+from fplume_montecarlo.profiling import profile_script
 
-CONFIG = load_config(PROJ_ROOT / "config.yaml")
+profile_script("plot_montecarlo")
 
-# ---Load volcano features
-VOLCANO = CONFIG["volcano"]  # This is now a Volcano object
+CONFIG = load_config(PROJ_ROOT / "config.yaml")
 
-# ---Load event metadata
+# ---Load event metadata (events of several volcanoes are labelled with the volcano name)
 events = load_events(ERUPTIONS_FILE, code=None)
-event_map = {
-    f"{int(e['year'])}_{int(e['month']):02}_{int(e['day']):02}_{int(e['hour']):02}": e
-    for e in events
-}
+event_map = {e["date_prefix"]: e for e in events}
+multi_volcano = len({e["volcano"].name for e in events}) > 1
 
-# ---Read and Combine Simulation Data
+# ---Read and Combine Simulation Data (memory-mapped ensembles, see ensemble_store.py)
 combined_data = []
 
 for filename in sorted(os.listdir(COLUMN_FILES_DIR)):
@@ -40,11 +54,8 @@ for filename in sorted(os.listdir(COLUMN_FILES_DIR)):
                 print(f"Skipped {filename}: No matching event")
                 continue
 
-            file_path = os.path.join(COLUMN_FILES_DIR, filename)
-            with open(file_path, "r") as file:
-                # ---Retrieve column heights from .column files
-                values = [float(val) for line in file for val in line.strip().split()]
-                values = np.array(values) + VOLCANO.height                              # Add height of the volcano
+            # ---Column heights above the vent and importance sampling weights (if any)
+            ensemble = open_ensemble(COLUMN_FILES_DIR, date_str)
 
             # ---Retrieve radar-based MER and column height from event metadata
             radar_value = event.get("h")
@@ -55,8 +66,10 @@ for filename in sorted(os.listdir(COLUMN_FILES_DIR)):
             
             # ---Combine weather radar data and Montecarlo simulation data
             combined_data.append({
-                "date": datetime.strptime(date_str, "%Y_%m_%d_%H"),
-                "values": values,
+                "date": datetime(int(event["year"]), int(event["month"]), int(event["day"]), int(event["hour"])),
+                "volcano": event["volcano"].name,
+                "ensemble": ensemble,
+                "height": event["volcano"].height,                                     # Height of the volcano
                 "radar_value": radar_value,
                 "mer": mer_value,
             })
@@ -68,26 +81,21 @@ for filename in sorted(os.listdir(COLUMN_FILES_DIR)):
 combined_data.sort(key=lambda x: x["mer"])
 
 # ---Prepare for Plotting
-boxplot_data = []
 boxplot_labels = []
 positions = []
 scatter_x = []
 scatter_y = []
 
 for idx, entry in enumerate(combined_data):
-    boxplot_data.append(entry["values"])
-    boxplot_labels.append(entry["date"].strftime("%Y-%m-%d-%H"))
+    label = entry["date"].strftime("%Y-%m-%d-%H")
+    boxplot_labels.append(f"{entry['volcano']}\n{label}" if multi_volcano else label)
     positions.append(idx + 1)
     scatter_x.append(idx + 1)
     scatter_y.append(entry["radar_value"])
 
-# ---Compute Custom Box Stats
-def custom_boxplot_stats(values):
-    q1 = np.percentile(values, 1)
-    q25 = np.percentile(values, 25)
-    q50 = np.percentile(values, 50)
-    q75 = np.percentile(values, 75)
-    q99 = np.percentile(values, 99)
+# ---Compute Custom Box Stats (weighted percentiles for importance sampling ensembles)
+def custom_boxplot_stats(ensemble, height):
+    q1, q25, q50, q75, q99 = ensemble_percentiles(ensemble, [1, 25, 50, 75, 99]) + height
     return {
         "whislo": q1,
         "q1": q25,
@@ -97,8 +105,8 @@ def custom_boxplot_stats(values):
     }
 
 custom_stats = []
-for values in boxplot_data:
-    stats = custom_boxplot_stats(values)
+for entry in combined_data:
+    stats = custom_boxplot_stats(entry['ensemble'], entry['height'])
     custom_stats.append([
         stats['whislo'], stats['q1'], stats['med'], stats['q3'], stats['whishi']
     ])
@@ -106,28 +114,41 @@ for values in boxplot_data:
 # ---Compute ECDF Percentiles including uncertainty
 ecdf_percentiles = []
 for entry in combined_data:
-    values = entry['values']
     radar_value = entry['radar_value']
-    sorted_vals = np.sort(values)
-    n = len(sorted_vals)
-
-    low = np.searchsorted(sorted_vals, radar_value - 300, side='right') / n
-    mid = np.searchsorted(sorted_vals, radar_value, side='right') / n
-    high = np.searchsorted(sorted_vals, radar_value + 300, side='right') / n
+    low, mid, high = ensemble_ecdf(
+        entry['ensemble'], np.array([radar_value - 300, radar_value, radar_value + 300]) - entry['height']
+    )
 
     ecdf_percentiles.append({
         'date': entry['date'],
         'radar_value': radar_value,
         'percentile': mid,
         'low': low,
-        'high': high
+        'high': high,
+        'ess': ensemble_size(entry['ensemble'])[1]
     })
 
+# ---Confidence intervals of the box stats and ECDF percentiles (bootstrap, all events at once)
+heights = np.array([entry['height'] for entry in combined_data])
+bootstrap = ensemble_ci(
+    [entry['ensemble'] for entry in combined_data],
+    [entry['radar_value'] - entry['height'] for entry in combined_data],
+    n_boot=1000
+)
+bootstrap['box_low'] = bootstrap['box_low'] + heights[:, None]
+bootstrap['box_high'] = bootstrap['box_high'] + heights[:, None]
+for i, e in enumerate(ecdf_percentiles):
+    e['ci_low'] = bootstrap['ecdf_low'][i, 1]
+    e['ci_high'] = bootstrap['ecdf_high'][i, 1]
+
 # ---Print ECDF Percentile Table
-print(f"{'Date':<20} {'Radar Value':>12} {'ECDF Percentile':>18} {'Range':>18}")
+print(f"{'Date':<20} {'Radar Value':>12} {'ECDF Percentile':>18} {'Range':>18} "
+      f"{'Bootstrap 95% CI':>18} {'ESS':>10}")
 for e in ecdf_percentiles:
     print(f"{e['date'].strftime('%Y-%m-%d %H:%M'): <20} {e['radar_value']:>12.1f} "
-          f"{e['percentile']*100:>17.1f}%  [{e['low']*100:.1f}% – {e['high']*100:.1f}%]")
+          f"{e['percentile']*100:>17.1f}%  [{e['low']*100:.1f}% – {e['high']*100:.1f}%] "
+          f"  [{e['ci_low']*100:.1f}% – {e['ci_high']*100:.1f}%] "
+          f"{e['ess']:>10.0f}")
 
 # --- Plot
 fig, (ax1, ax2, ax3) = plt.subplots(
@@ -153,6 +174,13 @@ ax1.bxp([{
     capprops=dict(color='black')
 )
 
+medians = np.array([s[2] for s in custom_stats])
+ax1.errorbar(
+    positions, medians,
+    yerr=[medians - bootstrap['box_low'][:, 2], bootstrap['box_high'][:, 2] - medians],
+    fmt='none', ecolor='darkblue', label='Median 95% CI (bootstrap)',
+    capsize=2, elinewidth=2, zorder=2
+)
 ax1.errorbar(
     scatter_x, scatter_y, yerr=300,
     fmt='o', color='red', label='H radar',
@@ -178,6 +206,13 @@ ax2.errorbar(
     fmt='o', color='red', label='ECDF Percentile',
     capsize=4, markersize=3
 )
+ax2.errorbar(
+    positions, percentiles,
+    yerr=[[(e['percentile'] - e['ci_low']) * 100 for e in ecdf_percentiles],
+          [(e['ci_high'] - e['percentile']) * 100 for e in ecdf_percentiles]],
+    fmt='none', ecolor='black', label='95% CI (bootstrap)',
+    capsize=2, elinewidth=2, zorder=3
+)
 ax2.set_ylabel("ECDF Percentile (%)", fontsize=14, color='red')
 ax2.set_ylim([0, 100.1])
 ax2.tick_params(axis='y', labelcolor='red', labelsize=12)
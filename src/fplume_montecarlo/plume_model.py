@@ -0,0 +1,369 @@
+"""
+Vectorized 1D integral plume model for fast screening, used alongside FPLUME.
+
+The model belongs to the same family as FPLUME (Folch et al., 2016): a steady, top-hat,
+wind-coupled integral model of a bent-over plume (Woodhouse et al., 2013), with:
+    - entrainment velocity Ue = ks |U - V cos(phi)| + kw |V sin(phi)|;
+    - moist entrained air (specific humidity of the .met profile) and condensation of the
+      water vapour with latent heat release;
+    - pyroclasts, dry air and water with their own specific heats (cp sampled, Ca and Cw
+      as in template_fplume.inp);
+    - the column top limited to c_umbrella times the neutral buoyancy height.
+
+It is driven by the same .met profile and the same six sampled parameters of FPLUME,
+and all the samples of an event are integrated at once as a batched ODE over NumPy arrays
+(Heun scheme, step proportional to the plume radius), so that thousands of samples take
+a fraction of a second. The raw model heights are mapped to FPLUME heights with a linear
+calibration fitted on the stored FPLUME results (.column and .samples files) and saved in
+PROCESSED_DATA_DIR/plume_model_calibration.json.
+
+Used for fast screening, pilot runs (run_montecarlo --importance with pilot_engine: numpy)
+and proposal design.
+
+Usage:
+    python fplume_montecarlo.plume_model --code <n> --n 10000     # screening ensemble
+    python fplume_montecarlo.plume_model --all --calibrate         # calibrate and benchmark
+"""
+
+# ---Import packages
+import argparse
+import json
+import time
+
+import numpy as np
+import pandas as pd
+from scipy.stats import truncnorm
+
+# ---Import directories and utilities
+from fplume_montecarlo.config import (
+    COLUMN_FILES_DIR,
+    ERUPTIONS_FILE,
+    PROCESSED_DATA_DIR,
+    PROJ_ROOT,
+)
+from fplume_montecarlo.generate_inp_file import parameter_distributions, truncnorm_bounds
+from fplume_montecarlo.utilities import (
+    load_column_file,
+    load_config,
+    load_events,
+    load_samples_file,
+)
+
+CONFIG = load_config(PROJ_ROOT / "config.yaml")
+
+# ---Physical constants (Ca and Cw as in template_fplume.inp)
+G = 9.81                # gravity (m/s²)
+R_AIR = 287.05          # gas constant of dry air (J/kg·K)
+R_VAPOUR = 461.5        # gas constant of water vapour (J/kg·K)
+C_AIR = 1004.5          # specific heat of air (J/kg·K)
+C_WATER = 2000.0        # specific heat of water (J/kg·K)
+LATENT_HEAT = 2.5e6     # latent heat of condensation (J/kg)
+RHO_PYROCLASTS = 2500.0 # density of pyroclasts (kg/m³)
+RHO_LIQUID = 1000.0     # density of liquid water (kg/m³)
+
+# ---Entrainment coefficients (Woodhouse et al., 2013)
+KS = 0.09
+KW = 0.9
+
+# ---Output files
+CALIBRATION_FILE = PROCESSED_DATA_DIR / "plume_model_calibration.json"
+SCREENING_DIR = COLUMN_FILES_DIR / "screening"
+
+def load_met_profile(met_file):
+    """
+    Reads a .met file into arrays of altitude (m a.s.l.), density (kg/m³), pressure (Pa),
+    temperature (K), specific humidity (kg/kg) and wind speed (m/s), sorted by altitude.
+
+    Returns:
+        dict: {"z", "rho", "p", "T", "q", "wind"} of np.ndarray.
+    """
+    data = np.loadtxt(met_file, comments="#")
+    data = data[np.argsort(data[:, 0])]
+    return {
+        "z": data[:, 0] * 1000,
+        "rho": data[:, 1],
+        "p": data[:, 2] * 100,
+        "T": data[:, 3],
+        "q": data[:, 4] / 1000,
+        "wind": np.hypot(data[:, 5], data[:, 6]),
+    }
+
+def event_met_profile(event):
+    """
+    Met profile (load_met_profile) of an event. The .met file is created from the ERA5 file
+    if it does not exist (create_met_file.ensure_met_file).
+    """
+    from fplume_montecarlo.create_met_file import ensure_met_file
+
+    return load_met_profile(ensure_met_file(event))
+
+def saturation_ratio(T, p):
+    """
+    Mass of water vapour per mass of dry air at saturation (over liquid water).
+    """
+    e_s = 611.2 * np.exp(17.67 * (T - 273.15) / np.maximum(T - 29.65, 1.0))
+    e_s = np.minimum(e_s, 0.5 * p)
+    return (R_AIR / R_VAPOUR) * e_s / (p - e_s)
+
+def plume_state(Qs, Qa, Qw, F, cp, p):
+    """
+    Temperature, liquid water flux and density of the plume from the conserved fluxes.
+    The temperature is found with a few fixed-point iterations on the condensed water.
+    """
+    C = Qs * cp + Qa * C_AIR + Qw * C_WATER
+    T = F / C
+    Ql = np.zeros_like(T)
+    for _ in range(4):
+        Ql = np.clip(Qw - saturation_ratio(T, p) * Qa, 0.0, Qw)
+        T = (F + LATENT_HEAT * Ql) / C
+    Q = Qs + Qa + Qw
+    gas = (Qa * R_AIR + (Qw - Ql) * R_VAPOUR) * T / p
+    rho = Q / (Qs / RHO_PYROCLASTS + Ql / RHO_LIQUID + gas)
+    return T, rho
+
+def integrate_plume(params, met, vent_height, step=0.05, max_steps=4000, max_height=40000.0):
+    """
+    Integrates the plume equations for all the samples at once.
+
+    Parameters:
+        params (dict): arrays (one value per sample) of MER, exit_velocity, exit_temperature,
+            exit_water_fraction, cp and c_umbrella (same names as parameters_montecarlo).
+        met (dict): profile returned by load_met_profile().
+        vent_height (float): height of the vent (m a.s.l.).
+        step (float): integration step along the plume axis, relative to the plume radius.
+        max_steps (int): maximum number of integration steps.
+        max_height (float): maximum column height above the vent (m).
+
+    Returns:
+        np.ndarray: raw column heights above the vent (m), one per sample.
+    """
+    mer = np.asarray(params["MER"], dtype=float)
+    u0 = np.asarray(params["exit_velocity"], dtype=float)
+    T0 = np.asarray(params["exit_temperature"], dtype=float)
+    n_w = np.asarray(params["exit_water_fraction"], dtype=float) / 100
+    cp = np.asarray(params["cp"], dtype=float)
+    c_umbrella = np.asarray(params["c_umbrella"], dtype=float)
+
+    def air(z):
+        z_asl = vent_height + z
+        return (np.interp(z_asl, met["z"], met["rho"]), np.interp(z_asl, met["z"], met["p"]),
+                np.interp(z_asl, met["z"], met["T"]), np.interp(z_asl, met["z"], met["q"]),
+                np.interp(z_asl, met["z"], met["wind"]))
+
+    # ---Initial fluxes (divided by pi): pyroclasts, dry air, water, momentum, energy
+    Qs = mer * (1 - n_w) / np.pi
+    Qw0 = mer * n_w / np.pi
+    y = np.stack([
+        np.zeros_like(mer),             # Qa, entrained dry air
+        Qw0,                            # Qw, water (vapour + liquid)
+        np.zeros_like(mer),             # Mh, horizontal momentum
+        (Qs + Qw0) * u0,                # Mz, vertical momentum
+        (Qs * cp + Qw0 * C_WATER) * T0, # F, energy
+        np.zeros_like(mer),             # z, height above the vent
+    ])
+
+    def derivatives(y):
+        Qa, Qw, Mh, Mz, F, z = y
+        Q = Qs + Qa + Qw
+        rho_a, p, T_a, q_a, wind = air(z)
+        _, rho = plume_state(Qs, Qa, Qw, F, cp, p)
+
+        U = np.maximum(np.hypot(Mh, Mz) / Q, 1e-3)
+        cos_phi, sin_phi = Mh / (Q * U), Mz / (Q * U)
+        b = np.sqrt(Q / (rho * U))
+
+        Ue = KS * np.abs(U - wind * cos_phi) + KW * np.abs(wind * sin_phi)
+        entrained = 2 * rho_a * b * Ue
+
+        dy = np.stack([
+            entrained * (1 - q_a),
+            entrained * q_a,
+            entrained * wind,
+            G * (rho_a - rho) * b ** 2,
+            entrained * ((1 - q_a) * C_AIR + q_a * C_WATER) * T_a - Q * G * sin_phi,
+            sin_phi,
+        ])
+        return dy, b, rho, rho_a
+
+    z_top = np.zeros_like(mer)
+    z_nb = np.full_like(mer, np.nan)
+    active = np.ones_like(mer, dtype=bool)
+
+    dy1, b, rho, rho_a = derivatives(y)
+    for _ in range(max_steps):
+        if not active.any():
+            break
+        ds = step * b
+        dy2, *_ = derivatives(y + ds * dy1)
+        y_new = np.where(active, y + 0.5 * ds * (dy1 + dy2), y)
+        dy1, b, rho_new, rho_a_new = derivatives(y_new)
+
+        # ---Neutral buoyancy: first level where the plume becomes denser than air going up
+        crossing = active & np.isnan(z_nb) & (rho < rho_a) & (rho_new >= rho_a_new)
+        z_nb = np.where(crossing, y_new[5], z_nb)
+
+        # ---Stop at the top of the column (no upward momentum left)
+        stopped = active & ((y_new[3] <= 0) | (y_new[5] >= max_height))
+        y, rho, rho_a = y_new, rho_new, rho_a_new
+        z_top = np.where(active, np.maximum(z_top, y[5]), z_top)
+        active &= ~stopped
+
+    z_nb = np.where(np.isnan(z_nb), z_top, z_nb)
+    return np.minimum(z_top, c_umbrella * z_nb)
+
+def load_calibration():
+    """
+    Reads the calibration of the model heights, identity if not calibrated yet.
+
+    Returns:
+        dict: {"intercept": float, "slope": float, ...}
+    """
+    if CALIBRATION_FILE.exists():
+        with open(CALIBRATION_FILE, "r") as f:
+            return json.load(f)
+    return {"intercept": 0.0, "slope": 1.0}
+
+def screening_heights(event, params, calibrated=True, met=None):
+    """
+    Column heights above the vent (m) of the screening model for an event, one per sample.
+
+    Parameters:
+        event (dict): eruption event.
+        params (dict or pd.DataFrame): sampled parameters, one value per sample.
+        calibrated (bool): apply the linear calibration to FPLUME heights.
+        met (dict, optional): met profile of the event, by default event_met_profile(event).
+    """
+    met = met if met is not None else event_met_profile(event)
+    heights = integrate_plume({name: np.asarray(params[name]) for name in CONFIG["parameters_montecarlo"]},
+                              met, event["volcano"].height)
+    if calibrated:
+        calibration = load_calibration()
+        heights = calibration["intercept"] + calibration["slope"] * heights
+    return heights
+
+def sample_batch(event, n):
+    """
+    Samples n sets of perturbed parameters of an event, with the distributions of
+    sample_parameters (normal truncated at zero) and one draw of n values per parameter.
+
+    Returns:
+        pd.DataFrame: one row per sample.
+    """
+    samples = {}
+    for name, stats in parameter_distributions(event["mer"], event["exit_v"]).items():
+        mean, std = stats["mean"], stats["std"]
+        a, b = truncnorm_bounds(mean, std)
+        samples[name] = truncnorm.rvs(a, b, loc=mean, scale=std, size=n)
+    return pd.DataFrame(samples)
+
+def calibrate(events):
+    """
+    Fits the linear calibration of the model heights on the stored FPLUME results and
+    benchmarks accuracy and speed of the screening model per event.
+
+    Returns:
+        tuple: (calibration dict, pd.DataFrame with one row per event)
+    """
+    raw, target, rows = [], [], []
+    for event in events:
+        date_prefix = event["date_prefix"]
+        column_file = COLUMN_FILES_DIR / f"{date_prefix}.column"
+        samples_file = COLUMN_FILES_DIR / f"{date_prefix}.samples"
+        if not (column_file.exists() and samples_file.exists()):
+            print(f"Skipped {date_prefix}: missing .column or .samples file")
+            continue
+        try:
+            met = event_met_profile(event)
+        except FileNotFoundError as e:
+            print(f"Skipped {date_prefix}: {e}")
+            continue
+
+        samples = load_samples_file(samples_file)
+        heights = load_column_file(column_file)
+        n = min(len(samples), len(heights))
+
+        # ---Speed of a screening ensemble of n samples: sampling and integration
+        start = time.perf_counter()
+        sample_batch(event, n)
+        sampling = time.perf_counter() - start
+        start = time.perf_counter()
+        model = screening_heights(event, samples.iloc[:n], calibrated=False, met=met)
+        integration = time.perf_counter() - start
+        elapsed = sampling + integration
+
+        raw.append(model)
+        target.append(heights[:n])
+        rows.append({"code": event["code"], "date_prefix": date_prefix, "n": n,
+                     "sampling_s": sampling, "integration_s": integration,
+                     "seconds": elapsed, "samples_per_s": n / elapsed})
+
+    if not rows:
+        raise ValueError("No stored FPLUME results to calibrate the model")
+
+    x, y = np.concatenate(raw), np.concatenate(target)
+    slope, intercept = np.polyfit(x, y, 1)
+    calibration = {
+        "intercept": float(intercept),
+        "slope": float(slope),
+        "n_events": len(rows),
+        "n_samples": len(x),
+        "rmse": float(np.sqrt(np.mean((intercept + slope * x - y) ** 2))),
+        "r2": float(np.corrcoef(x, y)[0, 1] ** 2),
+    }
+
+    # ---Per-event accuracy of the calibrated model
+    for row, model, heights in zip(rows, raw, target):
+        calibrated = intercept + slope * model
+        row["bias_median"] = np.median(calibrated) - np.median(heights)
+        row["rmse"] = np.sqrt(np.mean((calibrated - heights) ** 2))
+        row["corr"] = np.corrcoef(calibrated, heights)[0, 1]
+
+    with open(CALIBRATION_FILE, "w") as f:
+        json.dump(calibration, f, indent=2)
+    return calibration, pd.DataFrame(rows)
+
+def main():
+    """
+    Parses command-line arguments and runs the screening model or its calibration.
+    """
+    parser = argparse.ArgumentParser(description="Vectorized NumPy plume model for fast screening")
+    parser.add_argument("--code", type=int, help="Process only one event by code")
+    parser.add_argument("--all", action="store_true", help="Process all events")
+    parser.add_argument("--n", type=int, default=CONFIG["n_montecarlo"], help="Number of samples")
+    parser.add_argument("--calibrate", action="store_true",
+                        help="Calibrate and benchmark against stored FPLUME results")
+    args = parser.parse_args()
+
+    if args.all:
+        events = load_events(ERUPTIONS_FILE, code=None)
+    elif args.code:
+        events = [load_events(ERUPTIONS_FILE, code=args.code)]
+    else:
+        raise ValueError("Please specify --code <int> or --all")
+
+    if args.calibrate:
+        calibration, benchmark = calibrate(events)
+        print(benchmark.to_string(index=False))
+        print(f"Calibration: H_fplume = {calibration['intercept']:.1f} + "
+              f"{calibration['slope']:.3f} H_model, RMSE = {calibration['rmse']:.0f} m, "
+              f"R² = {calibration['r2']:.3f}")
+        print(f"Saved calibration to: {CALIBRATION_FILE}")
+        return
+
+    SCREENING_DIR.mkdir(parents=True, exist_ok=True)
+    for event in events:
+        date_prefix = event["date_prefix"]
+        start = time.perf_counter()
+        samples = sample_batch(event, args.n)
+        heights = screening_heights(event, samples)
+        elapsed = time.perf_counter() - start
+
+        np.savetxt(SCREENING_DIR / f"{date_prefix}.column", heights, fmt="%.1f")
+        samples.to_csv(SCREENING_DIR / f"{date_prefix}.samples", sep="\t", index=False,
+                       float_format="%.6g")
+        q1, q50, q99 = np.percentile(heights + event["volcano"].height, [1, 50, 99])
+        print(f"{date_prefix}: {args.n} samples in {elapsed:.2f} s, height a.s.l. "
+              f"median {q50:.0f} m [{q1:.0f} – {q99:.0f}], radar {event['h']} m")
+
+if __name__ == "__main__":
+    main()
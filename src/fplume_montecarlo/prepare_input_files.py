@@ -4,11 +4,14 @@ files into the TMP_MONTECARLO_DIR working directory as:
     -{date_prefix}.met
     -{date_prefix}.tgsd
 
-The .inp file will be created later by run_montecarlo.py.
+The .inp file will be created later by run_montecarlo.py. Events with a missing .met file
+are all reported at the end; the inputs of the other events are prepared anyway.
+pipeline.py runs the same steps without these intermediate copies.
 
 Usage:
     python fplume_montecarlo.prepare_input_files --code <n>
     python fplume_montecarlo.prepare_input_files --all
+    python fplume_montecarlo.prepare_input_files --all --profile     # see profiling.py
 """
 
 # ---Import packaged
@@ -18,8 +21,9 @@ import shutil
 # --- Import directories and utilites
 from fplume_montecarlo.config import ERUPTIONS_FILE, FPLUME_MET_FILES_DIR, TMP_MONTECARLO_DIR, FPLUME_TEMPLATES_DIR
 from fplume_montecarlo.utilities import load_events
+from fplume_montecarlo.profiling import profiled
 
-
+@profiled("prepare_input_files")
 def main():
     """
     Main function to prepare the input directories for FPLUME by copying
@@ -38,9 +42,16 @@ def main():
     else:
         raise ValueError("Please specify --code <int> or --all")
     
+    missing = []
     for event in events:
         date_prefix = event['date_prefix']
 
+        # ---Check if the .met file exists, and keep preparing the other events if not
+        met_file = FPLUME_MET_FILES_DIR / f"{date_prefix}.met"
+        if not met_file.exists():
+            missing.append(date_prefix)
+            continue
+
         # ---Temporary working directory for FPLUME
         dest_dir = TMP_MONTECARLO_DIR
         dest_dir.mkdir(parents=True, exist_ok=True)
@@ -51,13 +62,13 @@ def main():
         shutil.copy(FPLUME_TEMPLATES_DIR / template_tgsd_file, tgsd_file)
 
         # ---Copy the .met file in the working directory
-        met_file = FPLUME_MET_FILES_DIR / f"{date_prefix}.met"
-        if not met_file.exists():
-            # ---Check if the .met file exists
-            print(f"Missing .met file for event {date_prefix}. Please run create_met_file.py")
-            return
         shutil.copy(met_file, dest_dir / met_file.name)
-        print(f"Prepared inputs in {dest_dir}")
+        print(f"Prepared inputs of {date_prefix} in {dest_dir}")
+
+    # ---Report all the events with missing inputs
+    if missing:
+        print(f"Missing .met file for {len(missing)} of {len(events)} events "
+              f"(please run create_met_file.py): {', '.join(missing)}")
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,354 @@
+"""
+Profiling mode of the pipeline steps (--profile on download_era5, create_met_file,
+prepare_input_files, run_montecarlo, pipeline, timeseries_montecarlo, plot_montecarlo and
+qqplot_montecarlo).
+
+Two modes:
+    - sample (default): a background thread samples the Python stack of every thread
+      (main thread and worker pools) every profile_interval seconds (profiling in
+      config.yaml). Stacks waiting for a child process (subprocess module, i.e. FPLUME)
+      end with a "[child process]" frame, so that FPLUME time is separated from Python time.
+      Stacks are written in the folded format ("frame;frame;frame count"), readable by
+      flamegraph.pl, speedscope and inferno, and comparable between runs (--compare);
+    - cprofile: deterministic profile of the main thread (cProfile), saved as .prof
+      (pstats, snakeviz) with a text report of the functions with the largest cumulative time.
+
+In both modes the wall time spent waiting for child processes is also measured directly
+(child_process, summed over all the threads), and a summary row of each profiled stage
+(wall, CPU and child wait time) is appended to PROFILES_DIR/profiles.csv.
+
+Usage:
+    python fplume_montecarlo.run_montecarlo --all --profile
+    python fplume_montecarlo.create_met_file --all --profile=cprofile
+    python fplume_montecarlo.profiling --compare <before.folded> <after.folded>
+    python fplume_montecarlo.profiling --history run_montecarlo
+"""
+
+# ---Import packages
+import argparse
+import atexit
+from collections import Counter
+from contextlib import contextmanager
+import cProfile
+from datetime import datetime
+import functools
+import io
+import os
+from pathlib import Path
+import pstats
+import sys
+import threading
+import time
+
+# ---Import directories and utilities
+from fplume_montecarlo.config import PROJ_ROOT
+from fplume_montecarlo.utilities import load_config
+
+CONFIG = load_config(PROJ_ROOT / "config.yaml")
+
+# ---Output directory of the profiles
+PROFILES_DIR = PROJ_ROOT / "profiles"
+PROFILE_MODES = ("sample", "cprofile")
+
+# ---Wall time spent waiting for child processes, summed over all the threads
+_child_wait = {"seconds": 0.0, "calls": 0}
+_child_lock = threading.Lock()
+
+@contextmanager
+def child_process():
+    """
+    Measures the wall time spent waiting for a child process (e.g. an FPLUME run).
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        with _child_lock:
+            _child_wait["seconds"] += time.perf_counter() - start
+            _child_wait["calls"] += 1
+
+def frame_label(frame):
+    """
+    Label of a stack frame in the folded stacks: module:function.
+    """
+    return f"{Path(frame.f_code.co_filename).stem}:{frame.f_code.co_name}"
+
+def fold_stack(frame, root):
+    """
+    Folded stack (root first) of a frame. Frames below the first frame of the subprocess
+    module are replaced by "[child process]".
+    """
+    frames = []
+    while frame is not None:
+        frames.append(frame)
+        frame = frame.f_back
+    labels = [root]
+    for frame in reversed(frames):
+        if Path(frame.f_code.co_filename).stem == "subprocess":
+            labels.append("[child process]")
+            break
+        labels.append(frame_label(frame))
+    return ";".join(labels)
+
+class SamplingProfiler:
+    """
+    Samples the stacks of all the threads (except its own) at a fixed interval.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.stacks = Counter()
+        self.n_samples = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+
+    def _run(self):
+        own = threading.get_ident()
+        main = threading.main_thread().ident
+        while not self._stop.wait(self.interval):
+            for ident, frame in sys._current_frames().items():
+                if ident != own:
+                    self.stacks[fold_stack(frame, "main" if ident == main else "worker")] += 1
+            self.n_samples += 1
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+class StageProfiler:
+    """
+    Profile of one pipeline stage, in sample or cprofile mode.
+    """
+
+    def __init__(self, stage, mode="sample"):
+        if mode not in PROFILE_MODES:
+            raise ValueError(f"Unknown profile mode '{mode}'. Available: {list(PROFILE_MODES)}")
+        self.stage = stage
+        self.mode = mode
+        self.profiler = None
+
+    def start(self):
+        with _child_lock:
+            _child_wait.update(seconds=0.0, calls=0)
+        if self.mode == "sample":
+            self.profiler = SamplingProfiler(CONFIG["profiling"]["profile_interval"])
+        else:
+            self.profiler = cProfile.Profile()
+        self.wall_start = time.perf_counter()
+        self.cpu_start = time.process_time()
+        if self.mode == "sample":
+            self.profiler.start()
+        else:
+            self.profiler.enable()
+
+    def stop(self):
+        """
+        Stops the profiler and writes the reports.
+
+        Returns:
+            dict: summary row of the stage.
+        """
+        if self.mode == "sample":
+            self.profiler.stop()
+        else:
+            self.profiler.disable()
+        wall = time.perf_counter() - self.wall_start
+        cpu = time.process_time() - self.cpu_start
+
+        PROFILES_DIR.mkdir(parents=True, exist_ok=True)
+        stem = PROFILES_DIR / f"{self.stage}_{datetime.now():%Y%m%d_%H%M%S}"
+        if self.mode == "sample":
+            report = stem.with_suffix(".folded")
+            write_folded(self.profiler.stacks, report)
+            n_samples = self.profiler.n_samples
+            text = top_frames_report(self.profiler.stacks, CONFIG["profiling"]["top"])
+        else:
+            report = stem.with_suffix(".prof")
+            self.profiler.dump_stats(report)
+            n_samples = 0
+            stream = io.StringIO()
+            pstats.Stats(self.profiler, stream=stream).sort_stats("cumulative").print_stats(
+                CONFIG["profiling"]["top"])
+            text = stream.getvalue()
+        with open(stem.with_suffix(".txt"), "w") as f:
+            f.write(text)
+
+        summary = {
+            "timestamp": f"{datetime.now():%Y-%m-%d %H:%M:%S}",
+            "stage": self.stage,
+            "mode": self.mode,
+            "wall_s": round(wall, 3),
+            "cpu_s": round(cpu, 3),
+            "child_wait_s": round(_child_wait["seconds"], 3),
+            "child_calls": _child_wait["calls"],
+            "samples": n_samples,
+            "report": report.name,
+        }
+        append_summary(summary)
+        print(f"Profile of {self.stage}: wall {wall:.2f} s, CPU {cpu:.2f} s, waiting for "
+              f"{summary['child_calls']} child processes {summary['child_wait_s']:.2f} s "
+              f"(summed over threads). Saved to {report}")
+        return summary
+
+def write_folded(stacks, output_file):
+    """
+    Writes the sampled stacks in the folded format of flame graphs.
+    """
+    with open(output_file, "w") as f:
+        f.writelines(f"{stack} {count}\n" for stack, count in sorted(stacks.items()))
+
+def read_folded(folded_file):
+    """
+    Reads a folded stacks file.
+
+    Returns:
+        Counter: {stack: count}
+    """
+    stacks = Counter()
+    with open(folded_file, "r") as f:
+        for line in f:
+            stack, _, count = line.rstrip("\n").rpartition(" ")
+            if stack:
+                stacks[stack] += int(count)
+    return stacks
+
+def frame_shares(stacks):
+    """
+    Inclusive and self share of the samples of every frame.
+
+    Returns:
+        dict: {frame: (inclusive share, self share)}
+    """
+    total = sum(stacks.values()) or 1
+    inclusive, own = Counter(), Counter()
+    for stack, count in stacks.items():
+        frames = stack.split(";")
+        for frame in set(frames[1:]):
+            inclusive[frame] += count
+        own[frames[-1]] += count
+    return {frame: (inclusive[frame] / total, own[frame] / total) for frame in inclusive}
+
+def top_frames_report(stacks, top):
+    """
+    Text report of the frames with the largest inclusive share of the samples.
+    """
+    shares = sorted(frame_shares(stacks).items(), key=lambda item: item[1][0], reverse=True)
+    lines = [f"{'Inclusive':>10} {'Self':>8}  Frame"]
+    for frame, (inclusive, own) in shares[:top]:
+        lines.append(f"{inclusive * 100:>9.1f}% {own * 100:>7.1f}%  {frame}")
+    return "\n".join(lines) + "\n"
+
+def compare_folded(before_file, after_file, top):
+    """
+    Text report of the frames whose inclusive share changed the most between two profiles.
+    """
+    before = frame_shares(read_folded(before_file))
+    after = frame_shares(read_folded(after_file))
+    rows = []
+    for frame in set(before) | set(after):
+        b = before.get(frame, (0.0, 0.0))[0]
+        a = after.get(frame, (0.0, 0.0))[0]
+        rows.append((frame, b, a))
+    rows.sort(key=lambda row: abs(row[2] - row[1]), reverse=True)
+    lines = [f"{'Before':>8} {'After':>8} {'Delta':>8}  Frame"]
+    for frame, b, a in rows[:top]:
+        lines.append(f"{b * 100:>7.1f}% {a * 100:>7.1f}% {(a - b) * 100:>+7.1f}%  {frame}")
+    return "\n".join(lines) + "\n"
+
+def append_summary(summary):
+    """
+    Appends the summary row of a profiled stage to PROFILES_DIR/profiles.csv.
+    """
+    summary_file = PROFILES_DIR / "profiles.csv"
+    write_header = not summary_file.exists()
+    with open(summary_file, "a") as f:
+        if write_header:
+            f.write(",".join(summary) + "\n")
+        f.write(",".join(str(v) for v in summary.values()) + "\n")
+
+@contextmanager
+def profile_stage(stage, mode="sample"):
+    """
+    Profiles the code of a stage (no-op if mode is None).
+    """
+    if mode is None:
+        yield
+        return
+    profiler = StageProfiler(stage, mode)
+    profiler.start()
+    try:
+        yield
+    finally:
+        profiler.stop()
+
+def pop_profile_argument(argv=None):
+    """
+    Removes --profile / --profile=<mode> / --profile <mode> from the command line.
+
+    Returns:
+        str or None: the profile mode, None if --profile is not given.
+    """
+    argv = sys.argv if argv is None else argv
+    for i, arg in enumerate(argv):
+        if arg == "--profile":
+            del argv[i]
+            if i < len(argv) and argv[i] in PROFILE_MODES:
+                return argv.pop(i)
+            return "sample"
+        if arg.startswith("--profile="):
+            del argv[i]
+            return arg.split("=", 1)[1]
+    return None
+
+def profiled(stage):
+    """
+    Decorator of the main function of a pipeline step, adding the --profile option.
+    """
+    def decorator(main):
+        @functools.wraps(main)
+        def wrapper(*args, **kwargs):
+            with profile_stage(stage, pop_profile_argument()):
+                return main(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def profile_script(stage):
+    """
+    Adds the --profile option to a script-style pipeline step (code at module level):
+    profiling starts when called and the reports are written at exit.
+    """
+    mode = pop_profile_argument()
+    if mode is not None:
+        profiler = StageProfiler(stage, mode)
+        profiler.start()
+        atexit.register(profiler.stop)
+
+def main():
+    """
+    Compares two sampled profiles, or prints the profile history of a stage.
+    """
+    parser = argparse.ArgumentParser(description="Compare profiles of the pipeline steps")
+    parser.add_argument("--compare", nargs=2, metavar=("BEFORE", "AFTER"),
+                        help="Two .folded files to compare")
+    parser.add_argument("--history", metavar="STAGE", help="Profile history of a stage")
+    parser.add_argument("--top", type=int, default=CONFIG["profiling"]["top"],
+                        help="Number of frames to report")
+    args = parser.parse_args()
+
+    if args.compare:
+        before, after = (Path(f) if os.path.isabs(f) or Path(f).exists() else PROFILES_DIR / f
+                         for f in args.compare)
+        print(compare_folded(before, after, args.top), end="")
+    elif args.history:
+        import pandas as pd
+
+        history = pd.read_csv(PROFILES_DIR / "profiles.csv")
+        print(history[history["stage"] == args.history].to_string(index=False))
+    else:
+        raise ValueError("Please specify --compare <before> <after> or --history <stage>")
+
+if __name__ == "__main__":
+    main()
@@ -3,14 +3,14 @@ import numpy as np
 import matplotlib.pyplot as plt
 from fplume_montecarlo.config import ERUPTIONS_FILE, COLUMN_FILES_DIR, PLOTS_DIR
 from fplume_montecarlo.utilities import load_events
+from fplume_montecarlo.ensemble_store import open_ensemble, ensemble_ecdf, ensemble_ci
+from fplume_montecarlo.profiling import profile_script
 
+profile_script("qqplot_montecarlo")
 
 # --- Load event metadata
 events = load_events(ERUPTIONS_FILE, code=None)
-event_map = {
-    f"{int(e['year'])}_{int(e['month']):02}_{int(e['day']):02}_{int(e['hour']):02}": e
-    for e in events
-}
+event_map = {e["date_prefix"]: e for e in events}
 
 # --- Read and combine data
 combined_data = []
@@ -24,10 +24,8 @@ for filename in sorted(os.listdir(COLUMN_FILES_DIR)):
             if not event:
                 continue
 
-            file_path = os.path.join(COLUMN_FILES_DIR, filename)
-            with open(file_path, "r") as file:
-                values = [float(val) for line in file for val in line.strip().split()]
-                values = np.array(values) + 3350  # Add Etna height
+            # Memory-mapped heights above the vent and importance sampling weights (ensemble_store.py)
+            ensemble = open_ensemble(COLUMN_FILES_DIR, date_str)
 
             radar_value = event.get("h")
             mer_value = event.get("mer")
@@ -36,7 +34,8 @@ for filename in sorted(os.listdir(COLUMN_FILES_DIR)):
 
             combined_data.append({
                 "mer": mer_value,
-                "values": values,
+                "ensemble": ensemble,
+                "height": event["volcano"].height,
                 "radar_value": radar_value,
             })
 
@@ -45,13 +44,9 @@ for filename in sorted(os.listdir(COLUMN_FILES_DIR)):
 
 # --- Compute ECDF percentiles with radar uncertainty (±300 m)
 for entry in combined_data:
-    values = np.sort(entry['values'])
-    n = len(values)
-    radar = entry['radar_value']
+    radar = entry['radar_value'] - entry['height']     # radar height above the vent
 
-    low = np.searchsorted(values, radar - 300, side='right') / n
-    mid = np.searchsorted(values, radar, side='right') / n
-    high = np.searchsorted(values, radar + 300, side='right') / n
+    low, mid, high = ensemble_ecdf(entry['ensemble'], [radar - 300, radar, radar + 300])
 
     entry.update({
         "ecdf_low": low,
@@ -59,6 +54,18 @@ for entry in combined_data:
         "ecdf_high": high,
     })
 
+# --- Bootstrap 95% confidence intervals of the ECDF percentiles (all events at once)
+bootstrap = ensemble_ci(
+    [e["ensemble"] for e in combined_data],
+    [e["radar_value"] - e["height"] for e in combined_data],
+    n_boot=1000
+)
+for i, entry in enumerate(combined_data):
+    entry.update({
+        "ci_low": bootstrap["ecdf_low"][i, 1],
+        "ci_high": bootstrap["ecdf_high"][i, 1],
+    })
+
 # --- Split data by MER threshold
 threshold = 1e6
 low_mer_group = [e for e in combined_data if e["mer"] < threshold]
@@ -69,23 +76,27 @@ def prepare_qq_data(group):
     percentiles = np.array([e["ecdf_mid"] for e in group])
     low_bounds = np.array([e["ecdf_low"] for e in group])
     high_bounds = np.array([e["ecdf_high"] for e in group])
+    ci_bounds = np.array([[e["ci_low"], e["ci_high"]] for e in group]).reshape(-1, 2)
     sorted_idx = np.argsort(percentiles)
 
     sorted_percentiles = percentiles[sorted_idx]
     sorted_lows = low_bounds[sorted_idx]
     sorted_highs = high_bounds[sorted_idx]
+    sorted_ci = ci_bounds[sorted_idx].T
 
     theoretical_quantiles = np.linspace(0, 1, len(sorted_percentiles), endpoint=False) + 0.5 / len(sorted_percentiles)
 
-    return theoretical_quantiles, sorted_percentiles, sorted_lows, sorted_highs
+    return theoretical_quantiles, sorted_percentiles, sorted_lows, sorted_highs, sorted_ci
 
 # --- Plot QQ plots for both groups
 fig, axs = plt.subplots(1, 2, figsize=(12, 6), sharey=True)
 
 # Plot for low MER
-q_theo_low, p_mid_low, p_lo_low, p_hi_low = prepare_qq_data(low_mer_group)
+q_theo_low, p_mid_low, p_lo_low, p_hi_low, ci_low = prepare_qq_data(low_mer_group)
 axs[0].errorbar(q_theo_low, p_mid_low, yerr=[p_mid_low - p_lo_low, p_hi_low - p_mid_low],
                 fmt='o', capsize=4, color='blue', markersize=4, label="Low MER")
+axs[0].errorbar(q_theo_low, p_mid_low, yerr=[p_mid_low - ci_low[0], ci_low[1] - p_mid_low],
+                fmt='none', capsize=2, elinewidth=2, ecolor='black', label="95% CI (bootstrap)")
 axs[0].plot([0, 1], [0, 1], 'r--', label="1:1 line")
 axs[0].set_title("QQ Plot - MER < 8e5", fontsize=13)
 axs[0].set_xlabel("Theoretical Quantiles", fontsize=12)
@@ -94,9 +105,11 @@ axs[0].grid(True)
 axs[0].legend()
 
 # Plot for high MER
-q_theo_high, p_mid_high, p_lo_high, p_hi_high = prepare_qq_data(high_mer_group)
+q_theo_high, p_mid_high, p_lo_high, p_hi_high, ci_high = prepare_qq_data(high_mer_group)
 axs[1].errorbar(q_theo_high, p_mid_high, yerr=[p_mid_high - p_lo_high, p_hi_high - p_mid_high],
                 fmt='o', capsize=4, color='green', markersize=4, label="High MER")
+axs[1].errorbar(q_theo_high, p_mid_high, yerr=[p_mid_high - ci_high[0], ci_high[1] - p_mid_high],
+                fmt='none', capsize=2, elinewidth=2, ecolor='black', label="95% CI (bootstrap)")
 axs[1].plot([0, 1], [0, 1], 'r--', label="1:1 line")
 axs[1].set_title("QQ Plot - MER ≥ 8e5", fontsize=13)
 axs[1].set_xlabel("Theoretical Quantiles", fontsize=12)
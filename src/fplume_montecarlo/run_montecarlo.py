@@ -2,22 +2,36 @@
 Runs FPLUME for a number of steps defined by n_montecarlo to simulate 
 the volcanic column height.
 
-Generates a .column file containing the distribution of simulated column heights.
+Generates a .column file containing the distribution of simulated column heights,
+and a .samples file with the perturbed input parameters of each run (same line order).
+
+With --workers <n>, the runs of all the events are split into chunks and scheduled
+longest-expected-first over a pool of n FPLUME workers (see scheduler.py).
 
 Usage:
     python fplume_montecarlo.run_montecarlo --code <n>
     python fplume_montecarlo.run_montecarlo --all
+    python fplume_montecarlo.run_montecarlo --all --importance
+    python fplume_montecarlo.run_montecarlo --all --workers 8
+    python fplume_montecarlo.run_montecarlo --all --profile         # see profiling.py
 """
 
 # ---Import packages
 import subprocess
 import argparse
 import shutil
+import time
+import numpy as np
+import pandas as pd
 
 # ---Import directories and utilities
-from fplume_montecarlo.generate_inp_file import generate_inp_file
+from fplume_montecarlo.generate_inp_file import (
+    generate_inp_file, sample_parameters, design_proposal, importance_weight
+)
 from fplume_montecarlo.config import PROJ_ROOT, ERUPTIONS_FILE, FPLUME_EXE_DIR, TMP_MONTECARLO_DIR, TEMPLATE_FILE, COLUMN_FILES_DIR
 from fplume_montecarlo.utilities import load_events, load_config
+from fplume_montecarlo.profiling import profiled, child_process
+from fplume_montecarlo.ensemble_store import EnsembleWriter, export_column_file
 
 CONFIG = load_config(PROJ_ROOT / "config.yaml")
 
@@ -25,10 +39,182 @@ CONFIG = load_config(PROJ_ROOT / "config.yaml")
 
 n_montecarlo = CONFIG["n_montecarlo"]
 
+
 # ---FPLUME executable file
 FPLUME_EXE = FPLUME_EXE_DIR / "fplume"
 
-def run_fplume(event):
+def write_samples_row(samples_file, sampled_params):
+    """
+    Appends the sampled input parameters of one FPLUME run to the .samples file,
+    writing the tab-separated header with the parameter names on first use.
+    """
+    write_header = not samples_file.exists()
+    with open(samples_file, "a") as f:
+        if write_header:
+            f.write("\t".join(sampled_params.keys()) + "\n")
+        f.write("\t".join(f"{v:.6g}" for v in sampled_params.values()) + "\n")
+
+def write_samples_rows(samples_file, rows):
+    """
+    Appends the sampled input parameters of several FPLUME runs to the .samples file at once.
+    """
+    if not rows:
+        return
+    write_header = not samples_file.exists()
+    with open(samples_file, "a") as f:
+        if write_header:
+            f.write("\t".join(rows[0].keys()) + "\n")
+        f.writelines("\t".join(f"{v:.6g}" for v in sampled_params.values()) + "\n"
+                     for sampled_params in rows)
+
+def run_fplume_exe(date_prefix, work_dir):
+    """
+    Runs the FPLUME executable on the {date_prefix}.inp/.met/.tgsd files already present in
+    work_dir (a subdirectory of FPLUME_EXE_DIR).
+
+    Returns:
+        Path: the .res result file written by FPLUME.
+    """
+    # ---Run FPLUME
+    a = 'fplume'
+    b = f'{work_dir.name}/{date_prefix}'
+    with child_process():
+        subprocess.run([str(a), str(b)],check=True,cwd=str(FPLUME_EXE_DIR))
+
+    # ---Result file containing the outputs of the FPLUME run
+    result_file = work_dir / f"{date_prefix}.01.res"
+    if not result_file.exists():
+        raise FileNotFoundError(f"{result_file} not found")
+    return result_file
+
+def read_column_height(result_file):
+    """
+    Retrieves the column height from the last line of a FPLUME result file.
+
+    Returns:
+        str or None: column height (m above the vent), None if the result file is empty.
+    """
+    with open(result_file, "r") as f:
+        lines = f.readlines()
+    if lines:
+        return lines[-1].split()[0]
+    return None
+
+def stage_inputs(date_prefix, source_dir, work_dir, tgsd_template=None):
+    """
+    Copies the .met and .tgsd files of an event from source_dir to the FPLUME working
+    directory work_dir, unless they are already staged there. If tgsd_template is given,
+    the .tgsd file is copied from this template instead.
+    """
+    work_dir.mkdir(parents=True, exist_ok=True)
+    for suffix in (".met", ".tgsd"):
+        staged = work_dir / f"{date_prefix}{suffix}"
+        if not staged.exists():
+            source = tgsd_template if suffix == ".tgsd" and tgsd_template else source_dir / staged.name
+            shutil.copy(source, staged)
+
+def execute_fplume(event, sampled_params, output_dir, target_path):
+    """
+    Writes the .inp file for the given input parameters directly in the working directory
+    target_path (where the .met and .tgsd files of output_dir are staged on first use) and
+    runs FPLUME once.
+
+    Returns:
+        Path: the .res result file written by FPLUME.
+    """
+    date_prefix = event["date_prefix"]
+    stage_inputs(date_prefix, output_dir, target_path)
+
+    # ---Generate input file
+    generate_inp_file(
+        event["year"], event["month"], event["day"], event["hour"],
+        event["mer"], event["exit_v"],
+        TEMPLATE_FILE,
+        target_path,
+        sampled_params=sampled_params,
+        volcano=event["volcano"]
+    )
+
+    return run_fplume_exe(date_prefix, target_path)
+
+def run_single(event, sampled_params, output_dir, target_path):
+    """
+    Runs FPLUME once for the given sampled input parameters.
+
+    Returns:
+        str or None: column height (m above the vent) as written by FPLUME, None if the
+        result file is empty.
+    """
+    result_file = execute_fplume(event, sampled_params, output_dir, target_path)
+    return read_column_height(result_file)
+
+def run_pilot(event, n_pilot, output_dir, target_path):
+    """
+    Runs a small plain Monte Carlo ensemble, used to design the importance sampling proposal.
+
+    Returns:
+        tuple: (pd.DataFrame of sampled parameters, np.ndarray of column heights)
+    """
+    date_prefix = event["date_prefix"]
+    samples, heights = [], []
+    for i in range(1, n_pilot + 1):
+        print(f"  Pilot iteration {i} of {n_pilot} for {date_prefix}")
+        sampled_params = sample_parameters(event["mer"], event["exit_v"])
+        height = run_single(event, sampled_params, output_dir, target_path)
+        if height is not None:
+            samples.append(sampled_params)
+            heights.append(float(height))
+    return pd.DataFrame(samples), np.array(heights)
+
+def design_importance_proposal(event, output_dir, target_path):
+    """
+    Designs the importance sampling proposal of an event from a pilot run (n_pilot in
+    config.yaml, with FPLUME or with the screening model of plume_model.py).
+
+    Returns:
+        dict: proposal as returned by design_proposal.
+    """
+    settings = CONFIG["importance_sampling"]
+    if settings.get("pilot_engine", "fplume") == "numpy":
+        # ---Pilot run with the in-process screening model (no FPLUME runs)
+        from fplume_montecarlo.plume_model import sample_batch, screening_heights
+
+        pilot_samples = sample_batch(event, settings["n_pilot"])
+        pilot_heights = screening_heights(event, pilot_samples)
+    else:
+        pilot_samples, pilot_heights = run_pilot(event, settings["n_pilot"], output_dir, target_path)
+    target_height = event["h"] - event["volcano"].height                # radar height above the vent
+    proposal = design_proposal(
+        pilot_samples, pilot_heights, target_height, event["mer"], event["exit_v"],
+        defensive_fraction=settings["defensive_fraction"]
+    )
+    print(f"  Importance sampling proposal for {event['date_prefix']}: {proposal['shift']}")
+    return proposal
+
+def clean_working_dirs(date_prefix, target_path, inputs=True):
+    """
+    Removes the files of an event from the FPLUME working directory and, if inputs is True,
+    from the temporary directory of the inputs (TMP_MONTECARLO_DIR).
+    """
+    # Clean only files/directories starting with date_prefix inside target_path
+    for item in target_path.iterdir():
+        if item.name.startswith(date_prefix):
+            if item.is_dir():
+                shutil.rmtree(item)
+            else:
+                item.unlink()
+
+    # Similarly, clean only matching files/directories in TMP_MONTECARLO_DIR
+    if not inputs:
+        return
+    for item in TMP_MONTECARLO_DIR.iterdir():
+        if item.name.startswith(date_prefix):
+            if item.is_dir():
+                shutil.rmtree(item)
+            else:
+                item.unlink()
+
+def run_fplume(event, importance=False, results_dir=COLUMN_FILES_DIR):
     """
     Runs the FPLUME executable for a single eruption event using Monte Carlo sampling.
 
@@ -37,72 +223,78 @@ def run_fplume(event):
         - .met file: meteorological profile at the Etna location.
         - .tgsd file: particle size distribution (PSD) for a typical eruption.
         - .inp file: initial volcanic conditions (perturbed for each Monte Carlo iteration).
+
+    If importance is True, a pilot run (n_pilot in config.yaml, with FPLUME or with the
+    screening model of plume_model.py) is used to shift the sampling distribution toward the
+    radar column height, and the likelihood-ratio weight of each run is stored in the
+    "weight" column of the .samples file.
+
+    The heights (and weights) of the runs are stored in preallocated .npy arrays in results_dir
+    (COLUMN_FILES_DIR by default), flushed every chunk_size runs (aggregation in config.yaml,
+    see ensemble_store.py), and the .column and .samples files are written next to them.
     """ 
 
     date_prefix = event["date_prefix"]
     output_dir = TMP_MONTECARLO_DIR
+    target_path = FPLUME_EXE_DIR / "tmp_montecarlo"
+    chunk_size = CONFIG["aggregation"]["chunk_size"]
 
-    # ---Initialize .column file
-    column_file = output_dir / f"{date_prefix}.column"
-    column_file.unlink(missing_ok=True)  # Remove if it exists
+    # ---Initialize .samples file (sampled input parameters, one row per .column line)
+    samples_file = output_dir / f"{date_prefix}.samples"
+    samples_file.unlink(missing_ok=True)
 
+    # ---Stage the current .met and .tgsd files in the working directory
+    if target_path.exists():
+        clean_working_dirs(date_prefix, target_path, inputs=False)
+    stage_inputs(date_prefix, output_dir, target_path)
+
+    # ---Design the importance sampling proposal from a pilot run
+    proposal = design_importance_proposal(event, output_dir, target_path) if importance else None
+
+    # ---Preallocated heights (and weights) of all the runs
+    results_dir.mkdir(parents=True, exist_ok=True)
+    writer = EnsembleWriter(results_dir, date_prefix, n_montecarlo, weighted=proposal is not None,
+                            chunk_size=chunk_size)
+    samples_rows = []
+    n_valid = 0
+
+    start = time.perf_counter()
     for i in range(1, n_montecarlo +1):
         print(f"  Iteration {i} of {n_montecarlo} for {date_prefix}")
 
-        # ---Generate randomized input file
-        inp_path = generate_inp_file(
-            event["year"], event["month"], event["day"], event["hour"],
-            event["mer"], event["exit_v"],
-            TEMPLATE_FILE,
-            output_dir
-        )
-        
-        target_path = FPLUME_EXE_DIR / "tmp_montecarlo"
-        target_path.mkdir(parents=True, exist_ok=True)
-
-        # ---Copy .met, .tgsd, .inp files in the working directory
-        for item in output_dir.iterdir():
-            if item.is_file():
-                shutil.copy(item, target_path)
-
-
-        # ---Run FPLUME
-        a = 'fplume'
-        b = f'tmp_montecarlo/{date_prefix}'
-        subprocess.run([str(a), str(b)],check=True,cwd=str(FPLUME_EXE_DIR))
+        # ---Sample perturbed input parameters and run FPLUME
+        sampled_params = sample_parameters(event["mer"], event["exit_v"], proposal=proposal)
+        last_val = run_single(event, sampled_params, output_dir, target_path)
 
-        # ---Read result file containing the outputs of the FPLUME run and retrieve the column height
-        result_file = target_path / f"{date_prefix}.01.res"
-        if not result_file.exists():
-            raise FileNotFoundError(f"{result_file} not found")
-
-        with open(result_file, "r") as f:
-            lines = f.readlines()
-        if lines:
-            last_val = lines[-1].split()[0]
-            with open(column_file, "a") as col_f:
-                col_f.write(last_val + "\n")
-
-        # ---Clear working directories        
-        if i == n_montecarlo:
-            shutil.copy(column_file, COLUMN_FILES_DIR)
-
-            # Clean only files/directories starting with date_prefix inside target_path
-            for item in target_path.iterdir():
-                if item.name.startswith(date_prefix):
-                    if item.is_dir():
-                        shutil.rmtree(item)
-                    else:
-                        item.unlink()
-
-            # Similarly, clean only matching files/directories in TMP_MONTECARLO_DIR
-            for item in TMP_MONTECARLO_DIR.iterdir():
-                if item.name.startswith(date_prefix):
-                    if item.is_dir():
-                        shutil.rmtree(item)
-                    else:
-                        item.unlink()
+        if last_val is not None:
+            n_valid += 1
+            if proposal is not None:
+                sampled_params["weight"] = importance_weight(
+                    sampled_params, event["mer"], event["exit_v"], proposal
+                )
+            samples_rows.append(sampled_params)
+        writer.append(last_val, sampled_params.get("weight", 1.0))
 
+        # ---Flush the samples with the heights, every chunk_size runs
+        if i % chunk_size == 0:
+            write_samples_rows(samples_file, samples_rows)
+            samples_rows = []
+
+    write_samples_rows(samples_file, samples_rows)
+    writer.close()
+
+    # ---Runtime history, used by the scheduler (run_montecarlo --workers): per valid run,
+    # as the scheduler records it
+    from fplume_montecarlo.scheduler import record_runtime
+
+    record_runtime(event, n_valid, time.perf_counter() - start)
+
+    # ---Store results and clear working directories
+    export_column_file(results_dir, date_prefix, results_dir / f"{date_prefix}.column")
+    shutil.copy(samples_file, results_dir)
+    clean_working_dirs(date_prefix, target_path)
+
+@profiled("run_montecarlo")
 def main():
     """
     Parses command-line arguments and runs FPLUME for specified eruption events.
@@ -110,6 +302,10 @@ def main():
     parser = argparse.ArgumentParser(description="Prepare FPLUME input folders")
     parser.add_argument("--code", type=int, help="Process only one event by code")
     parser.add_argument("--all", action="store_true", help="Process all events")
+    parser.add_argument("--importance", action="store_true",
+                        help="Importance sampling toward the radar column height")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of FPLUME workers of the runtime-aware scheduler")
     args = parser.parse_args()
 
     if args.all:
@@ -118,11 +314,17 @@ def main():
         events = [load_events(ERUPTIONS_FILE, code=args.code)]
     else:
         raise ValueError("Please specify --code <int>")
+
+    if args.workers > 1:
+        from fplume_montecarlo.scheduler import run_campaign
+
+        run_campaign(events, args.workers, importance=args.importance)
+        return
     
     for event in events:
         date_prefix = event['date_prefix']
         print(f"Processing event {date_prefix}")
-        run_fplume(event)
+        run_fplume(event, importance=args.importance)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,259 @@
+"""
+Runs several named configurations (scenarios in config.yaml) of the Monte Carlo simulation
+for each eruption event in one campaign, and compares them with paired differences.
+
+Each scenario overrides parameters_montecarlo (e.g. different means or stds) and optionally
+the .tgsd template. For each event:
+    - the .met file is staged once in the FPLUME working directory of the sweep, and the
+      .tgsd file is staged again only for the scenarios overriding the .tgsd template;
+    - the same uniform draws are used by all scenarios (common random numbers), mapped to
+      the parameters of each scenario through the inverse CDF, so that the runs of two
+      scenarios are paired and their differences are much less noisy than with independent
+      draws;
+    - paired-difference statistics of the column height are computed for each scenario pair.
+
+Outputs are saved in COLUMN_FILES_DIR/scenarios:
+    - {date_prefix}.{scenario}.column and {date_prefix}.{scenario}.samples
+    - scenario_differences.csv
+
+Requires the .met files created by create_met_file.py.
+
+Usage:
+    python fplume_montecarlo.scenario_sweep --code <n>
+    python fplume_montecarlo.scenario_sweep --all
+    python fplume_montecarlo.scenario_sweep --all --scenarios baseline weak_umbrella --n 2000
+"""
+
+# ---Import packages
+import argparse
+import copy
+from itertools import combinations
+
+import numpy as np
+import pandas as pd
+
+# ---Import directories and utilities
+from fplume_montecarlo.config import (
+    COLUMN_FILES_DIR,
+    ERUPTIONS_FILE,
+    FPLUME_EXE_DIR,
+    FPLUME_MET_FILES_DIR,
+    FPLUME_TEMPLATES_DIR,
+    PROJ_ROOT,
+    TEMPLATE_FILE,
+)
+from fplume_montecarlo.generate_inp_file import generate_inp_file, transform_uniforms
+from fplume_montecarlo.run_montecarlo import (
+    clean_working_dirs,
+    read_column_height,
+    run_fplume_exe,
+    stage_inputs,
+    write_samples_row,
+)
+from fplume_montecarlo.utilities import load_config, load_events
+
+CONFIG = load_config(PROJ_ROOT / "config.yaml")
+
+# ---Output directory of the scenario sweep
+SCENARIOS_DIR = COLUMN_FILES_DIR / "scenarios"
+
+# ---FPLUME working directory of the scenario sweep
+WORK_DIR = FPLUME_EXE_DIR / "tmp_scenarios"
+
+def scenario_settings(name):
+    """
+    Merges the overrides of a scenario into the default settings of config.yaml.
+
+    Returns:
+        tuple: (parameters_montecarlo dict of the scenario, Path of its .tgsd template)
+    """
+    overrides = CONFIG["scenarios"][name] or {}
+
+    param_montecarlo = copy.deepcopy(CONFIG["parameters_montecarlo"])
+    for param, values in (overrides.get("parameters_montecarlo") or {}).items():
+        if param not in param_montecarlo:
+            raise ValueError(f"Unknown parameter '{param}' in scenario '{name}'")
+        param_montecarlo[param].update(values)
+
+    tgsd_template = FPLUME_TEMPLATES_DIR / overrides.get("tgsd_template", "template_fplume.tgsd")
+    return param_montecarlo, tgsd_template
+
+def run_scenario(event, name, uniforms):
+    """
+    Runs FPLUME for one scenario of an event, using the given uniform draws. The inputs
+    of the event must be staged in WORK_DIR (run_event).
+
+    Parameters:
+        event (dict): eruption event.
+        name (str): scenario name.
+        uniforms (np.ndarray): uniform draws, shape (n runs, n parameters).
+
+    Returns:
+        np.ndarray: column heights (m above the vent), NaN for runs without result.
+    """
+    date_prefix = event["date_prefix"]
+    param_montecarlo, _ = scenario_settings(name)
+
+    SCENARIOS_DIR.mkdir(parents=True, exist_ok=True)
+    column_file = SCENARIOS_DIR / f"{date_prefix}.{name}.column"
+    samples_file = SCENARIOS_DIR / f"{date_prefix}.{name}.samples"
+    column_file.unlink(missing_ok=True)
+    samples_file.unlink(missing_ok=True)
+
+    heights = np.full(len(uniforms), np.nan)
+    for i, u in enumerate(uniforms):
+        print(f"  Scenario {name}: iteration {i + 1} of {len(uniforms)} for {date_prefix}")
+
+        # ---Map the common uniform draws to the parameters of the scenario
+        sampled_params = transform_uniforms(u, event["mer"], event["exit_v"], param_montecarlo)
+        generate_inp_file(
+            event["year"], event["month"], event["day"], event["hour"],
+            event["mer"], event["exit_v"],
+            TEMPLATE_FILE,
+            WORK_DIR,
+            sampled_params=sampled_params,
+            volcano=event["volcano"]
+        )
+
+        # ---Run FPLUME
+        height = read_column_height(run_fplume_exe(date_prefix, WORK_DIR))
+        last_val = height if height is not None else "nan"
+        heights[i] = float(last_val)
+
+        # ---One line per run, so that the runs of different scenarios stay paired
+        with open(column_file, "a") as col_f:
+            col_f.write(last_val + "\n")
+        write_samples_row(samples_file, sampled_params)
+
+    return heights
+
+def run_event(event, names, uniforms):
+    """
+    Runs all the scenarios of an event with the same uniform draws. The .met file is
+    staged once, and the .tgsd file again only when the template of a scenario differs
+    from the staged one.
+
+    Returns:
+        dict: {scenario: np.ndarray of column heights above the vent}
+    """
+    date_prefix = event["date_prefix"]
+    if not (FPLUME_MET_FILES_DIR / f"{date_prefix}.met").exists():
+        raise FileNotFoundError(f"Missing .met file for event {date_prefix}. "
+                                f"Please run create_met_file.py")
+    if WORK_DIR.exists():
+        clean_working_dirs(date_prefix, WORK_DIR, inputs=False)
+
+    results = {}
+    staged_tgsd = None
+    for name in names:
+        _, tgsd_template = scenario_settings(name)
+        if tgsd_template != staged_tgsd:
+            (WORK_DIR / f"{date_prefix}.tgsd").unlink(missing_ok=True)
+            stage_inputs(date_prefix, FPLUME_MET_FILES_DIR, WORK_DIR, tgsd_template=tgsd_template)
+            staged_tgsd = tgsd_template
+        results[name] = run_scenario(event, name, uniforms)
+
+    # ---Clean the working directory of the sweep
+    clean_working_dirs(date_prefix, WORK_DIR, inputs=False)
+    return results
+
+def paired_differences(event, results, radar_sigma=300):
+    """
+    Computes paired-difference statistics of the column height for each scenario pair.
+
+    Parameters:
+        event (dict): eruption event.
+        results (dict): {scenario: np.ndarray of column heights above the vent}, paired by run.
+        radar_sigma (float): radar height uncertainty (m), only used to report the ECDF
+            difference at h ± radar_sigma.
+
+    Returns:
+        pd.DataFrame: one row per scenario pair (a, b) with statistics of a - b.
+    """
+    radar = event["h"] - event["volcano"].height
+    rows = []
+    for a, b in combinations(results, 2):
+        ya, yb = results[a], results[b]
+        valid = ~(np.isnan(ya) | np.isnan(yb))
+        ya, yb = ya[valid], yb[valid]
+        n = len(ya)
+        if n < 2:
+            continue
+        diff = ya - yb
+
+        se = diff.std(ddof=1) / np.sqrt(n)
+        var_independent = ya.var(ddof=1) + yb.var(ddof=1)
+        ecdf_diff = (ya <= radar).astype(float) - (yb <= radar).astype(float)
+        pa, pb = np.percentile(ya, [1, 50, 99]), np.percentile(yb, [1, 50, 99])
+
+        rows.append({
+            "code": event["code"],
+            "date_prefix": event["date_prefix"],
+            "scenario_a": a,
+            "scenario_b": b,
+            "n_pairs": n,
+            "mean_diff": diff.mean(),
+            "se_diff": se,
+            "ci95_low": diff.mean() - 1.96 * se,
+            "ci95_high": diff.mean() + 1.96 * se,
+            "correlation": np.corrcoef(ya, yb)[0, 1],
+            "variance_reduction": var_independent / diff.var(ddof=1) if diff.var() > 0 else np.inf,
+            "p1_diff": pa[0] - pb[0],
+            "p50_diff": pa[1] - pb[1],
+            "p99_diff": pa[2] - pb[2],
+            "ecdf_radar_diff": ecdf_diff.mean(),
+            "ecdf_radar_se": ecdf_diff.std(ddof=1) / np.sqrt(n),
+            "ecdf_radar_low_diff": np.mean(ya <= radar - radar_sigma) - np.mean(yb <= radar - radar_sigma),
+            "ecdf_radar_high_diff": np.mean(ya <= radar + radar_sigma) - np.mean(yb <= radar + radar_sigma),
+        })
+    return pd.DataFrame(rows)
+
+def main():
+    """
+    Parses command-line arguments and runs the scenario sweep for the selected events.
+    """
+    parser = argparse.ArgumentParser(description="Scenario sweep with common random numbers")
+    parser.add_argument("--code", type=int, help="Process only one event by code")
+    parser.add_argument("--all", action="store_true", help="Process all events")
+    parser.add_argument("--scenarios", nargs="+", default=None,
+                        help="Scenarios to run (default: all scenarios in config.yaml)")
+    parser.add_argument("--n", type=int, default=CONFIG["n_montecarlo"],
+                        help="Number of runs per scenario")
+    parser.add_argument("--seed", type=int, default=None, help="Seed of the common random numbers")
+    args = parser.parse_args()
+
+    if args.all:
+        events = load_events(ERUPTIONS_FILE, code=None)
+    elif args.code:
+        events = [load_events(ERUPTIONS_FILE, code=args.code)]
+    else:
+        raise ValueError("Please specify --code <int> or --all")
+
+    names = args.scenarios or list(CONFIG["scenarios"])
+    for name in names:
+        if name not in CONFIG["scenarios"]:
+            raise ValueError(f"Unknown scenario '{name}'. Available: {list(CONFIG['scenarios'])}")
+
+    rng = np.random.default_rng(args.seed)
+    n_params = len(CONFIG["parameters_montecarlo"])
+
+    differences = []
+    for event in events:
+        print(f"Processing event {event['date_prefix']}")
+
+        # ---Common random numbers shared by all the scenarios of the event
+        uniforms = rng.random((args.n, n_params))
+        results = run_event(event, names, uniforms)
+
+        diff = paired_differences(event, results)
+        if not diff.empty:
+            print(diff[["scenario_a", "scenario_b", "mean_diff", "ci95_low", "ci95_high",
+                        "variance_reduction"]].to_string(index=False))
+        differences.append(diff)
+
+    output_file = SCENARIOS_DIR / "scenario_differences.csv"
+    pd.concat(differences, ignore_index=True).to_csv(output_file, index=False)
+    print(f"Saved paired differences to: {output_file}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,374 @@
+"""
+Runtime-aware scheduler of Monte Carlo campaigns over a shared pool of FPLUME workers
+(run_montecarlo --workers <n>).
+
+FPLUME runtime differs a lot between events (high-MER plumes integrate further), so running
+the events in catalog order often leaves one slow event running alone at the end of a
+campaign. Instead:
+    - the runtime per run of each event is taken from the runtime history
+      (PROCESSED_DATA_DIR/runtime_history.csv, updated after every event), or predicted
+      from MER and exit velocity with a log-linear fit of the history;
+    - the runs of all the events are split into chunks of chunk_size runs (scheduler in
+      config.yaml), handed out longest-expected-first to the worker pool;
+    - each worker has its own scratch directory in FPLUME_EXE_DIR, where the .met and .tgsd
+      files of an event are staged once;
+    - the projected completion time of the campaign is reported after every chunk, scaling
+      the remaining expected work by the observed wall time per unit of expected work.
+
+The heights (and weights) of every chunk are written by the worker to its slice of the
+preallocated memory-mapped arrays of the event in COLUMN_FILES_DIR (ensemble_store.py), and
+the sampled parameters to a file per chunk; the .column and .samples files of an event are
+written, in chunk order, when all its chunks are complete.
+
+Requires the inputs prepared by prepare_input_files.py, or the in-memory inputs of
+pipeline.py (met profiles handed over as DataFrames and written once, into the worker
+scratch directories).
+"""
+
+# ---Import packages
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+import queue
+import shutil
+import subprocess
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+# ---Import directories and utilities
+from fplume_montecarlo.config import (
+    COLUMN_FILES_DIR,
+    FPLUME_EXE_DIR,
+    PROCESSED_DATA_DIR,
+    PROJ_ROOT,
+    TEMPLATE_FILE,
+    TMP_MONTECARLO_DIR,
+)
+from fplume_montecarlo.ensemble_store import EnsembleWriter, export_column_file
+from fplume_montecarlo.generate_inp_file import (
+    generate_inp_file,
+    importance_weight,
+    sample_parameters,
+)
+from fplume_montecarlo.run_montecarlo import (
+    clean_working_dirs,
+    design_importance_proposal,
+    n_montecarlo,
+    read_column_height,
+    run_fplume_exe,
+    write_samples_rows,
+)
+from fplume_montecarlo.utilities import load_config
+
+CONFIG = load_config(PROJ_ROOT / "config.yaml")
+
+# ---Runtime of the past Monte Carlo runs
+RUNTIME_HISTORY_FILE = PROCESSED_DATA_DIR / "runtime_history.csv"
+
+def load_runtime_history():
+    """
+    Reads the runtime history (one row per completed event).
+
+    Returns:
+        pd.DataFrame: columns date_prefix, mer, exit_v, n_runs, seconds_per_run.
+    """
+    if not RUNTIME_HISTORY_FILE.exists():
+        return pd.DataFrame(columns=["date_prefix", "mer", "exit_v", "n_runs", "seconds_per_run"])
+    return pd.read_csv(RUNTIME_HISTORY_FILE)
+
+def record_runtime(event, n_runs, seconds):
+    """
+    Appends the runtime of a completed event (worker-seconds over n_runs) to the history.
+    """
+    if n_runs == 0:
+        return
+    write_header = not RUNTIME_HISTORY_FILE.exists()
+    RUNTIME_HISTORY_FILE.parent.mkdir(parents=True, exist_ok=True)
+    with open(RUNTIME_HISTORY_FILE, "a") as f:
+        if write_header:
+            f.write("date_prefix,mer,exit_v,n_runs,seconds_per_run\n")
+        f.write(f"{event['date_prefix']},{event['mer']},{event['exit_v']},{n_runs},{seconds / n_runs:.4f}\n")
+
+def expected_seconds_per_run(events, history=None):
+    """
+    Expected runtime per FPLUME run of each event: the latest runtime of the event in the
+    history, otherwise a fit of log(seconds per run) on log10(MER) and exit velocity (at
+    least 3 events in the history), otherwise default_seconds_per_run.
+
+    Returns:
+        dict: {date_prefix: seconds per run}
+    """
+    history = load_runtime_history() if history is None else history
+    default = CONFIG["scheduler"]["default_seconds_per_run"]
+
+    latest = history.groupby("date_prefix")["seconds_per_run"].last().to_dict()
+    fit = None
+    if history["date_prefix"].nunique() >= 3:
+        A = np.column_stack([np.ones(len(history)), np.log10(history["mer"].astype(float)),
+                             history["exit_v"].astype(float)])
+        fit, *_ = np.linalg.lstsq(A, np.log(history["seconds_per_run"].astype(float)), rcond=None)
+
+    expected = {}
+    for event in events:
+        if event["date_prefix"] in latest:
+            expected[event["date_prefix"]] = latest[event["date_prefix"]]
+        elif fit is not None:
+            expected[event["date_prefix"]] = float(np.exp(
+                fit[0] + fit[1] * np.log10(event["mer"]) + fit[2] * event["exit_v"]))
+        else:
+            expected[event["date_prefix"]] = default
+    return expected
+
+def make_chunks(events, expected, n_runs, chunk_size):
+    """
+    Splits the runs of every event into chunks, sorted longest-expected-first.
+
+    Returns:
+        list[dict]: chunks with keys event, index, start (first run), n and expected (seconds).
+    """
+    chunks = []
+    for event in events:
+        for index, start in enumerate(range(0, n_runs, chunk_size)):
+            n = min(chunk_size, n_runs - start)
+            chunks.append({"event": event, "index": index, "start": start, "n": n,
+                           "expected": n * expected[event["date_prefix"]]})
+    return sorted(chunks, key=lambda c: c["expected"], reverse=True)
+
+def prepared_inputs(date_prefix):
+    """
+    Inputs of an event prepared by prepare_input_files.py in TMP_MONTECARLO_DIR.
+
+    Returns:
+        dict: {"met": Path, "tgsd": Path}, or None if the .met file is missing.
+    """
+    met_file = TMP_MONTECARLO_DIR / f"{date_prefix}.met"
+    if not met_file.exists():
+        return None
+    return {"met": met_file, "tgsd": TMP_MONTECARLO_DIR / f"{date_prefix}.tgsd"}
+
+def stage_event(date_prefix, work_dir, event_inputs):
+    """
+    Writes the .met and .tgsd files of an event in a worker scratch directory. Each input
+    is either a file, copied, or the met profile as a DataFrame, written with save_to_txt.
+    """
+    work_dir.mkdir(parents=True, exist_ok=True)
+    for suffix in (".met", ".tgsd"):
+        source = event_inputs[suffix[1:]]
+        target = work_dir / f"{date_prefix}{suffix}"
+        if isinstance(source, pd.DataFrame):
+            from fplume_montecarlo.create_met_file import save_to_txt
+
+            save_to_txt(source, target)
+        else:
+            if not source.exists():
+                raise FileNotFoundError(f"Missing {source.name}. Please run prepare_input_files.py")
+            shutil.copy(source, target)
+
+def chunk_samples_file(date_prefix, index):
+    """
+    File of the sampled parameters of the runs with a result of a chunk.
+    """
+    return TMP_MONTECARLO_DIR / f"{date_prefix}_chunks" / f"{index}.samples"
+
+def run_chunk(chunk, work_dir, proposal=None):
+    """
+    Runs the FPLUME runs of a chunk in a worker scratch directory. The sampled parameters
+    of the runs with a result are written to chunk_samples_file. A failed FPLUME run
+    (non-zero exit code or missing result file) gets a NaN height and no samples row, and
+    the chunk goes on.
+
+    Returns:
+        tuple: (np.ndarray of heights, NaN for failed runs, np.ndarray of weights,
+                number of failed FPLUME runs)
+    """
+    event = chunk["event"]
+    date_prefix = event["date_prefix"]
+    heights = np.full(chunk["n"], np.nan)
+    weights = np.ones(chunk["n"])
+    rows = []
+    n_failed = 0
+    for i in range(chunk["n"]):
+        sampled_params = sample_parameters(event["mer"], event["exit_v"], proposal=proposal)
+        generate_inp_file(
+            event["year"], event["month"], event["day"], event["hour"],
+            event["mer"], event["exit_v"],
+            TEMPLATE_FILE,
+            work_dir,
+            sampled_params=sampled_params,
+            volcano=event["volcano"]
+        )
+        try:
+            height = read_column_height(run_fplume_exe(date_prefix, work_dir))
+        except (subprocess.CalledProcessError, FileNotFoundError) as e:
+            print(f"  Run {chunk['start'] + i} of {date_prefix} failed: {e}")
+            n_failed += 1
+            continue
+        if height is not None:
+            if proposal is not None:
+                sampled_params["weight"] = importance_weight(
+                    sampled_params, event["mer"], event["exit_v"], proposal
+                )
+                weights[i] = sampled_params["weight"]
+            heights[i] = float(height)
+            rows.append(sampled_params)
+
+    samples_file = chunk_samples_file(date_prefix, chunk["index"])
+    samples_file.parent.mkdir(parents=True, exist_ok=True)
+    samples_file.unlink(missing_ok=True)
+    write_samples_rows(samples_file, rows)
+    return heights, weights, n_failed
+
+def save_event(event, writer, n_chunks):
+    """
+    Closes the heights arrays of an event and writes its .column and .samples files, in chunk order.
+    """
+    date_prefix = event["date_prefix"]
+    writer.close()
+    export_column_file(COLUMN_FILES_DIR, date_prefix, COLUMN_FILES_DIR / f"{date_prefix}.column")
+
+    header = None
+    with open(COLUMN_FILES_DIR / f"{date_prefix}.samples", "w") as out:
+        for index in range(n_chunks):
+            samples_file = chunk_samples_file(date_prefix, index)
+            if not samples_file.exists():
+                continue
+            with open(samples_file, "r") as f:
+                first = f.readline()
+                if header is None:
+                    header = first
+                    out.write(header)
+                shutil.copyfileobj(f, out)
+    shutil.rmtree(chunk_samples_file(date_prefix, 0).parent, ignore_errors=True)
+
+def run_campaign(events, n_workers, importance=False, n_runs=n_montecarlo, inputs=None):
+    """
+    Runs the Monte Carlo simulation of all the events over a shared pool of n_workers FPLUME
+    workers, handing out chunks longest-expected-first.
+
+    Failed FPLUME runs (non-zero exit code or missing result file) are stored as failed
+    runs (NaN heights) and counted in the report at the end; the runtime history counts the
+    runs with a result only. Any other error stops the campaign and is raised.
+
+    Args:
+        inputs (dict, optional): {date_prefix: {"met": DataFrame or Path, "tgsd": Path}}
+            (pipeline.py). By default, the inputs prepared in TMP_MONTECARLO_DIR.
+
+    Returns:
+        dict: number of failed FPLUME runs of each event with failures, {date_prefix: n}.
+    """
+    settings = CONFIG["scheduler"]
+    if inputs is None:
+        inputs = {e["date_prefix"]: prepared_inputs(e["date_prefix"]) for e in events}
+    ready = []
+    for event in events:
+        if inputs.get(event["date_prefix"]) is None:
+            print(f"Skipped {event['date_prefix']}: missing inputs. Please run prepare_input_files.py")
+            continue
+        ready.append(event)
+    events = ready
+    if not events:
+        return {}
+
+    # ---Importance sampling proposals are designed before scheduling the runs
+    proposals = {}
+    if importance:
+        pilot_dir = FPLUME_EXE_DIR / "tmp_montecarlo"
+        for event in events:
+            stage_event(event["date_prefix"], pilot_dir, inputs[event["date_prefix"]])
+            proposals[event["date_prefix"]] = design_importance_proposal(event, pilot_dir, pilot_dir)
+            clean_working_dirs(event["date_prefix"], pilot_dir, inputs=False)
+
+    expected = expected_seconds_per_run(events)
+    chunks = make_chunks(events, expected, n_runs, settings["chunk_size"])
+    total_expected = sum(c["expected"] for c in chunks)
+    print(f"Scheduling {len(chunks)} chunks of {len(events)} events on {n_workers} workers, "
+          f"expected {total_expected / n_workers / 60:.1f} min")
+
+    tasks = queue.Queue()
+    for chunk in chunks:
+        tasks.put(chunk)
+
+    # ---Preallocated heights (and weights) of all the runs of every event
+    writers = {e["date_prefix"]: EnsembleWriter(COLUMN_FILES_DIR, e["date_prefix"], n_runs, weighted=importance)
+               for e in events}
+    for e in events:
+        shutil.rmtree(chunk_samples_file(e["date_prefix"], 0).parent, ignore_errors=True)
+
+    lock = threading.Lock()
+    n_done = {e["date_prefix"]: 0 for e in events}
+    worker_seconds = {e["date_prefix"]: 0.0 for e in events}
+    remaining = {e["date_prefix"]: 0 for e in events}
+    for chunk in chunks:
+        remaining[chunk["event"]["date_prefix"]] += 1
+    n_chunks = dict(remaining)
+    failed = {e["date_prefix"]: 0 for e in events}
+    progress = {"done": 0, "done_expected": 0.0}
+    abort = threading.Event()
+    start = time.perf_counter()
+
+    def worker(k):
+        work_dir = FPLUME_EXE_DIR / f"tmp_montecarlo_{k}"
+        shutil.rmtree(work_dir, ignore_errors=True)
+        work_dir.mkdir(parents=True, exist_ok=True)
+        staged = set()
+        try:
+            while not abort.is_set():
+                try:
+                    chunk = tasks.get_nowait()
+                except queue.Empty:
+                    break
+                run_task(chunk, work_dir, staged)
+        except BaseException:
+            # ---Stop the other workers, the error is raised by run_campaign
+            abort.set()
+            raise
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    def run_task(chunk, work_dir, staged):
+        event = chunk["event"]
+        date_prefix = event["date_prefix"]
+        if date_prefix not in staged:
+            stage_event(date_prefix, work_dir, inputs[date_prefix])
+            staged.add(date_prefix)
+
+        chunk_start = time.perf_counter()
+        heights, weights, n_failed = run_chunk(chunk, work_dir, proposals.get(date_prefix))
+        chunk_seconds = time.perf_counter() - chunk_start
+
+        with lock:
+            writers[date_prefix].write(chunk["start"], heights, weights)
+            n_done[date_prefix] += int(np.sum(~np.isnan(heights)))
+            failed[date_prefix] += n_failed
+            worker_seconds[date_prefix] += chunk_seconds
+            remaining[date_prefix] -= 1
+            progress["done"] += 1
+            progress["done_expected"] += chunk["expected"]
+
+            # ---Projected completion from the observed wall time per unit of expected work
+            elapsed = time.perf_counter() - start
+            left = elapsed / progress["done_expected"] * (total_expected - progress["done_expected"])
+            eta = datetime.now() + timedelta(seconds=left)
+            print(f"  Chunk {progress['done']}/{len(chunks)} ({date_prefix}) done, "
+                  f"projected completion at {eta:%Y-%m-%d %H:%M:%S} (in {left / 60:.1f} min)")
+
+            if remaining[date_prefix] == 0:
+                save_event(event, writers[date_prefix], n_chunks[date_prefix])
+                # ---Runtime per run with a result, as run_montecarlo records it
+                record_runtime(event, n_done[date_prefix], worker_seconds[date_prefix])
+                note = f", {failed[date_prefix]} failed FPLUME runs" if failed[date_prefix] else ""
+                print(f"  Event {date_prefix} complete: {n_done[date_prefix]} runs{note}")
+
+    with ThreadPoolExecutor(max_workers=n_workers) as pool:
+        futures = [pool.submit(worker, k) for k in range(n_workers)]
+    for future in futures:
+        future.result()
+    print(f"Campaign completed in {(time.perf_counter() - start) / 60:.1f} min")
+
+    failed = {date_prefix: n for date_prefix, n in failed.items() if n}
+    if failed:
+        print("Failed FPLUME runs (stored as failed runs): "
+              + ", ".join(f"{date_prefix} {n}" for date_prefix, n in failed.items()))
+    return failed
@@ -0,0 +1,238 @@
+"""
+Estimates first-order and total sensitivity indices of the simulated column height with
+respect to the perturbed FPLUME inputs (MER, exit velocity, exit temperature, exit water
+fraction, cp, c_umbrella).
+
+No new FPLUME run is needed: the indices are computed from the .column and .samples files
+already stored in COLUMN_FILES_DIR by run_montecarlo.py (given-data estimators):
+    - First order S_i = Var(E[H | X_i]) / Var(H): each input is split into equiprobable bins
+      and the variance of the bin means of H is computed. All events with the same number
+      of samples are processed at once as (events, samples, parameters) arrays.
+    - Total S_Ti = E[Var(H | X_~i)] / Var(H): for every sample, the nearest sample in the
+      rank-transformed space of all the other inputs is found and S_Ti is estimated as
+      mean((H - H_nn)^2) / (2 Var(H)).
+
+Indices are ranked per event and per MER class (same threshold of qqplot_montecarlo.py) and
+saved to PROCESSED_DATA_DIR/sensitivity_indices.csv.
+
+Usage:
+    python fplume_montecarlo.sensitivity_montecarlo --code <n>
+    python fplume_montecarlo.sensitivity_montecarlo --all
+"""
+
+# ---Import packages
+import argparse
+
+import numpy as np
+import pandas as pd
+from scipy.spatial import cKDTree
+
+# ---Import directories and utilities
+from fplume_montecarlo.config import COLUMN_FILES_DIR, ERUPTIONS_FILE, PROCESSED_DATA_DIR
+from fplume_montecarlo.utilities import load_column_file, load_events, load_samples_file
+
+# ---MER threshold (kg/s) separating low and high MER events
+MER_THRESHOLD = 1e6
+
+def load_ensembles(events):
+    """
+    Loads the stored inputs and outputs of the Monte Carlo runs of each event.
+
+    Returns:
+        list[dict]: one entry per event with keys "event", "X" (N x P array of inputs),
+        "Y" (N array of column heights) and "parameters" (list of input names).
+    """
+    ensembles = []
+    for event in events:
+        date_prefix = event["date_prefix"]
+        column_file = COLUMN_FILES_DIR / f"{date_prefix}.column"
+        samples_file = COLUMN_FILES_DIR / f"{date_prefix}.samples"
+        if not column_file.exists() or not samples_file.exists():
+            print(f"Skipped {date_prefix}: missing .column or .samples file. "
+                  f"Please run run_montecarlo.py")
+            continue
+
+        heights = load_column_file(column_file)
+        samples = load_samples_file(samples_file)
+        if "weight" in samples.columns:
+            # ---Given-data estimators need samples of the nominal distribution
+            print(f"Skipped {date_prefix}: importance sampling ensemble")
+            continue
+        n = min(len(heights), len(samples))
+        if n < 2:
+            print(f"Skipped {date_prefix}: not enough samples")
+            continue
+
+        ensembles.append({
+            "event": event,
+            "X": samples.to_numpy(dtype=float)[:n],
+            "Y": heights[:n],
+            "parameters": list(samples.columns),
+        })
+    return ensembles
+
+def first_order_indices(X, Y, n_bins):
+    """
+    Binning estimator of the first-order indices, vectorized across events.
+
+    Parameters:
+        X (np.ndarray): inputs, shape (E, N, P).
+        Y (np.ndarray): outputs, shape (E, N).
+        n_bins (int): number of equiprobable bins per input.
+
+    Returns:
+        np.ndarray: first-order indices, shape (E, P).
+    """
+    E, N, P = X.shape
+
+    # ---Equiprobable bins from the ranks of each input
+    ranks = X.argsort(axis=1).argsort(axis=1)
+    bins = ranks * n_bins // N
+
+    # ---Conditional means of Y in each (event, parameter, bin) cell
+    cell = (np.arange(E)[:, None, None] * P + np.arange(P)[None, None, :]) * n_bins + bins
+    y = np.broadcast_to(Y[:, :, None], X.shape)
+    size = E * P * n_bins
+    sums = np.bincount(cell.ravel(), weights=y.ravel(), minlength=size).reshape(E, P, n_bins)
+    counts = np.bincount(cell.ravel(), minlength=size).reshape(E, P, n_bins)
+    means = sums / np.maximum(counts, 1)
+
+    # ---Variance of the conditional means over the variance of Y
+    y_mean = Y.mean(axis=1)[:, None, None]
+    var_cond = (counts * (means - y_mean) ** 2).sum(axis=2) / N
+    var_y = Y.var(axis=1)[:, None]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return var_cond / var_y
+
+def total_indices(X, Y):
+    """
+    Nearest-neighbour estimator of the total indices for a single event.
+
+    Parameters:
+        X (np.ndarray): inputs, shape (N, P).
+        Y (np.ndarray): outputs, shape (N,).
+
+    Returns:
+        np.ndarray: total indices, shape (P,).
+    """
+    N, P = X.shape
+    var_y = Y.var()
+    if var_y == 0:
+        return np.full(P, np.nan)
+
+    # ---Rank transform so that all inputs have uniform marginals on [0, 1)
+    U = X.argsort(axis=0).argsort(axis=0) / N
+
+    totals = np.empty(P)
+    for i in range(P):
+        others = np.delete(U, i, axis=1)
+        _, idx = cKDTree(others).query(others, k=2)
+        totals[i] = np.mean((Y - Y[idx[:, 1]]) ** 2) / (2 * var_y)
+    return totals
+
+def compute_indices(ensembles, n_bins=None):
+    """
+    Computes first-order and total indices for every ensemble.
+
+    Events are grouped by number of samples so that the first-order indices of each
+    group are computed in a single vectorized call.
+
+    Returns:
+        pd.DataFrame: one row per (event, parameter) with S1, ST and the rank of the
+        parameter within the event (1 = most influential, by total index).
+    """
+    groups = {}
+    for ens in ensembles:
+        groups.setdefault(ens["X"].shape, []).append(ens)
+
+    rows = []
+    for (N, P), group in groups.items():
+        bins = n_bins or max(2, int(np.sqrt(N)))
+        X = np.stack([ens["X"] for ens in group])
+        Y = np.stack([ens["Y"] for ens in group])
+        S1 = first_order_indices(X, Y, bins)
+
+        for e, ens in enumerate(group):
+            ST = total_indices(ens["X"], ens["Y"])
+            event = ens["event"]
+            for p, name in enumerate(ens["parameters"]):
+                rows.append({
+                    "code": event["code"],
+                    "date_prefix": event["date_prefix"],
+                    "mer": event["mer"],
+                    "mer_class": "high" if event["mer"] >= MER_THRESHOLD else "low",
+                    "parameter": name,
+                    "S1": S1[e, p],
+                    "ST": ST[p],
+                })
+
+    # ---Indices are NaN for ensembles without output variance: ranked last
+    df = pd.DataFrame(rows)
+    if not df.empty:
+        df["rank"] = (df.groupby("date_prefix")["ST"]
+                      .rank(ascending=False, method="min", na_option="bottom").astype(int))
+    return df
+
+def rank_by_class(df):
+    """
+    Averages the indices of the events in each MER class and ranks the parameters.
+
+    Returns:
+        pd.DataFrame: one row per (mer_class, parameter) with mean S1, ST and rank.
+    """
+    classes = (df.groupby(["mer_class", "parameter"], as_index=False)[["S1", "ST"]].mean())
+    classes["n_events"] = classes["mer_class"].map(df.groupby("mer_class")["date_prefix"].nunique())
+    classes["rank"] = (classes.groupby("mer_class")["ST"]
+                       .rank(ascending=False, method="min", na_option="bottom").astype(int))
+    return classes.sort_values(["mer_class", "rank"])
+
+def print_rankings(df, classes):
+    """
+    Prints the parameter rankings per event and per MER class.
+    """
+    print(f"{'Event':<16} {'Parameter':<22} {'S1':>8} {'ST':>8} {'Rank':>6}")
+    for date_prefix, group in df.groupby("date_prefix", sort=False):
+        for _, row in group.sort_values("rank").iterrows():
+            print(f"{date_prefix:<16} {row['parameter']:<22} "
+                  f"{row['S1']:>8.3f} {row['ST']:>8.3f} {row['rank']:>6d}")
+
+    print(f"\n{'MER class':<16} {'Parameter':<22} {'S1':>8} {'ST':>8} {'Rank':>6}")
+    for _, row in classes.iterrows():
+        label = f"{row['mer_class']} ({row['n_events']})"
+        print(f"{label:<16} {row['parameter']:<22} "
+              f"{row['S1']:>8.3f} {row['ST']:>8.3f} {row['rank']:>6d}")
+
+def main():
+    """
+    Parses command-line arguments and computes the sensitivity indices of the selected events.
+    """
+    parser = argparse.ArgumentParser(description="Sensitivity indices from stored Monte Carlo runs")
+    parser.add_argument("--code", type=int, help="Process only one event by code")
+    parser.add_argument("--all", action="store_true", help="Process all events")
+    parser.add_argument("--bins", type=int, default=None,
+                        help="Number of bins of the first-order estimator (default: sqrt(N))")
+    args = parser.parse_args()
+
+    if args.all:
+        events = load_events(ERUPTIONS_FILE, code=None)
+    elif args.code:
+        events = [load_events(ERUPTIONS_FILE, code=args.code)]
+    else:
+        raise ValueError("Please specify --code <int> or --all")
+
+    ensembles = load_ensembles(events)
+    if not ensembles:
+        print("No Monte Carlo results with stored samples found")
+        return
+
+    df = compute_indices(ensembles, n_bins=args.bins)
+    classes = rank_by_class(df)
+    print_rankings(df, classes)
+
+    output_file = PROCESSED_DATA_DIR / "sensitivity_indices.csv"
+    df.to_csv(output_file, index=False)
+    classes.to_csv(PROCESSED_DATA_DIR / "sensitivity_indices_mer_class.csv", index=False)
+    print(f"Saved sensitivity indices to: {output_file}")
+
+if __name__ == "__main__":
+    main()
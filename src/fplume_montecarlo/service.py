@@ -0,0 +1,368 @@
+"""
+Long-lived local job service for near-real-time plume height distributions.
+
+The service keeps resident in memory the configuration, the compiled .inp template, the .tgsd
+template and the .met profiles already requested, and a pool of FPLUME workers, each one with
+its own scratch directory in FPLUME_EXE_DIR where the inputs of an event are staged only once.
+
+Jobs are submitted over a local HTTP endpoint, for an event of list_eruptions.txt or for
+ad-hoc conditions, and split into single FPLUME runs. Runs of "urgent" jobs are always taken
+before those of "batch" jobs (e.g. backfill of the catalog). Results can be polled or
+streamed as they arrive, and are saved in COLUMN_FILES_DIR/service when a job is complete.
+
+Endpoints:
+    POST /jobs                 {"code": 166, "n": 1000, "priority": "urgent"}
+                               {"year": "2021", "month": "02", "day": "16", "hour": "17",
+                                "mer": 1.2e6, "exit_v": 250, "n": 1000,
+                                "volcano": "Vesuvius"}   (default volcano of config.yaml)
+    GET  /jobs                 status of all the jobs
+    GET  /jobs/<id>            status and summary statistics of a job
+    GET  /jobs/<id>/stream     column heights (one JSON line per run) as they arrive
+
+Usage:
+    python fplume_montecarlo.service --port 8765 --workers 4
+"""
+
+# ---Import packages
+import argparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import itertools
+import json
+import queue
+import shutil
+import threading
+import time
+
+from loguru import logger
+import numpy as np
+
+# ---Import directories and utilities
+from fplume_montecarlo.config import (
+    COLUMN_FILES_DIR,
+    ERUPTIONS_FILE,
+    FPLUME_EXE_DIR,
+    FPLUME_TEMPLATES_DIR,
+    PROJ_ROOT,
+    TEMPLATE_FILE,
+)
+from fplume_montecarlo.generate_inp_file import generate_inp_file, load_template, sample_parameters
+from fplume_montecarlo.run_montecarlo import read_column_height, run_fplume_exe, write_samples_row
+from fplume_montecarlo.utilities import (
+    event_date_prefix,
+    load_config,
+    load_events,
+    resolve_volcano,
+)
+
+CONFIG = load_config(PROJ_ROOT / "config.yaml")
+
+# ---Job priorities (lower runs first)
+PRIORITIES = {"urgent": 0, "batch": 1}
+
+# ---Output directory of the service
+SERVICE_DIR = COLUMN_FILES_DIR / "service"
+
+class Job:
+    """
+    A Monte Carlo request: n FPLUME runs for one event, collected as they complete.
+    """
+
+    def __init__(self, job_id, event, n, priority):
+        self.job_id = job_id
+        self.event = event
+        self.n = n
+        self.priority = priority
+        self.status = "queued"
+        self.heights = []
+        self.samples = []
+        self.failed = 0
+        self.error = None
+        self.submitted = time.time()
+        self.finished = None
+        self.cond = threading.Condition()
+
+    def add_result(self, sampled_params, height, error=None):
+        """
+        Records the outcome of one run and wakes up the clients streaming the job.
+
+        Returns:
+            bool: True if this run completed the job.
+        """
+        with self.cond:
+            self.status = "running"
+            if height is None:
+                self.failed += 1
+                self.error = error or self.error
+            else:
+                self.heights.append(height)
+                self.samples.append(sampled_params)
+            if len(self.heights) + self.failed >= self.n:
+                self.status = "done" if self.heights else "failed"
+                self.finished = time.time()
+            self.cond.notify_all()
+            return self.finished is not None
+
+    def summary(self):
+        """
+        Status of the job with box statistics of the heights received so far (m a.s.l.).
+        """
+        with self.cond:
+            heights = np.array(self.heights) + self.event["volcano"].height
+            info = {
+                "job_id": self.job_id,
+                "date_prefix": self.event["date_prefix"],
+                "priority": self.priority,
+                "status": self.status,
+                "n": self.n,
+                "completed": len(self.heights),
+                "failed": self.failed,
+                "error": self.error,
+                "elapsed_s": round((self.finished or time.time()) - self.submitted, 1),
+            }
+        if len(heights):
+            q1, q25, q50, q75, q99 = np.percentile(heights, [1, 25, 50, 75, 99])
+            info["stats"] = {"whislo": q1, "q1": q25, "med": q50, "q3": q75, "whishi": q99}
+            if self.event.get("h") is not None:
+                info["ecdf_radar"] = float(np.mean(heights <= self.event["h"]))
+        return info
+
+    def save(self):
+        """
+        Saves the .column and .samples files of a completed job.
+        """
+        SERVICE_DIR.mkdir(parents=True, exist_ok=True)
+        stem = f"{self.event['date_prefix']}.job{self.job_id}"
+        samples_file = SERVICE_DIR / f"{stem}.samples"
+        samples_file.unlink(missing_ok=True)
+        with open(SERVICE_DIR / f"{stem}.column", "w") as f:
+            for height, sampled_params in zip(self.heights, self.samples):
+                f.write(f"{height}\n")
+                write_samples_row(samples_file, sampled_params)
+
+class JobService:
+    """
+    Priority queue of single FPLUME runs served by a pool of resident worker threads.
+    """
+
+    def __init__(self, n_workers):
+        self.tasks = queue.PriorityQueue()
+        self.jobs = {}
+        self.job_ids = itertools.count(1)
+        self.task_ids = itertools.count()
+        self.lock = threading.Lock()
+
+        # ---Resident inputs: compiled template, .tgsd template and .met profiles by date
+        load_template(TEMPLATE_FILE)
+        with open(FPLUME_TEMPLATES_DIR / "template_fplume.tgsd", "r") as f:
+            self.tgsd = f.read()
+        self.met_profiles = {}
+
+        self.workers = [
+            threading.Thread(target=self.worker, args=(k,), daemon=True)
+            for k in range(n_workers)
+        ]
+        for worker in self.workers:
+            worker.start()
+
+    def resolve_event(self, request):
+        """
+        Builds the event dict of a job from a catalog code or from ad-hoc conditions.
+        """
+        if "code" in request:
+            return load_events(ERUPTIONS_FILE, code=int(request["code"]))
+
+        event = {key: request[key] for key in ("mer", "exit_v")}
+        for key, width in (("year", 4), ("month", 2), ("day", 2), ("hour", 2)):
+            event[key] = f"{int(request[key]):0{width}d}"
+        event["h"] = request.get("h")
+        event["code"] = None
+        event["volcano"] = resolve_volcano(request.get("volcano"))
+        event["date_prefix"] = event_date_prefix(event["year"], event["month"], event["day"],
+                                                 event["hour"], event["volcano"])
+        return event
+
+    def met_profile(self, event):
+        """
+        Returns the .met profile of an event, kept in memory after the first request.
+        The profile is created from the ERA5 file if the .met file does not exist yet.
+        """
+        date_prefix = event["date_prefix"]
+        with self.lock:
+            if date_prefix not in self.met_profiles:
+                from fplume_montecarlo.create_met_file import ensure_met_file
+
+                with open(ensure_met_file(event), "r") as f:
+                    self.met_profiles[date_prefix] = f.read()
+            return self.met_profiles[date_prefix]
+
+    def submit(self, request):
+        """
+        Creates a job and queues its runs.
+
+        Returns:
+            Job: the submitted job.
+        """
+        priority = request.get("priority", "batch")
+        if priority not in PRIORITIES:
+            raise ValueError(f"Unknown priority '{priority}'. Available: {list(PRIORITIES)}")
+        event = self.resolve_event(request)
+        self.met_profile(event)                            # fail early if no met data
+
+        job = Job(next(self.job_ids), event, int(request.get("n", CONFIG["n_montecarlo"])), priority)
+        with self.lock:
+            self.jobs[job.job_id] = job
+        for _ in range(job.n):
+            self.tasks.put((PRIORITIES[priority], job.job_id, next(self.task_ids), job))
+        return job
+
+    def worker(self, k):
+        """
+        Worker loop: takes the highest priority run, stages the inputs of its event in the
+        scratch directory of the worker (once per event) and runs FPLUME.
+        """
+        work_dir = FPLUME_EXE_DIR / f"tmp_worker_{k}"
+        shutil.rmtree(work_dir, ignore_errors=True)
+        work_dir.mkdir(parents=True, exist_ok=True)
+        staged = set()
+
+        while True:
+            _, _, _, job = self.tasks.get()
+            try:
+                if self.run_task(job, work_dir, staged):
+                    job.save()
+            except Exception:
+                # ---The job is complete but its files could not be saved
+                logger.exception(f"Could not save job {job.job_id}")
+            finally:
+                self.tasks.task_done()
+
+    def run_task(self, job, work_dir, staged):
+        """
+        One FPLUME run of a job in the scratch directory work_dir. Any error (sampling,
+        inputs, rendering of the .inp file, FPLUME) is logged with its traceback and recorded
+        as a failed run, so that the job always completes.
+
+        Returns:
+            bool: True if this run completed the job.
+        """
+        event = job.event
+        date_prefix = event["date_prefix"]
+        sampled_params = None
+        try:
+            sampled_params = sample_parameters(event["mer"], event["exit_v"])
+            if date_prefix not in staged:
+                with open(work_dir / f"{date_prefix}.met", "w") as f:
+                    f.write(self.met_profile(event))
+                with open(work_dir / f"{date_prefix}.tgsd", "w") as f:
+                    f.write(self.tgsd)
+                staged.add(date_prefix)
+
+            generate_inp_file(
+                event["year"], event["month"], event["day"], event["hour"],
+                event["mer"], event["exit_v"],
+                TEMPLATE_FILE,
+                work_dir,
+                sampled_params=sampled_params,
+                volcano=event["volcano"]
+            )
+            height = read_column_height(run_fplume_exe(date_prefix, work_dir))
+            height = float(height) if height is not None else None
+        except Exception as e:
+            logger.exception(f"Run of job {job.job_id} ({date_prefix}) failed")
+            return job.add_result(sampled_params, None, error=f"{type(e).__name__}: {e}")
+        return job.add_result(sampled_params, height)
+
+def make_handler(service):
+    """
+    Builds the HTTP request handler bound to a JobService.
+    """
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def send_json(self, status, payload):
+            body = json.dumps(payload, default=float).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def get_job(self, job_id):
+            job = service.jobs.get(int(job_id)) if job_id.isdigit() else None
+            if job is None:
+                self.send_json(404, {"error": f"Unknown job {job_id}"})
+            return job
+
+        def do_POST(self):
+            if self.path.rstrip("/") != "/jobs":
+                return self.send_json(404, {"error": f"Unknown endpoint {self.path}"})
+            try:
+                length = int(self.headers.get("Content-Length", 0))
+                job = service.submit(json.loads(self.rfile.read(length) or b"{}"))
+            except (ValueError, KeyError, OSError) as e:
+                return self.send_json(400, {"error": str(e)})
+            self.send_json(202, job.summary())
+
+        def do_GET(self):
+            parts = [p for p in self.path.split("/") if p]
+            if parts == ["jobs"]:
+                return self.send_json(200, [job.summary() for job in service.jobs.values()])
+            if len(parts) == 2 and parts[0] == "jobs":
+                job = self.get_job(parts[1])
+                return job and self.send_json(200, job.summary())
+            if len(parts) == 3 and parts[0] == "jobs" and parts[2] == "stream":
+                job = self.get_job(parts[1])
+                return job and self.stream(job)
+            self.send_json(404, {"error": f"Unknown endpoint {self.path}"})
+
+        def stream(self, job):
+            """
+            Streams one JSON line per completed run, then a final summary line.
+            """
+            self.send_response(200)
+            self.send_header("Content-Type", "application/x-ndjson")
+            self.end_headers()
+            sent = 0
+            while True:
+                with job.cond:
+                    while sent == len(job.heights) and job.status not in ("done", "failed"):
+                        job.cond.wait()
+                    new = job.heights[sent:]
+                    finished = job.status in ("done", "failed")
+                for height in new:
+                    sent += 1
+                    self.wfile.write(json.dumps({"run": sent, "height": height + job.event["volcano"].height})
+                                     .encode() + b"\n")
+                self.wfile.flush()
+                if finished and sent == len(job.heights):
+                    break
+            self.wfile.write(json.dumps(job.summary(), default=float).encode() + b"\n")
+
+        def log_message(self, format, *args):
+            print(f"[service] {self.address_string()} {format % args}")
+
+    return Handler
+
+def main():
+    """
+    Parses command-line arguments and starts the job service.
+    """
+    parser = argparse.ArgumentParser(description="Local FPLUME Monte Carlo job service")
+    parser.add_argument("--host", default="127.0.0.1", help="Address to listen on (local by default)")
+    parser.add_argument("--port", type=int, default=8765, help="Port to listen on")
+    parser.add_argument("--workers", type=int, default=4, help="Number of FPLUME workers")
+    args = parser.parse_args()
+
+    service = JobService(args.workers)
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(service))
+    print(f"FPLUME job service listening on http://{args.host}:{args.port} "
+          f"with {args.workers} workers")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,236 @@
+"""
+Time-series campaign mode for long eruptions (e.g. paroxysms lasting several hours): plume
+height distributions at every hour of a start/end window (list_timeseries.txt).
+
+For each campaign:
+    - the ERA5 pressure levels of all the hours are downloaded with a single request
+      (download_era5_window), unless the file already exists in ERA5_DIR;
+    - the .met profiles of all the hours are generated in one pass over the file;
+    - hours whose profile barely changes share the Monte Carlo runs: the profile of each hour
+      is compared with the last simulated hour (RMS vector wind and temperature differences
+      below max_altitude_km), and it reuses those runs if both differences are below the
+      thresholds in config.yaml (timeseries); otherwise it is simulated with run_montecarlo;
+    - a summary of the plume height distribution at every hour is saved.
+
+Outputs are saved in COLUMN_FILES_DIR/timeseries:
+    - {date_prefix}.column and {date_prefix}.samples of the simulated hours
+    - {code}_{start}_{end}.timeseries.csv: one row per hour, with the simulated hour whose
+      runs it uses (source) and the profile differences
+
+Usage:
+    python fplume_montecarlo.timeseries_montecarlo --code <n>
+    python fplume_montecarlo.timeseries_montecarlo --all
+    python fplume_montecarlo.timeseries_montecarlo --code <n> --plan      # only plan the runs
+    python fplume_montecarlo.timeseries_montecarlo --code <n> --profile   # see profiling.py
+"""
+
+# ---Import packages
+import argparse
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+# ---Import directories and utilities
+from fplume_montecarlo.config import (
+    COLUMN_FILES_DIR,
+    ERA5_DIR,
+    FPLUME_MET_FILES_DIR,
+    FPLUME_TEMPLATES_DIR,
+    PROJ_ROOT,
+    TIMESERIES_FILE,
+    TMP_MONTECARLO_DIR,
+)
+from fplume_montecarlo.create_met_file import process_era5_timeseries, save_to_txt
+from fplume_montecarlo.ensemble_store import ensemble_percentiles, open_ensemble
+from fplume_montecarlo.profiling import profiled
+from fplume_montecarlo.run_montecarlo import run_fplume, stage_inputs
+from fplume_montecarlo.utilities import event_date_prefix, load_campaigns, load_config
+
+CONFIG = load_config(PROJ_ROOT / "config.yaml")
+
+# ---Output directory of the time-series campaigns
+TIMESERIES_DIR = COLUMN_FILES_DIR / "timeseries"
+
+def hourly_event(campaign, hour):
+    """
+    Builds the event dict (as in load_events) of one hour of a campaign.
+    """
+    event = {
+        "code": campaign["code"],
+        "year": f"{hour.year:04d}",
+        "month": f"{hour.month:02d}",
+        "day": f"{hour.day:02d}",
+        "hour": f"{hour.hour:02d}",
+        "mer": campaign["mer"],
+        "exit_v": campaign["exit_v"],
+        "h": campaign.get("h"),
+        "volcano": campaign["volcano"],
+    }
+    event["date_prefix"] = event_date_prefix(event["year"], event["month"], event["day"],
+                                             event["hour"], event["volcano"])
+    return event
+
+def fetch_era5(campaign, data_format="netcdf"):
+    """
+    Returns the ERA5 file covering the window of a campaign, downloading it with a single
+    request if it does not exist yet.
+    """
+    for suffix in (".grib", ".nc"):
+        era5_file = Path(ERA5_DIR) / f"{campaign['window_prefix']}_pressure_levels{suffix}"
+        if era5_file.exists():
+            return era5_file
+
+    from fplume_montecarlo.download_era5 import (
+        CDS_KEY,
+        CDS_URL,
+        FORMAT_SUFFIX,
+        download_era5_window,
+        pressure_level_vars,
+        pressure_levels,
+        volcano_area,
+    )
+
+    filename = f"{ERA5_DIR}/{campaign['window_prefix']}_pressure_levels{FORMAT_SUFFIX[data_format]}"
+    return Path(download_era5_window(campaign["start"], campaign["end"], pressure_level_vars,
+                                     pressure_levels, CDS_URL, CDS_KEY, data_format=data_format,
+                                     filename=filename, area=volcano_area(campaign["volcano"])))
+
+def create_met_files(campaign, era5_file):
+    """
+    Generates the .met files of all the hours of a campaign in one pass over the ERA5 file.
+
+    Returns:
+        dict: {pd.Timestamp: .met DataFrame}
+    """
+    hours = pd.date_range(campaign["start"], campaign["end"], freq="h")
+    profiles = process_era5_timeseries(era5_file, hours, campaign["volcano"])
+
+    FPLUME_MET_FILES_DIR.mkdir(parents=True, exist_ok=True)
+    for hour, df in profiles.items():
+        save_to_txt(df, FPLUME_MET_FILES_DIR / f"{hourly_event(campaign, hour)['date_prefix']}.met")
+    print(f"Saved {len(profiles)} met files to: {FPLUME_MET_FILES_DIR}")
+    return profiles
+
+def profile_difference(df_a, df_b, max_altitude_km):
+    """
+    RMS differences of vector wind (m/s) and temperature (K) between two .met profiles
+    on the same pressure levels, below max_altitude_km.
+
+    Returns:
+        tuple: (wind RMS difference, temperature RMS difference)
+    """
+    below = (df_a['Altitude (km)'] <= max_altitude_km).to_numpy()
+    du = df_a['Wind Velocity West->East (m/s)'].to_numpy() - df_b['Wind Velocity West->East (m/s)'].to_numpy()
+    dv = df_a['Wind Velocity North->South (m/s)'].to_numpy() - df_b['Wind Velocity North->South (m/s)'].to_numpy()
+    dt = df_a['Temperature (K)'].to_numpy() - df_b['Temperature (K)'].to_numpy()
+    return np.sqrt(np.mean(du[below] ** 2 + dv[below] ** 2)), np.sqrt(np.mean(dt[below] ** 2))
+
+def plan_runs(campaign, profiles):
+    """
+    Decides which hours are simulated and which ones reuse the runs of the last simulated hour.
+
+    Returns:
+        pd.DataFrame: one row per hour with date_prefix, source (date_prefix of the simulated
+        hour whose runs are used), wind_rms and temperature_rms (differences from the source).
+    """
+    settings = CONFIG["timeseries"]
+    rows = []
+    reference = None
+    for hour, df in profiles.items():
+        date_prefix = hourly_event(campaign, hour)["date_prefix"]
+        if reference is not None:
+            wind_rms, temperature_rms = profile_difference(df, profiles[reference[0]],
+                                                           settings["max_altitude_km"])
+            if wind_rms < settings["wind_threshold"] and temperature_rms < settings["temperature_threshold"]:
+                rows.append({"date_prefix": date_prefix, "source": reference[1],
+                             "wind_rms": wind_rms, "temperature_rms": temperature_rms})
+                continue
+        reference = (hour, date_prefix)
+        rows.append({"date_prefix": date_prefix, "source": date_prefix,
+                     "wind_rms": 0.0, "temperature_rms": 0.0})
+    return pd.DataFrame(rows)
+
+def summarize(campaign, plan):
+    """
+    Adds the box statistics (m a.s.l.) of the runs used by each hour to the plan.
+    """
+    stats = {}
+    for source in plan["source"].unique():
+        column_file = TIMESERIES_DIR / f"{source}.column"
+        if column_file.exists():
+            percentiles = ensemble_percentiles(open_ensemble(TIMESERIES_DIR, source), [1, 25, 50, 75, 99])
+            stats[source] = dict(zip(["p1", "p25", "p50", "p75", "p99"],
+                                     percentiles + campaign["volcano"].height))
+    summary = plan.join(pd.DataFrame([stats.get(s, {}) for s in plan["source"]], index=plan.index))
+    summary.insert(0, "code", campaign["code"])
+    return summary
+
+def run_campaign(campaign, importance=False, data_format="netcdf", plan_only=False):
+    """
+    Runs a time-series campaign: single ERA5 retrieval, .met files of all the hours, and
+    Monte Carlo runs shared by hours with similar profiles.
+
+    Returns:
+        pd.DataFrame: summary of the campaign (one row per hour).
+    """
+    era5_file = fetch_era5(campaign, data_format=data_format)
+    profiles = create_met_files(campaign, era5_file)
+    plan = plan_runs(campaign, profiles)
+
+    simulated = plan["source"].unique()
+    print(f"Campaign {campaign['code']}: {len(plan)} hours, {len(simulated)} simulated, "
+          f"{len(plan) - len(simulated)} reusing the runs of a previous hour")
+
+    if not plan_only:
+        for hour in profiles:
+            event = hourly_event(campaign, hour)
+            if event["date_prefix"] not in simulated:
+                continue
+            print(f"Processing hour {event['date_prefix']}")
+
+            # ---Stage the .met and .tgsd files of the hour (as prepare_input_files.py),
+            # replacing the files left by an interrupted campaign
+            for suffix in (".met", ".tgsd"):
+                (TMP_MONTECARLO_DIR / f"{event['date_prefix']}{suffix}").unlink(missing_ok=True)
+            stage_inputs(event["date_prefix"], FPLUME_MET_FILES_DIR, TMP_MONTECARLO_DIR,
+                         tgsd_template=FPLUME_TEMPLATES_DIR / "template_fplume.tgsd")
+            run_fplume(event, importance=importance, results_dir=TIMESERIES_DIR)
+
+    summary = summarize(campaign, plan)
+    TIMESERIES_DIR.mkdir(parents=True, exist_ok=True)
+    output_file = TIMESERIES_DIR / f"{campaign['code']}_{campaign['window_prefix']}.timeseries.csv"
+    summary.to_csv(output_file, index=False)
+    print(f"Saved time-series summary to: {output_file}")
+    return summary
+
+@profiled("timeseries_montecarlo")
+def main():
+    """
+    Parses command-line arguments and runs the selected time-series campaigns.
+    """
+    parser = argparse.ArgumentParser(description="Time-series Monte Carlo campaigns")
+    parser.add_argument("--code", type=int, help="Process only one campaign by code")
+    parser.add_argument("--all", action="store_true", help="Process all campaigns")
+    parser.add_argument("--format", choices=["netcdf", "grib"], default="netcdf",
+                        help="ERA5 download format")
+    parser.add_argument("--importance", action="store_true",
+                        help="Importance sampling toward the radar column height (requires h)")
+    parser.add_argument("--plan", action="store_true",
+                        help="Only create the .met files and plan the simulated hours")
+    args = parser.parse_args()
+
+    if args.all:
+        campaigns = load_campaigns(TIMESERIES_FILE, code=None)
+    elif args.code:
+        campaigns = [load_campaigns(TIMESERIES_FILE, code=args.code)]
+    else:
+        raise ValueError("Please specify --code <int> or --all")
+
+    for campaign in campaigns:
+        summary = run_campaign(campaign, importance=args.importance, data_format=args.format,
+                               plan_only=args.plan)
+        print(summary.to_string(index=False))
+
+if __name__ == "__main__":
+    main()
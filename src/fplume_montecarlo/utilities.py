@@ -1,4 +1,6 @@
-from fplume_montecarlo.config import ERUPTIONS_FILE, PROJ_ROOT
+from functools import cache
+
+from fplume_montecarlo.config import PROJ_ROOT
 
 def progress_bar(url, save_path, chunk_size=1024):
     """
@@ -30,14 +32,53 @@ def load_eruptions(filepath):
         sep="\t",
         encoding="utf-8",
         engine="python",
-        dtype={"year": str, "month": str, "day": str, "hour": str}
+        dtype={"year": str, "month": str, "day": str, "hour": str, "volcano": str}
     )
 
 
 
+@cache
+def default_volcano():
+    """
+    Volcano of config.yaml, used for the events without a volcano in the catalog.
+    """
+    return load_config(PROJ_ROOT / "config.yaml")["volcano"]
+
+def resolve_volcano(name):
+    """
+    Volcano of an event: the volcano named in the catalog (optional "volcano" column),
+    or the default volcano of config.yaml if the name is missing.
+
+    Returns:
+        Volcano: the volcano object.
+    """
+    import pandas as pd
+
+    from fplume_montecarlo.volcanoes import VOLCANOES
+
+    if name is None or (not isinstance(name, str) and pd.isna(name)) or name == "":
+        return default_volcano()
+    try:
+        return VOLCANOES[name]
+    except KeyError:
+        raise ValueError(f"Unknown volcano '{name}'. Available: {list(VOLCANOES.keys())}")
+
+def event_date_prefix(year, month, day, hour, volcano=None):
+    """
+    Prefix of the files of an event ({year}_{month}_{day}_{hour}). Events of a volcano other
+    than the default volcano of config.yaml are prefixed with the volcano name, so that
+    events of different volcanoes at the same hour do not share files.
+    """
+    date_prefix = f"{year}_{month}_{day}_{hour}"
+    if volcano is None or volcano.name == default_volcano().name:
+        return date_prefix
+    return f"{volcano.name}_{date_prefix}"
+
 def load_events(filepath, code=None):
     """
     Load eruption events. If "code" is provided, return only that event.
+    The volcano of each event ("volcano" column, default volcano of config.yaml if missing)
+    is attached to the event as a Volcano object.
 
     Parameters:
         filepath (str or Path): Path to the eruptions file.
@@ -48,22 +89,60 @@ def load_events(filepath, code=None):
         list[dict]: A list of event dicts if no code is provided.
     """
 
-    df = load_eruptions(ERUPTIONS_FILE)
+    df = load_eruptions(filepath)
+
+    def make_event(row):
+        event = row.to_dict()
+        event["volcano"] = resolve_volcano(event.get("volcano"))
+        event["date_prefix"] = event_date_prefix(
+            event["year"], event["month"], event["day"], event["hour"], event["volcano"]
+        )
+        return event
 
     if code is not None:
         event_row = df[df["code"] == code]
         if event_row.empty:
             raise ValueError(f"No event found with code {code}")
-        event = event_row.iloc[0].to_dict()
-        event["date_prefix"] = f"{event['year']}_{event['month']}_{event['day']}_{event['hour']}"
-        return event
+        return make_event(event_row.iloc[0])
+
+    return [make_event(row) for _, row in df.iterrows()]
+
+def load_campaigns(filepath, code=None):
+    """
+    Load time-series campaigns: eruptions spanning a start/end window (YYYY_MM_DD_HH, both
+    included), with columns code, start, end, mer, exit_v and optionally h and volcano.
+
+    Parameters:
+        filepath (str or Path): Path to the campaigns file.
+        code (int, optional): Specific campaign code to extract. If None, return all.
+
+    Returns:
+        dict: A single campaign dict if code is provided.
+        list[dict]: A list of campaign dicts if no code is provided.
+    """
+    import pandas as pd
+
+    df = pd.read_csv(filepath, sep="\t", encoding="utf-8", dtype={"start": str, "end": str, "volcano": str})
 
-    events = []
+    campaigns = []
     for _, row in df.iterrows():
-        event = row.to_dict()
-        event["date_prefix"] = f"{event['year']}_{event['month']}_{event['day']}_{event['hour']}"
-        events.append(event)
-    return events
+        campaign = row.to_dict()
+        campaign["volcano"] = resolve_volcano(campaign.get("volcano"))
+        campaign["start"] = pd.to_datetime(campaign["start"], format="%Y_%m_%d_%H")
+        campaign["end"] = pd.to_datetime(campaign["end"], format="%Y_%m_%d_%H")
+        if campaign["end"] < campaign["start"]:
+            raise ValueError(f"Campaign {campaign['code']} ends before it starts")
+        campaign["window_prefix"] = f"{campaign['start']:%Y_%m_%d_%H}_{campaign['end']:%Y_%m_%d_%H}"
+        if campaign["volcano"].name != default_volcano().name:
+            campaign["window_prefix"] = f"{campaign['volcano'].name}_{campaign['window_prefix']}"
+        campaigns.append(campaign)
+
+    if code is not None:
+        for campaign in campaigns:
+            if campaign["code"] == code:
+                return campaign
+        raise ValueError(f"No campaign found with code {code}")
+    return campaigns
 
 def load_config(config_file="config.yaml"):
     "Read config.yaml"
@@ -81,4 +160,72 @@ def load_config(config_file="config.yaml"):
     except KeyError:
         raise ValueError(f"Unknown volcano '{volcano_name}' in config.yaml. Available: {list(VOLCANOES.keys())}")
 
-    return config
\ No newline at end of file
+    return config
+
+def load_column_file(column_file):
+    """
+    Read the simulated column heights (m above the vent) stored in a .column file.
+
+    Returns:
+        np.ndarray: 1D array of heights, one per Monte Carlo run.
+    """
+    import numpy as np
+
+    with open(column_file, "r") as f:
+        values = [float(val) for line in f for val in line.strip().split()]
+    return np.array(values)
+
+def load_samples_file(samples_file):
+    """
+    Read the sampled FPLUME input parameters stored in a .samples file
+    (tab-separated, header with parameter names, one row per .column line).
+
+    Returns:
+        pd.DataFrame: One column per perturbed parameter.
+    """
+    import pandas as pd
+
+    return pd.read_csv(samples_file, sep="\t")
+
+def weighted_percentile(values, q, weights=None):
+    """
+    Percentile(s) q (0-100) of values with likelihood-ratio weights.
+    Without weights, this is np.percentile.
+
+    In-memory reference definition of the bounded-memory ensemble_percentiles of
+    ensemble_store.py, which the tests compare against it.
+    """
+    import numpy as np
+
+    if weights is None:
+        return np.percentile(values, q)
+
+    order = np.argsort(values, kind="stable")
+    sorted_vals, sorted_w = merge_ties(np.asarray(values)[order], np.asarray(weights)[order])
+    return midpoint_percentile(sorted_vals, sorted_w, q)
+
+def merge_ties(sorted_vals, sorted_weights):
+    """
+    Distinct values of sorted_vals with the summed weights of their tied runs, so that the
+    weighted statistics do not depend on the order of tied values.
+
+    Returns:
+        tuple: (np.ndarray of distinct values, np.ndarray of their weights)
+    """
+    import numpy as np
+
+    distinct, start = np.unique(sorted_vals, return_index=True)
+    return distinct, np.add.reduceat(sorted_weights, start) if len(start) else sorted_weights[:0]
+
+def midpoint_percentile(sorted_vals, sorted_weights, q, below=0.0, total=None):
+    """
+    Percentile(s) q (0-100) of distinct sorted values, interpolating the midpoint CDF
+    (weight below each value + half its weight) / total weight. "below" is the weight of
+    the values preceding sorted_vals that are not passed (ensemble_store), and total
+    defaults to the sum of sorted_weights.
+    """
+    import numpy as np
+
+    total = sorted_weights.sum() if total is None else total
+    cdf = (below + np.cumsum(sorted_weights) - 0.5 * sorted_weights) / total
+    return np.interp(np.asarray(q) / 100, cdf, sorted_vals)
@@ -0,0 +1,62 @@
+"""
+The bounded-memory percentiles of ensemble_store must agree with the in-memory definitions
+(np.percentile, utilities.weighted_percentile), including for ensembles with tied heights.
+"""
+
+import numpy as np
+import pytest
+
+from fplume_montecarlo.ensemble_store import EnsembleWriter, ensemble_percentiles, open_ensemble
+from fplume_montecarlo.utilities import weighted_percentile
+
+PERCENTILES = [0, 1, 5, 25, 50, 75, 95, 99, 100]
+
+def write_ensemble(directory, heights, weights=None, chunk_size=97):
+    writer = EnsembleWriter(directory, "event", len(heights), weighted=weights is not None,
+                            chunk_size=chunk_size)
+    writer.write(0, heights, weights)
+    writer.close()
+    return open_ensemble(directory, "event")
+
+def synthetic_heights(rng, n):
+    """
+    Column heights rounded to 10 m (many ties), with a few failed runs.
+    """
+    heights = np.round(rng.lognormal(np.log(6000), 0.2, n), -1)
+    heights[rng.random(n) < 0.05] = np.nan
+    return heights
+
+@pytest.mark.parametrize("seed", range(20))
+@pytest.mark.parametrize("bins", [16, 65536])
+def test_weighted_percentiles_match(tmp_path, seed, bins):
+    rng = np.random.default_rng(seed)
+    n = int(rng.integers(50, 3000))
+    heights = synthetic_heights(rng, n)
+    weights = rng.uniform(0.2, 3.0, n)
+    ensemble = write_ensemble(tmp_path, heights, weights)
+
+    valid = ~np.isnan(heights)
+    expected = weighted_percentile(heights[valid], PERCENTILES, weights[valid])
+    np.testing.assert_allclose(ensemble_percentiles(ensemble, PERCENTILES, bins=bins),
+                               expected, rtol=1e-12)
+
+@pytest.mark.parametrize("seed", range(5))
+def test_plain_percentiles_match(tmp_path, seed):
+    rng = np.random.default_rng(seed)
+    heights = synthetic_heights(rng, 2000)
+    ensemble = write_ensemble(tmp_path, heights)
+
+    expected = np.percentile(heights[~np.isnan(heights)], PERCENTILES)
+    np.testing.assert_allclose(ensemble_percentiles(ensemble, PERCENTILES, bins=64),
+                               expected, rtol=1e-12)
+
+def test_weighted_percentile_ignores_order_of_ties():
+    rng = np.random.default_rng(0)
+    heights = np.round(rng.normal(6000, 500, 1000), -2)
+    weights = rng.uniform(0.2, 3.0, 1000)
+
+    expected = weighted_percentile(heights, PERCENTILES, weights)
+    for _ in range(10):
+        order = rng.permutation(len(heights))
+        np.testing.assert_allclose(weighted_percentile(heights[order], PERCENTILES, weights[order]),
+                                   expected, rtol=1e-12)